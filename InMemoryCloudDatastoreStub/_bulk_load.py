@@ -0,0 +1,63 @@
+import io
+from google.cloud import ndb
+from google.cloud.datastore_v1 import types
+from google.protobuf import json_format
+from typing import cast, IO, Iterable, Iterator, Optional, Union
+
+_JSONL = "jsonl"
+_DELIMITED = "delimited"
+
+_BulkSource = Union[str, IO[bytes], Iterable[Union[ndb.Model, types.Entity]]]
+
+
+def _read_delimited(stream: IO[bytes]) -> Iterator[bytes]:
+    # Varint length prefixed messages, as written by protobuf's
+    # writeDelimitedTo and the like
+    while True:
+        length = 0
+        shift = 0
+        while True:
+            byte = stream.read(1)
+            if not byte:
+                if shift:
+                    raise ValueError("Truncated delimited protobuf stream")
+                return
+            length |= (byte[0] & 0x7F) << shift
+            if not byte[0] & 0x80:
+                break
+            shift += 7
+        message = stream.read(length)
+        if len(message) != length:
+            raise ValueError("Truncated delimited protobuf stream")
+        yield message
+
+
+def _read_stream(stream: IO[bytes], source_format: str) -> Iterator[types.Entity]:
+    if source_format == _JSONL:
+        # One Entity per line, in the JSON form of the datastore REST API
+        for line in stream:
+            if line.strip():
+                yield json_format.Parse(line, types.Entity())
+    elif source_format == _DELIMITED:
+        for message in _read_delimited(stream):
+            yield types.Entity.FromString(message)
+    else:
+        raise ValueError(f"Unknown bulk load format {source_format!r}")
+
+
+def _bulk_entities(
+    source: _BulkSource, source_format: Optional[str]
+) -> Iterator[types.Entity]:
+    if isinstance(source, str):
+        if source_format is None:
+            source_format = _JSONL if source.endswith(".jsonl") else _DELIMITED
+        with open(source, "rb") as f:
+            yield from _read_stream(f, source_format)
+    elif isinstance(source, io.IOBase):
+        yield from _read_stream(cast(IO[bytes], source), source_format or _DELIMITED)
+    else:
+        for item in source:
+            if isinstance(item, ndb.Model):
+                yield ndb.model._entity_to_protobuf(item)
+            else:
+                yield item
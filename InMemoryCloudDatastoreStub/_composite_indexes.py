@@ -0,0 +1,276 @@
+import bisect
+import itertools
+from google.cloud.datastore_v1 import types
+from typing import Any, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+from ._indexes import (
+    _ancestor_paths,
+    _ancestor_sort_key,
+    _Desc,
+    _filter_interval,
+    _intersect_intervals,
+    _interval_bounds,
+    _is_indexable_filter,
+    _SortKey,
+    _value_sort_key,
+)
+from ._stored_object import _StoredObject
+
+_ASCENDING = types.PropertyOrder.Direction.ASCENDING
+_DESCENDING = types.PropertyOrder.Direction.DESCENDING
+
+_IndexProperty = Tuple[str, int]
+
+
+class _CompositeIndexDefinition(NamedTuple):
+    kind: str
+    ancestor: bool
+    properties: Tuple[_IndexProperty, ...]
+
+
+class _QueryShape(NamedTuple):
+    kind: str
+    ancestor: Optional[_SortKey]
+    equalities: Dict[str, types.PropertyFilter]
+    inequality: Optional[str]
+    inequalities: List[types.PropertyFilter]
+    orders: List[_IndexProperty]
+    # Filters an index can't answer, that have to be checked per entity
+    residual: List[types.PropertyFilter]
+
+
+def _parse_index_definitions(
+    definitions: Iterable[Dict[str, Any]],
+) -> List[_CompositeIndexDefinition]:
+    # Definitions have the same shape as the entries in index.yaml
+    parsed = []
+    for definition in definitions:
+        ancestor = definition.get("ancestor", False)
+        if isinstance(ancestor, str):
+            ancestor = ancestor.lower() in ("yes", "true")
+        properties = []
+        for prop in definition.get("properties", []):
+            direction = str(prop.get("direction", "asc")).lower()
+            if direction not in ("asc", "desc"):
+                raise ValueError(f"Invalid index direction {direction!r}")
+            properties.append(
+                (prop["name"], _DESCENDING if direction == "desc" else _ASCENDING)
+            )
+        parsed.append(
+            _CompositeIndexDefinition(
+                kind=definition["kind"],
+                ancestor=bool(ancestor),
+                properties=tuple(properties),
+            )
+        )
+    return parsed
+
+
+def _load_index_yaml(path: str) -> List[_CompositeIndexDefinition]:
+    try:
+        import yaml
+    except ImportError:
+        raise ImportError(
+            "Loading index.yaml requires PyYAML "
+            "(pip install InMemoryCloudDatastoreStub[yaml])"
+        )
+
+    with open(path, "r") as f:
+        index_config = yaml.safe_load(f) or {}
+    return _parse_index_definitions(index_config.get("indexes") or [])
+
+
+def _query_shape(
+    kind: str,
+    property_filters: List[types.PropertyFilter],
+    orders: Iterable[types.PropertyOrder],
+) -> _QueryShape:
+    ancestor: Optional[_SortKey] = None
+    equalities: Dict[str, types.PropertyFilter] = {}
+    inequality: Optional[str] = None
+    inequalities: List[types.PropertyFilter] = []
+    residual: List[types.PropertyFilter] = []
+
+    for prop_filter in property_filters:
+        name = prop_filter.property.name
+        if (
+            prop_filter.op == types.PropertyFilter.Operator.HAS_ANCESTOR
+            and ancestor is None
+            and prop_filter.value.WhichOneof("value_type") == "key_value"
+        ):
+            ancestor = _ancestor_sort_key(prop_filter.value.key_value)
+        elif not _is_indexable_filter(prop_filter):
+            residual.append(prop_filter)
+        elif prop_filter.op == types.PropertyFilter.Operator.EQUAL:
+            if name in equalities:
+                residual.append(prop_filter)
+            else:
+                equalities[name] = prop_filter
+        elif inequality is None or inequality == name:
+            inequality = name
+            inequalities.append(prop_filter)
+        else:
+            residual.append(prop_filter)
+
+    # Ordering on a property with an equality filter is a no-op
+    index_orders = [
+        (
+            order.property.name,
+            _DESCENDING if order.direction == _DESCENDING else _ASCENDING,
+        )
+        for order in orders
+        if order.property.name not in equalities
+    ]
+    return _QueryShape(
+        kind=kind,
+        ancestor=ancestor,
+        equalities=equalities,
+        inequality=inequality,
+        inequalities=inequalities,
+        orders=index_orders,
+        residual=residual,
+    )
+
+
+def _needs_composite_index(shape: _QueryShape) -> bool:
+    # Production serves kind, equality-only and single property queries
+    # from its built-in indexes. Everything else needs a composite index
+    if not shape.orders and shape.inequality is None:
+        return False
+    properties = set(shape.equalities) | {name for name, _ in shape.orders}
+    if shape.inequality is not None:
+        properties.add(shape.inequality)
+    return shape.ancestor is not None or len(properties) > 1
+
+
+def _recommended_index(shape: _QueryShape) -> str:
+    properties: List[_IndexProperty] = [(name, _ASCENDING) for name in shape.equalities]
+    if shape.inequality is not None and (
+        not shape.orders or shape.orders[0][0] != shape.inequality
+    ):
+        properties.append((shape.inequality, _ASCENDING))
+    properties.extend(shape.orders)
+
+    lines = [f"- kind: {shape.kind}"]
+    if shape.ancestor is not None:
+        lines.append("  ancestor: yes")
+    lines.append("  properties:")
+    for name, direction in properties:
+        lines.append(f"  - name: {name}")
+        if direction == _DESCENDING:
+            lines.append("    direction: desc")
+    return "\n".join(lines)
+
+
+class _CompositeIndex(object):
+
+    definition: _CompositeIndexDefinition
+    # Sorted ([ancestor key], *property sort keys, entity key sort key) tuples
+    _entries: List[Tuple[Any, ...]]
+
+    def __init__(self, definition: _CompositeIndexDefinition) -> None:
+        self.definition = definition
+        self._entries = []
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def build(self, items: Iterable[Tuple[_SortKey, _StoredObject]]) -> None:
+        self._entries = []
+        self.add_many(items)
+
+    def add_many(self, items: Iterable[Tuple[_SortKey, _StoredObject]]) -> None:
+        self._entries.extend(
+            entry
+            for store_key, stored in items
+            for entry in self._entity_entries(store_key, stored)
+        )
+        self._entries.sort()
+
+    def add(self, store_key: _SortKey, stored: _StoredObject) -> None:
+        for entry in self._entity_entries(store_key, stored):
+            bisect.insort(self._entries, entry)
+
+    def remove(self, store_key: _SortKey, stored: _StoredObject) -> None:
+        for entry in self._entity_entries(store_key, stored):
+            i = bisect.bisect_left(self._entries, entry)
+            if i < len(self._entries) and self._entries[i] == entry:
+                del self._entries[i]
+
+    def serves(self, shape: _QueryShape) -> bool:
+        if shape.kind != self.definition.kind:
+            return False
+        if self.definition.ancestor != (shape.ancestor is not None):
+            return False
+
+        properties = list(self.definition.properties)
+        num_equalities = len(shape.equalities)
+        if {name for name, _ in properties[:num_equalities]} != set(shape.equalities):
+            return False
+
+        suffix = properties[num_equalities:]
+        if shape.inequality is not None and not shape.orders:
+            # Unordered range queries can use the column in either direction
+            return len(suffix) == 1 and suffix[0][0] == shape.inequality
+        if shape.inequality is not None and shape.orders[0][0] != shape.inequality:
+            return False
+        return suffix == shape.orders
+
+    def keys(
+        self, shape: _QueryShape, after: Optional[Tuple[Any, ...]] = None
+    ) -> Iterator[_SortKey]:
+        # Entries are already in the query's order. Repeated properties can
+        # produce several entries per entity, only the first one is kept.
+        # Scans can start right after the ordered columns and key of a cursor
+        start, end = self._bounds(shape)
+        if after is not None:
+            start = max(
+                start, bisect.bisect_right(self._entries, self._prefix(shape) + after)
+            )
+        seen = set()
+        for i in range(start, end):
+            store_key = self._entries[i][-1]
+            if store_key not in seen:
+                seen.add(store_key)
+                yield store_key
+
+    def _prefix(self, shape: _QueryShape) -> Tuple[Any, ...]:
+        # The leading columns, which are fixed by the query
+        prefix: Tuple[Any, ...] = ()
+        if self.definition.ancestor:
+            prefix += (shape.ancestor,)
+        for name, direction in self.definition.properties[: len(shape.equalities)]:
+            sort_key = _value_sort_key(shape.equalities[name].value)
+            prefix += (_Desc(sort_key) if direction == _DESCENDING else sort_key,)
+        return prefix
+
+    def _bounds(self, shape: _QueryShape) -> Tuple[int, int]:
+        properties = self.definition.properties
+        num_equalities = len(shape.equalities)
+        prefix = self._prefix(shape)
+
+        if shape.inequality is None:
+            return _interval_bounds(self._entries, prefix, False, None, None)
+
+        lower, upper = _intersect_intervals(
+            [_filter_interval(f) for f in shape.inequalities]
+        )
+        descending = properties[num_equalities][1] == _DESCENDING
+        return _interval_bounds(self._entries, prefix, descending, lower, upper)
+
+    def _entity_entries(
+        self, store_key: _SortKey, stored: _StoredObject
+    ) -> List[Tuple[Any, ...]]:
+        # Entities missing any of the indexed properties aren't indexed.
+        # Repeated properties get an entry per combination of their values
+        columns: List[List[Any]] = []
+        if self.definition.ancestor:
+            columns.append(_ancestor_paths(stored.entity.key))
+        for name, direction in self.definition.properties:
+            sort_keys: List[Any] = stored.sort_keys(name)
+            if not sort_keys:
+                return []
+            if direction == _DESCENDING:
+                sort_keys = [_Desc(sort_key) for sort_key in sort_keys]
+            columns.append(sort_keys)
+        return [row + (store_key,) for row in itertools.product(*columns)]
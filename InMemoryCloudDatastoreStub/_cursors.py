@@ -0,0 +1,79 @@
+import grpc
+from google.cloud.datastore_v1 import types
+from google.protobuf.message import DecodeError
+from typing import Any, List, Optional, Tuple
+
+from ._indexes import _Desc, _is_indexable_value, _value_sort_key
+from ._rpc_error import _RpcError
+from ._stored_object import _StoredObject
+
+_DESCENDING = types.PropertyOrder.Direction.DESCENDING
+
+# Position of a result in a query's order: a sort key per query order,
+# then the entity's key to break ties
+_Position = Tuple[Any, ...]
+_QueryOrder = Tuple[str, int]
+
+
+def _query_orders(query: types.Query) -> List[_QueryOrder]:
+    return [(order.property.name, order.direction) for order in query.order]
+
+
+def _order_value(
+    ds_entity: types.Entity, name: str, direction: int
+) -> Optional[types.Value]:
+    # Repeated properties sort by their smallest value when ascending, and by
+    # their largest when descending. Entities without the property don't
+    # appear in queries ordered by it
+    if name not in ds_entity.properties:
+        return None
+
+    value_pb = ds_entity.properties[name]
+    if value_pb.WhichOneof("value_type") != "array_value":
+        return value_pb if _is_indexable_value(value_pb) else None
+
+    values = [v for v in value_pb.array_value.values if _is_indexable_value(v)]
+    if not values:
+        return None
+    pick = max if direction == _DESCENDING else min
+    return pick(values, key=_value_sort_key)
+
+
+def _result_position(
+    stored: _StoredObject, orders: List[_QueryOrder]
+) -> Optional[_Position]:
+    position: List[Any] = []
+    for name, direction in orders:
+        # Same choice of value for repeated properties as _order_value
+        sort_keys = stored.sort_keys(name)
+        if not sort_keys:
+            return None
+        sort_key = sort_keys[-1] if direction == _DESCENDING else sort_keys[0]
+        position.append(_Desc(sort_key) if direction == _DESCENDING else sort_key)
+    position.append(stored.key_sort_key())
+    return tuple(position)
+
+
+def _encode_cursor(ds_entity: types.Entity, orders: List[_QueryOrder]) -> bytes:
+    # A cursor is an entity holding the result's key and the values it was
+    # ordered by, which is all that's needed to recompute its position
+    cursor = types.Entity(key=ds_entity.key)
+    for name, direction in orders:
+        if name == "__key__":
+            continue
+        value_pb = _order_value(ds_entity, name, direction)
+        if value_pb is not None:
+            cursor.properties[name].CopyFrom(value_pb)
+    return cursor.SerializeToString()
+
+
+def _decode_cursor(cursor: bytes, orders: List[_QueryOrder]) -> _Position:
+    position = None
+    try:
+        cursor_entity = types.Entity.FromString(cursor)
+        position = _result_position(_StoredObject(0, cursor_entity), orders)
+    except DecodeError:
+        pass
+    if position is None:
+        raise _RpcError(grpc.StatusCode.INVALID_ARGUMENT, "Invalid query cursor.")
+    return position
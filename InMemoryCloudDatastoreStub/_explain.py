@@ -0,0 +1,186 @@
+import collections
+import threading
+from google.cloud.datastore_v1 import types
+from typing import Deque, Dict, List, NamedTuple, Optional
+
+from ._composite_indexes import _CompositeIndexDefinition
+from ._query_planner import _property_filters
+
+_DESCENDING = types.PropertyOrder.Direction.DESCENDING
+
+_OPERATOR_SYMBOLS = {
+    types.PropertyFilter.Operator.LESS_THAN: "<",
+    types.PropertyFilter.Operator.LESS_THAN_OR_EQUAL: "<=",
+    types.PropertyFilter.Operator.GREATER_THAN: ">",
+    types.PropertyFilter.Operator.GREATER_THAN_OR_EQUAL: ">=",
+    types.PropertyFilter.Operator.EQUAL: "=",
+    types.PropertyFilter.Operator.HAS_ANCESTOR: "HAS ANCESTOR",
+}
+
+# How entities are found, see LocalDatastoreStub._filtered_entities
+_COMPOSITE_INDEX = "composite_index"
+_ORDERED_INDEX = "ordered_index"
+_PROPERTY_INDEX = "property_index"
+_KEY_RANGE = "key_range"
+_RESULT_CACHE = "result_cache"
+
+# How results are put in the query's order
+_INDEX_ORDER = "index_order"
+_HEAP = "heap"
+_SORT = "sort"
+
+
+class _QueryProfile(object):
+    # Filled in while a query runs, explanations are made from it
+    __slots__ = (
+        "strategy",
+        "index",
+        "indexed_filters",
+        "scanned",
+        "matched",
+        "sort",
+        "recommended_index",
+    )
+
+    def __init__(self) -> None:
+        self.strategy = _RESULT_CACHE
+        self.index: Optional[str] = None
+        self.indexed_filters: List[types.PropertyFilter] = []
+        # Entities read from the store, and how many passed the filters
+        self.scanned = 0
+        self.matched = 0
+        self.sort = _INDEX_ORDER
+        self.recommended_index: Optional[str] = None
+
+
+class QueryExplanation(NamedTuple):
+    kind: Optional[str]
+    # The query without its values, cursors, offset and limit
+    shape: str
+    # One of composite_index, ordered_index (the index of the property the
+    # query is ordered by), property_index, key_range or result_cache
+    strategy: str
+    # Properties of the index used, if any
+    index: Optional[str]
+    indexed_filters: List[str]
+    # Filters checked against every scanned entity
+    scanned_filters: List[str]
+    entities_scanned: int
+    entities_matched: int
+    results: int
+    # index_order when results come in order, or heap or sort
+    sort: str
+    elapsed: float
+    # The composite index production would need for this query, if missing
+    recommended_index: Optional[str]
+
+
+class QueryShapeStats(NamedTuple):
+    shape: str
+    calls: int
+    entities_scanned: int
+    entities_matched: int
+    results: int
+    elapsed: float
+    max_elapsed: float
+
+
+def _describe_filter(prop_filter: types.PropertyFilter) -> str:
+    symbol = _OPERATOR_SYMBOLS.get(prop_filter.op, str(prop_filter.op))
+    return f"{prop_filter.property.name} {symbol} ?"
+
+
+def _describe_index(definition: _CompositeIndexDefinition) -> str:
+    # Like query orders: "__ancestor__, a, -b"
+    names = ["__ancestor__"] if definition.ancestor else []
+    names.extend(
+        ("-" if direction == _DESCENDING else "") + name
+        for name, direction in definition.properties
+    )
+    return ", ".join(names)
+
+
+def _describe_query(query: types.Query) -> str:
+    parts = [query.kind[0].name if query.kind else "*"]
+    filters = sorted(_describe_filter(f) for f in _property_filters(query.filter))
+    if filters:
+        parts.append("WHERE " + " AND ".join(filters))
+    if query.order:
+        parts.append(
+            "ORDER BY "
+            + ", ".join(
+                ("-" if order.direction == _DESCENDING else "") + order.property.name
+                for order in query.order
+            )
+        )
+    if query.projection:
+        parts.append("SELECT " + ", ".join(p.property.name for p in query.projection))
+    return " ".join(parts)
+
+
+def _explain(
+    query: types.Query, profile: _QueryProfile, results: int, elapsed: float
+) -> QueryExplanation:
+    return QueryExplanation(
+        kind=query.kind[0].name if query.kind else None,
+        shape=_describe_query(query),
+        strategy=profile.strategy,
+        index=profile.index,
+        indexed_filters=[_describe_filter(f) for f in profile.indexed_filters],
+        scanned_filters=[
+            _describe_filter(f)
+            for f in _property_filters(query.filter)
+            if f not in profile.indexed_filters
+        ],
+        entities_scanned=profile.scanned,
+        entities_matched=profile.matched,
+        results=results,
+        sort=profile.sort,
+        elapsed=elapsed,
+        recommended_index=profile.recommended_index,
+    )
+
+
+class _QueryExplainer(object):
+    """
+    Keeps the latest explanations, and totals per query shape
+    """
+
+    _lock: threading.Lock
+    _recent: Deque[QueryExplanation]
+    _shapes: Dict[str, QueryShapeStats]
+
+    def __init__(self, max_recent: int) -> None:
+        self._lock = threading.Lock()
+        self._recent = collections.deque(maxlen=max_recent)
+        self._shapes = {}
+
+    def record(self, explanation: QueryExplanation) -> None:
+        with self._lock:
+            self._recent.append(explanation)
+            stats = self._shapes.get(explanation.shape)
+            if stats is None:
+                stats = QueryShapeStats(explanation.shape, 0, 0, 0, 0, 0.0, 0.0)
+            self._shapes[explanation.shape] = QueryShapeStats(
+                shape=explanation.shape,
+                calls=stats.calls + 1,
+                entities_scanned=stats.entities_scanned + explanation.entities_scanned,
+                entities_matched=stats.entities_matched + explanation.entities_matched,
+                results=stats.results + explanation.results,
+                elapsed=stats.elapsed + explanation.elapsed,
+                max_elapsed=max(stats.max_elapsed, explanation.elapsed),
+            )
+
+    def recent(self) -> List[QueryExplanation]:
+        with self._lock:
+            return list(self._recent)
+
+    def most_expensive(self, n: int, by: str) -> List[QueryShapeStats]:
+        with self._lock:
+            shapes = list(self._shapes.values())
+        return sorted(shapes, key=lambda s: getattr(s, by), reverse=True)[:n]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._recent.clear()
+            self._shapes = {}
@@ -0,0 +1,135 @@
+import grpc
+import threading
+from google.cloud.datastore_v1 import types
+from typing import Dict, Iterable, List, Tuple
+
+from ._indexes import _path_sort_key, _SortKey
+from ._rpc_error import _RpcError
+
+# (project, namespace, parent path sort key, kind). Like in production, each
+# of these allocates its own IDs
+_IdGroup = Tuple[str, str, _SortKey, str]
+
+# Sequential IDs are below 2**52. Scattered IDs are above, and are the
+# reversed bits of a counter, so consecutive ones are far apart like
+# production's
+_MAX_SEQUENTIAL_BIT = 52
+_MAX_SEQUENTIAL_ID = (1 << _MAX_SEQUENTIAL_BIT) - 1
+_MAX_SCATTERED_COUNTER = (1 << (_MAX_SEQUENTIAL_BIT - 1)) - 1
+_MAX_SCATTERED_ID = _MAX_SEQUENTIAL_ID + 1 + _MAX_SCATTERED_COUNTER
+_SCATTER_SHIFT = 64 - _MAX_SEQUENTIAL_BIT + 1
+
+
+def _reverse_bits(value: int) -> int:
+    return int(f"{value:064b}"[::-1], 2)
+
+
+def _scattered_id(counter: int) -> int:
+    return _MAX_SEQUENTIAL_ID + 1 + _reverse_bits(counter << _SCATTER_SHIFT)
+
+
+def _scattered_counter(entity_id: int) -> int:
+    return _reverse_bits(entity_id - _MAX_SEQUENTIAL_ID - 1) >> _SCATTER_SHIFT
+
+
+def _id_group(key: types.Key) -> _IdGroup:
+    return (
+        key.partition_id.project_id,
+        key.partition_id.namespace_id,
+        _path_sort_key(key.path[:-1]),
+        key.path[-1].kind,
+    )
+
+
+def _store_key_id_group(store_key: _SortKey) -> _IdGroup:
+    project, namespace, path = store_key
+    return (project, namespace, path[:-1], path[-1][0])
+
+
+class _IdAllocator(object):
+    """
+    Allocates numeric IDs to incomplete keys, as a block per group of keys
+    sharing a parent and kind. Reserving an ID moves the group's counter past
+    it, so reserved IDs are never allocated without looking at the store
+    """
+
+    scattered: bool
+    _lock: threading.Lock
+    # Every group's sequential counter starts at least here
+    _floor: int
+    # Group -> next counter of each kind of IDs
+    _sequential: Dict[_IdGroup, int]
+    _scattered: Dict[_IdGroup, int]
+
+    def __init__(self, scattered: bool = False) -> None:
+        self.scattered = scattered
+        self._lock = threading.Lock()
+        self._floor = 1
+        self._sequential = {}
+        self._scattered = {}
+
+    def allocate(self, keys: Iterable[types.Key]) -> None:
+        """
+        Sets an ID on each incomplete key, in place
+        """
+        groups: Dict[_IdGroup, List[types.Key]] = {}
+        for key in keys:
+            if key.path[-1].WhichOneof("id_type") is None:
+                groups.setdefault(_id_group(key), []).append(key)
+
+        with self._lock:
+            blocks = [
+                (group_keys, self._take(group, len(group_keys)))
+                for group, group_keys in groups.items()
+            ]
+        for group_keys, first in blocks:
+            for counter, key in enumerate(group_keys, first):
+                key.path[-1].id = _scattered_id(counter) if self.scattered else counter
+
+    def reserve(self, store_keys: Iterable[_SortKey]) -> None:
+        """
+        Makes sure the numeric IDs of these keys are never allocated. Keys
+        with names, or no ID, are skipped
+        """
+        with self._lock:
+            for store_key in store_keys:
+                _, id_type, entity_id = store_key[2][-1]
+                # IDs past the scattered ones are never allocated
+                if id_type != 0 or not 0 < entity_id <= _MAX_SCATTERED_ID:
+                    continue
+                group = _store_key_id_group(store_key)
+                if entity_id > _MAX_SEQUENTIAL_ID:
+                    counters = self._scattered
+                    counter = _scattered_counter(entity_id)
+                else:
+                    counters = self._sequential
+                    counter = entity_id
+                if counter >= counters.get(group, 1):
+                    counters[group] = counter + 1
+
+    def next_sequential_id(self) -> int:
+        # No group allocates sequential IDs below this anymore
+        with self._lock:
+            return max([self._floor] + list(self._sequential.values()))
+
+    def reserve_below(self, next_id: int) -> None:
+        # Like reserving every sequential ID below next_id, in every group
+        with self._lock:
+            self._floor = max(self._floor, next_id)
+
+    def _take(self, group: _IdGroup, count: int) -> int:
+        # Returns the first counter of a block of count, called with the lock
+        if self.scattered:
+            counters = self._scattered
+            first = counters.get(group, 1)
+            limit = _MAX_SCATTERED_COUNTER
+        else:
+            counters = self._sequential
+            first = max(counters.get(group, 1), self._floor)
+            limit = _MAX_SEQUENTIAL_ID
+        if first + count - 1 > limit:
+            raise _RpcError(
+                grpc.StatusCode.RESOURCE_EXHAUSTED, "No IDs left to allocate"
+            )
+        counters[group] = first + count
+        return first
@@ -1,106 +1,655 @@
-import copy
+import bisect
+import grpc
+import heapq
+import itertools
+import threading
 import uuid
 from google.cloud.datastore_v1 import types
-from typing import Dict, Iterable, Optional, Tuple, List
-from ._stored_object import _StoredObject
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple, Type
+from ._composite_indexes import (
+    _CompositeIndex,
+    _CompositeIndexDefinition,
+    _QueryShape,
+)
+from ._id_allocator import _IdAllocator
+from ._indexes import (
+    _Bound,
+    _in_interval,
+    _key_sort_key,
+    _PropertyIndex,
+    _sorted_range,
+    _SortKey,
+)
+from ._partition import _Partition, _PartitionId
+from ._rpc_error import _RpcError
+from ._rwlock import _reads, _ReadWriteLock, _writes
+from ._snapshots import _read_snapshot, _SnapshotEntity, _write_snapshot
+from ._stored_object import _OBJECTS, _STORED_TYPES, _StoredObject
 from ._transactions import _InFlightTransaction, _TransactionType
 
+# (journal generation, position in the journal)
+_Checkpoint = Tuple[int, int]
+
 
 class _InMemoryStore(object):
+    """
+    Public methods are safe to call from several threads. Iterators over
+    entities (items, indexed_items, composite_items) have to be consumed
+    while holding `lock` for reading.
+
+    Entities are kept in a _Partition per (project, namespace), which is all
+    queries look at. Transactions, and the versions they read, are shared
+    """
 
+    lock: _ReadWriteLock
     _seqid: int
-    _next_id: int
-    _store: Dict[str, _StoredObject]
+    _scattered_ids: bool
+    # _StoredObject, or a subclass keeping entities serialized
+    _stored_type: Type[_StoredObject]
+    # Every partition's sequential IDs start at least here
+    _id_floor: int
+    _partitions: Dict[_PartitionId, _Partition]
+    _composite_definitions: List[_CompositeIndexDefinition]
+    _index_build_lock: threading.Lock
+    # Key -> (seqid of the write, version it replaced) for every write made
+    # while a transaction was open, oldest first. Transactions read "as of"
+    # their initial seqid by walking these chains instead of copying the store
+    _versions: Dict[_SortKey, List[Tuple[int, Optional[_StoredObject]]]]
     _transactions: Dict[bytes, _InFlightTransaction]
+    # Key -> version it replaced for every write since the first checkpoint,
+    # oldest first. Restoring a checkpoint undoes the writes made after it
+    _journal: Optional[List[Tuple[_SortKey, Optional[_StoredObject]]]]
+    # Bumped when the journal can no longer be undone, which invalidates
+    # every checkpoint taken before
+    _journal_generation: int
 
-    def __init__(self) -> None:
+    def __init__(
+        self, scattered_ids: bool = False, entity_storage: str = _OBJECTS
+    ) -> None:
+        if entity_storage not in _STORED_TYPES:
+            raise ValueError(f"Unknown entity storage {entity_storage!r}")
+        self.lock = _ReadWriteLock()
+        # Building indexes on first use happens while only reading
+        self._index_build_lock = threading.Lock()
         self._seqid = 0
-        self._next_id = 1
-        self._store = {}
+        self._scattered_ids = scattered_ids
+        self._stored_type = _STORED_TYPES[entity_storage]
+        self._id_floor = 1
+        self._partitions = {}
+        self._composite_definitions = []
+        self._versions = {}
         self._transactions = {}
+        self._journal = None
+        self._journal_generation = 0
 
+    @_reads
     def seqid(self, transaction_id: Optional[bytes]) -> int:
         if transaction_id and transaction_id in self._transactions:
             return self._transactions[transaction_id].initial_seqid
         return self._seqid
 
+    @_reads
+    def kind_seqid(self, partition_id: _PartitionId, kind: Optional[str]) -> int:
+        # Changes whenever the results of a (non transactional) query over
+        # kind could change. Kindless queries depend on every write to the
+        # partition
+        partition = self._partitions.get(partition_id)
+        if partition is None:
+            return 0
+        if kind is None:
+            return partition.seqid
+        return partition.kind_seqids.get(kind, 0)
+
+    def in_transaction(self, transaction_id: Optional[bytes]) -> bool:
+        return bool(transaction_id) and transaction_id in self._transactions
+
+    @_reads
+    def reads_latest(self, transaction_id: Optional[bytes]) -> bool:
+        # Whether reads see the latest data (so they can be served by indexes)
+        return self.seqid(transaction_id) == self._seqid
+
+    @_writes
     def put(
         self,
         ds_entity: types.Entity,
         entity_version: int,
         transaction_id: Optional[bytes],
     ) -> None:
-        key_str = ds_entity.key.SerializeToString()
         if transaction_id and transaction_id in self._transactions:
             mutation = types.Mutation(
                 upsert=ds_entity,
             )
             self._transactions[transaction_id].mutations.append(mutation)
         else:
-            self._seqid += 1
-            self._store[key_str] = _StoredObject(
-                entity=ds_entity, version=entity_version
+            store_key = _key_sort_key(ds_entity.key)
+            self._write(
+                store_key,
+                self._stored_type(entity_version, ds_entity, store_key),
             )
 
+    @_reads
     def get(
         self, key: types.Key, transaction_id: Optional[bytes]
     ) -> Optional[_StoredObject]:
-        key_str = key.SerializeToString()
+        store_key = _key_sort_key(key)
         if transaction_id and transaction_id in self._transactions:
-            return self._transactions[transaction_id].snapshot.get(key_str)
+            transaction = self._transactions[transaction_id]
+            transaction.read_set.add(store_key)
+            return self._read_as_of(store_key, transaction.initial_seqid)
         else:
-            return self._store.get(key_str)
+            return self._committed(store_key)
 
+    @_writes
     def delete(self, key: types.Key, transaction_id: Optional[bytes]) -> None:
-        key_str = key.SerializeToString()
         if transaction_id and transaction_id in self._transactions:
             mutation = types.Mutation(
                 delete=key,
             )
             self._transactions[transaction_id].mutations.append(mutation)
         else:
-            if key_str in self._store:
-                del self._store[key_str]
+            store_key = _key_sort_key(key)
+            if self._committed(store_key) is not None:
+                self._write(store_key, None)
 
-    def items(self, transaction_id: bytes) -> Iterable[Tuple[str, _StoredObject]]:
-        if transaction_id in self._transactions:
-            return self._transactions[transaction_id].snapshot.items()
-        else:
-            return self._store.items()
+    def items(
+        self,
+        partition_id: _PartitionId,
+        transaction_id: bytes,
+        kind: Optional[str] = None,
+        lower: _Bound = None,
+        upper: _Bound = None,
+    ) -> Iterable[Tuple[_SortKey, _StoredObject]]:
+        # Entities of the partition whose keys are in the interval, in key
+        # order. Descendants of a key make up a single interval, so ancestor
+        # queries only touch the entity group they're for
+        partition = self._partitions.get(partition_id) or self._empty_partition()
+        sorted_keys = partition.sorted_keys(kind)
+        store_keys = (sorted_keys[i] for i in _sorted_range(sorted_keys, lower, upper))
+        if not self.in_transaction(transaction_id):
+            return ((store_key, partition.store[store_key]) for store_key in store_keys)
+
+        as_of = self._transactions[transaction_id].initial_seqid
+        return self._items_as_of(partition_id, store_keys, kind, as_of, lower, upper)
+
+    @_reads
+    def key_range_size(
+        self,
+        partition_id: _PartitionId,
+        kind: Optional[str],
+        lower: _Bound,
+        upper: _Bound,
+    ) -> int:
+        partition = self._partitions.get(partition_id)
+        if partition is None:
+            return 0
+        return len(_sorted_range(partition.sorted_keys(kind), lower, upper))
+
+    @_reads
+    def record_reads(
+        self, transaction_id: bytes, store_keys: Iterable[_SortKey]
+    ) -> None:
+        # Entities returned by a transactional query are part of its read set
+        if self.in_transaction(transaction_id):
+            self._transactions[transaction_id].read_set.update(store_keys)
+
+    @_reads
+    def index_size(
+        self, partition_id: _PartitionId, kind: str, prop_filter: types.PropertyFilter
+    ) -> int:
+        index = self._property_index(partition_id, kind, prop_filter.property.name)
+        return index.count(prop_filter) if index else 0
+
+    def indexed_items(
+        self, partition_id: _PartitionId, kind: str, prop_filter: types.PropertyFilter
+    ) -> Iterable[Tuple[_SortKey, _StoredObject]]:
+        # Index scans only see committed data, not transaction snapshots
+        index = self._property_index(partition_id, kind, prop_filter.property.name)
+        if index is None:
+            return []
+        # Repeated properties can have several matching entries per entity
+        store = self._partitions[partition_id].store
+        store_keys = dict.fromkeys(index.keys(prop_filter))
+        return ((store_key, store[store_key]) for store_key in store_keys)
+
+    @_reads
+    def ordered_index_size(
+        self,
+        partition_id: _PartitionId,
+        kind: str,
+        name: str,
+        lower: _Bound,
+        upper: _Bound,
+    ) -> int:
+        index = self._property_index(partition_id, kind, name)
+        return index.interval_count(lower, upper) if index else 0
+
+    def ordered_items(
+        self,
+        partition_id: _PartitionId,
+        kind: str,
+        name: str,
+        descending: bool,
+        after: Optional[Tuple[_SortKey, _SortKey]],
+        bound: _Bound,
+    ) -> Iterable[Tuple[_SortKey, _StoredObject]]:
+        # Entities in the order of queries sorted by the property, see
+        # _PropertyIndex.ordered_entries. Repeated properties are only
+        # returned at the value they are ordered by
+        index = self._property_index(partition_id, kind, name)
+        if index is None:
+            return []
+        store = self._partitions[partition_id].store
+        return (
+            (store_key, stored)
+            for sort_key, store_key in index.ordered_entries(descending, after, bound)
+            for stored in (store[store_key],)
+            if stored.sort_keys(name)[-1 if descending else 0] == sort_key
+        )
+
+    @_writes
+    def add_composite_index(self, definition: _CompositeIndexDefinition) -> None:
+        self._composite_definitions.append(definition)
+        for partition_id, partition in self._partitions.items():
+            index = _CompositeIndex(definition)
+            index.build(self.items(partition_id, b"", definition.kind))
+            partition.composite_indexes.setdefault(definition.kind, []).append(index)
+
+    @_reads
+    def composite_index(
+        self, partition_id: _PartitionId, shape: _QueryShape
+    ) -> Optional[_CompositeIndex]:
+        # Every partition has the same composite indexes
+        partition = self._partitions.get(partition_id) or self._empty_partition()
+        for index in partition.composite_indexes.get(shape.kind, []):
+            if index.serves(shape):
+                return index
+        return None
+
+    def composite_items(
+        self,
+        partition_id: _PartitionId,
+        index: _CompositeIndex,
+        shape: _QueryShape,
+        after: Optional[Tuple[Any, ...]] = None,
+    ) -> Iterable[Tuple[_SortKey, _StoredObject]]:
+        # Like indexed_items, this only sees committed data
+        partition = self._partitions.get(partition_id) or self._empty_partition()
+        return (
+            (store_key, partition.store[store_key])
+            for store_key in index.keys(shape, after)
+        )
+
+    @_reads
+    def save_snapshot(self, path: str) -> None:
+        """
+        Writes the committed entities to a snapshot file at path
+        """
+        _write_snapshot(
+            path,
+            max(
+                [self._id_floor]
+                + [p.ids.next_sequential_id() for p in self._partitions.values()]
+            ),
+            (
+                _SnapshotEntity(store_key, stored.version, stored.serialized())
+                for partition_id in sorted(self._partitions)
+                for store_key, stored in self.items(partition_id, b"")
+            ),
+        )
+
+    @_writes
+    def load_snapshot(self, path: str) -> None:
+        """
+        Replaces the store's entities with the ones saved in a snapshot file.
+        Entities are only parsed when first read, and property indexes are
+        built the first time a query uses them
+        """
+        if self._transactions:
+            raise ValueError("Can't load a snapshot while transactions are open")
+
+        next_id, entities = _read_snapshot(path)
+        # Partitions keep their IDs, and their kinds, which all changed
+        previous = self._partitions
+        self._id_floor = max(self._id_floor, next_id)
+        self._partitions = {}
+        for partition_id, partition in previous.items():
+            self._partitions[partition_id] = _Partition(
+                partition.ids, self._composite_definitions
+            )
+            partition.ids.reserve_below(self._id_floor)
+        for store_key, version, serialized in entities:
+            partition = self._partition(store_key[:2])
+            partition.store[store_key] = self._stored_type.from_serialized(
+                version, serialized, store_key
+            )
+            partition.keys.append(store_key)
+            # Entities are in key order, so the kind lists stay sorted
+            partition.kind_index.setdefault(self._store_key_kind(store_key), []).append(
+                store_key
+            )
+
+        self._journal = None
+        self._journal_generation += 1
+        self._seqid += 1
+        for partition_id, partition in self._partitions.items():
+            partition.ids.reserve(partition.keys)
+            partition.unindexed_kinds = set(partition.kind_index)
+            for kind, composite_indexes in partition.composite_indexes.items():
+                for composite_index in composite_indexes:
+                    composite_index.build(self.items(partition_id, b"", kind))
+            previous_kinds = (
+                previous[partition_id].kind_index if partition_id in previous else {}
+            )
+            partition.seqid = self._seqid
+            for kind in itertools.chain(previous_kinds, partition.kind_index):
+                partition.kind_seqids[kind] = self._seqid
+
+    @_writes
+    def drop_namespace(self, project_id: str, namespace_id: str = "") -> None:
+        """
+        Deletes every entity of a namespace at once, and resets its IDs.
+        Checkpoints taken before can't be restored anymore
+        """
+        if self._transactions:
+            raise ValueError("Can't drop a namespace while transactions are open")
+        if self._partitions.pop((project_id, namespace_id), None) is None:
+            return
+        self._seqid += 1
+        if self._journal is not None:
+            self._journal = None
+            self._journal_generation += 1
+
+    @_writes
+    def put_multi(self, ds_entities: Iterable[types.Entity]) -> int:
+        """
+        Upserts committed entities in bulk, as a single write. Incomplete
+        keys are assigned IDs. Returns the number of entities written
+        """
+        # The source is read, and the keys completed, before anything is
+        # written, so a failing source leaves the store as it was. Loaded
+        # IDs are reserved, so they're never allocated
+        ds_entities = list(ds_entities)
+        self._reserve(_key_sort_key(ds_entity.key) for ds_entity in ds_entities)
+        self._allocate(ds_entity.key for ds_entity in ds_entities)
+        store_keys = [_key_sort_key(ds_entity.key) for ds_entity in ds_entities]
+
+        self._seqid += 1
+        written: Dict[_PartitionId, Dict[_SortKey, _StoredObject]] = {}
+        new_keys: Dict[_PartitionId, List[_SortKey]] = {}
+        for ds_entity, store_key in zip(ds_entities, store_keys):
+            partition_id = store_key[:2]
+            partition = self._partition(partition_id)
+            partition_written = written.setdefault(partition_id, {})
+            existing = partition.store.get(store_key)
+            if existing is None:
+                new_keys.setdefault(partition_id, []).append(store_key)
+            elif store_key not in partition_written:
+                # Entities written earlier in the batch aren't indexed yet
+                self._save_version(store_key, existing)
+                if self._journal is not None:
+                    self._journal.append((store_key, existing))
+                self._unindex_entity(partition, store_key, existing)
+            version = existing.version + 1 if existing else 0
+            stored = self._stored_type(version, ds_entity, store_key)
+            partition.store[store_key] = stored
+            partition_written[store_key] = stored
+
+        for partition_id, partition_keys in new_keys.items():
+            partition = self._partitions[partition_id]
+            for store_key in partition_keys:
+                self._save_version(store_key, None)
+                if self._journal is not None:
+                    self._journal.append((store_key, None))
+            # Sorting once merges the new keys in, instead of an insort each
+            partition.keys.extend(partition_keys)
+            partition.keys.sort()
+            new_keys_by_kind: Dict[str, List[_SortKey]] = {}
+            for store_key in partition_keys:
+                kind = self._store_key_kind(store_key)
+                new_keys_by_kind.setdefault(kind, []).append(store_key)
+            for kind, kind_keys in new_keys_by_kind.items():
+                sorted_keys = partition.kind_index.setdefault(kind, [])
+                sorted_keys.extend(kind_keys)
+                sorted_keys.sort()
+
+        for partition_id, partition_written in written.items():
+            partition = self._partitions[partition_id]
+            self._index_entities(partition, list(partition_written.items()))
+            for store_key in partition_written:
+                self._touch(partition, store_key)
+        return sum(len(partition_written) for partition_written in written.values())
+
+    @_writes
+    def checkpoint(self) -> _Checkpoint:
+        """
+        Returns a token that restore() can bring the committed data back to
+        """
+        if self._journal is None:
+            self._journal = []
+        return (self._journal_generation, len(self._journal))
+
+    @_writes
+    def restore(self, checkpoint: _Checkpoint) -> None:
+        """
+        Undoes the writes made since the checkpoint was taken, which costs
+        as much as those writes did. Checkpoints taken after this one can't
+        be restored anymore, earlier ones still can
+        """
+        generation, position = checkpoint
+        if (
+            self._journal is None
+            or generation != self._journal_generation
+            or position > len(self._journal)
+        ):
+            raise ValueError("The checkpoint can no longer be restored")
+        if self._transactions:
+            raise ValueError("Can't restore a checkpoint while transactions are open")
+
+        self._seqid += 1
+        undone = self._journal[position:]
+        del self._journal[position:]
+        for store_key, replaced in reversed(undone):
+            self._replace(store_key, replaced)
+            self._touch(self._partition(store_key[:2]), store_key)
 
+    @_writes
     def beginTransaction(self, mode: _TransactionType) -> bytes:
         transaction_id = uuid.uuid1().bytes
         self._transactions[transaction_id] = _InFlightTransaction(
             mode=mode,
             initial_seqid=self._seqid,
-            snapshot=copy.deepcopy(self._store),
             mutations=[],
+            read_set=set(),
         )
         return transaction_id
 
+    @_writes
     def commitTransaction(
         self, transaction_id: bytes, final_mutations: List[types.Mutation]
     ) -> List[types.MutationResult]:
-        if transaction_id != b"" and transaction_id in self._transactions:
-            transaction = self._transactions[transaction_id]
+        if transaction_id != b"":
+            if transaction_id not in self._transactions:
+                raise _RpcError(
+                    grpc.StatusCode.INVALID_ARGUMENT,
+                    "The referenced transaction has expired or is no longer valid.",
+                )
+            transaction = self._transactions.pop(transaction_id)
 
-            # Apply OCC (make sure no entities touched in the transaction have been modified since it began)
-            # For now, just assume that no writes at all are allowed
-            assert self._seqid == transaction.initial_seqid
+            # Apply OCC: abort if anything the transaction read or is about to
+            # write was modified since it began
+            if transaction.mode == _TransactionType.READ_WRITE and self._has_conflict(
+                transaction, itertools.chain(transaction.mutations, final_mutations)
+            ):
+                self._collect_versions()
+                raise _RpcError(
+                    grpc.StatusCode.ABORTED,
+                    "too much contention on these datastore entities. "
+                    "please try again.",
+                )
 
+            self._allocate_mutation_ids(transaction.mutations)
             for mutation in transaction.mutations:
                 self._applyMutation(mutation)
 
-            del self._transactions[transaction_id]
+        self._allocate_mutation_ids(final_mutations)
+        results = [self._applyMutation(m) for m in final_mutations]
+        self._collect_versions()
+        return results
+
+    @_writes
+    def allocate_ids(self, keys: Iterable[types.Key]) -> None:
+        """
+        Completes incomplete keys in place, with IDs that are never
+        allocated again
+        """
+        self._allocate(keys)
 
-        return [self._applyMutation(m) for m in final_mutations]
+    @_writes
+    def reserve_ids(self, keys: Iterable[types.Key]) -> None:
+        """
+        Makes sure the IDs of complete keys are never allocated
+        """
+        self._reserve(_key_sort_key(key) for key in keys)
 
+    @_writes
     def rollbackTransaction(self, transaction_id: bytes) -> None:
-        assert transaction_id in self._transactions
-        del self._transactions[transaction_id]
+        # Transactions that failed to commit are already gone
+        self._transactions.pop(transaction_id, None)
+        self._collect_versions()
+
+    def _has_conflict(
+        self, transaction: _InFlightTransaction, mutations: Iterable[types.Mutation]
+    ) -> bool:
+        write_set = {
+            _key_sort_key(key)
+            for key in map(self._mutation_key_if_complete, mutations)
+            if key is not None
+        }
+        for store_key in transaction.read_set | write_set:
+            chain = self._versions.get(store_key)
+            if chain and chain[-1][0] > transaction.initial_seqid:
+                return True
+        return False
+
+    def _partition(self, partition_id: _PartitionId) -> _Partition:
+        # Partitions are made on their first write
+        partition = self._partitions.get(partition_id)
+        if partition is None:
+            ids = _IdAllocator(self._scattered_ids)
+            ids.reserve_below(self._id_floor)
+            partition = _Partition(ids, self._composite_definitions)
+            self._partitions[partition_id] = partition
+        return partition
+
+    def _empty_partition(self) -> _Partition:
+        # Stands in for partitions nothing was written to yet
+        return _Partition(_IdAllocator(), self._composite_definitions)
+
+    def _committed(self, store_key: _SortKey) -> Optional[_StoredObject]:
+        partition = self._partitions.get(store_key[:2])
+        return partition.store.get(store_key) if partition else None
+
+    def _touch(self, partition: _Partition, store_key: _SortKey) -> None:
+        # Called after a write, for query caches
+        partition.seqid = self._seqid
+        partition.kind_seqids[self._store_key_kind(store_key)] = self._seqid
+
+    def _allocate(self, keys: Iterable[types.Key]) -> None:
+        keys_by_partition: Dict[_PartitionId, List[types.Key]] = {}
+        for key in keys:
+            partition_id = (key.partition_id.project_id, key.partition_id.namespace_id)
+            keys_by_partition.setdefault(partition_id, []).append(key)
+        for partition_id, partition_keys in keys_by_partition.items():
+            self._partition(partition_id).ids.allocate(partition_keys)
+
+    def _reserve(self, store_keys: Iterable[_SortKey]) -> None:
+        keys_by_partition: Dict[_PartitionId, List[_SortKey]] = {}
+        for store_key in store_keys:
+            keys_by_partition.setdefault(store_key[:2], []).append(store_key)
+        for partition_id, partition_keys in keys_by_partition.items():
+            self._partition(partition_id).ids.reserve(partition_keys)
+
+    def _write(self, store_key: _SortKey, stored: Optional[_StoredObject]) -> None:
+        # Makes stored the latest version of the entity, or deletes it
+        self._seqid += 1
+        existing = self._committed(store_key)
+        self._save_version(store_key, existing)
+        if self._journal is not None:
+            self._journal.append((store_key, existing))
+        self._replace(store_key, stored)
+        self._touch(self._partition(store_key[:2]), store_key)
+
+    def _replace(self, store_key: _SortKey, stored: Optional[_StoredObject]) -> None:
+        kind = self._store_key_kind(store_key)
+        partition = self._partition(store_key[:2])
+        existing = partition.store.pop(store_key, None)
+        if existing:
+            self._unindex_entity(partition, store_key, existing)
+        if stored is None:
+            if existing:
+                self._remove_sorted(partition.keys, store_key)
+                self._remove_sorted(partition.kind_index[kind], store_key)
+            return
+
+        if not existing:
+            bisect.insort(partition.keys, store_key)
+            bisect.insort(partition.kind_index.setdefault(kind, []), store_key)
+        partition.store[store_key] = stored
+        self._index_entity(partition, store_key, stored)
+
+    def _save_version(
+        self, store_key: _SortKey, replaced: Optional[_StoredObject]
+    ) -> None:
+        # Called after bumping the seqid for a write. Nothing needs the old
+        # version unless a transaction is open
+        if self._transactions:
+            self._versions.setdefault(store_key, []).append((self._seqid, replaced))
+
+    def _read_as_of(self, store_key: _SortKey, seqid: int) -> Optional[_StoredObject]:
+        # The first write after seqid replaced the version that was visible then
+        for written_at, replaced in self._versions.get(store_key, ()):
+            if written_at > seqid:
+                return replaced
+        return self._committed(store_key)
+
+    def _items_as_of(
+        self,
+        partition_id: _PartitionId,
+        store_keys: Iterable[_SortKey],
+        kind: Optional[str],
+        seqid: int,
+        lower: _Bound,
+        upper: _Bound,
+    ) -> Iterator[Tuple[_SortKey, _StoredObject]]:
+        # Keys deleted since seqid are only left in _versions
+        deleted_keys = sorted(
+            k
+            for k in self._versions
+            if k[:2] == partition_id
+            and self._committed(k) is None
+            and _in_interval(k, lower, upper)
+        )
+        for store_key in heapq.merge(store_keys, deleted_keys):
+            stored = self._read_as_of(store_key, seqid)
+            if stored and (kind is None or self._store_key_kind(store_key) == kind):
+                yield store_key, stored
+
+    def _collect_versions(self) -> None:
+        # Drop versions that were replaced before every open transaction began
+        if not self._transactions:
+            self._versions.clear()
+            return
+
+        oldest_seqid = min(t.initial_seqid for t in self._transactions.values())
+        for store_key in list(self._versions):
+            chain = [v for v in self._versions[store_key] if v[0] > oldest_seqid]
+            if chain:
+                self._versions[store_key] = chain
+            else:
+                del self._versions[store_key]
 
     def _applyMutation(self, mutation: types.Mutation) -> types.MutationResult:
-        # TODO will need to potentially do key assignment for insert/upsert
+        # Keys are complete, see _allocate_mutation_ids
         mutation_key = self._mutation_key(mutation)
         existing_data = self.get(mutation_key, None)
         operation = mutation.WhichOneof("operation")
@@ -135,28 +684,127 @@ class _InMemoryStore(object):
             self.delete(mutation_key, None)
             return types.MutationResult(key=mutation_key, version=new_version)
 
+    def _mutation_key_if_complete(
+        self, mutation: types.Mutation
+    ) -> Optional[types.Key]:
+        # Keys of inserts are incomplete until their IDs are allocated
+        key = self._mutation_key(mutation)
+        if key.path[-1].WhichOneof("id_type") is None:
+            return None
+        return key
+
     def _mutation_key(self, mutation: types.Mutation) -> types.Key:
         operation = mutation.WhichOneof("operation")
-        if operation == "insert":
-            op = mutation.insert
-        elif operation == "update":
-            op = mutation.update
-        elif operation == "upsert":
-            op = mutation.upsert
-        elif operation == "delete":
-            key = mutation.delete
-            return key
+        if operation == "delete":
+            return mutation.delete
+        return getattr(mutation, operation).key
 
-        key = self._maybe_assign_key(op.key)
-        op.key.CopyFrom(key)
-        return key
+    def _allocate_mutation_ids(self, mutations: List[types.Mutation]) -> None:
+        # Incomplete keys get their IDs as a block per kind, before the
+        # mutations are applied
+        self._allocate(
+            self._mutation_key(mutation)
+            for mutation in mutations
+            if mutation.WhichOneof("operation") in ("insert", "upsert")
+        )
 
-    def _maybe_assign_key(self, key: types.Key) -> types.Key:
-        id_type = key.path[-1].WhichOneof("id_type")
-        if id_type is None:
-            key.path[-1].id = self._next_id
-            self._next_id += 1
-        return key
+    def _index_entity(
+        self, partition: _Partition, store_key: _SortKey, stored: _StoredObject
+    ) -> None:
+        kind = self._store_key_kind(store_key)
+        for composite_index in partition.composite_indexes.get(kind, []):
+            composite_index.add(store_key, stored)
+        if kind in partition.unindexed_kinds:
+            return
+        for name in stored.entity.properties:
+            sort_keys = stored.sort_keys(name)
+            if not sort_keys:
+                continue
+            index = partition.property_indexes.setdefault(
+                (kind, name), _PropertyIndex()
+            )
+            for sort_key in sort_keys:
+                index.add(sort_key, store_key)
+
+    def _unindex_entity(
+        self, partition: _Partition, store_key: _SortKey, stored: _StoredObject
+    ) -> None:
+        kind = self._store_key_kind(store_key)
+        for composite_index in partition.composite_indexes.get(kind, []):
+            composite_index.remove(store_key, stored)
+        if kind in partition.unindexed_kinds:
+            return
+        for name in stored.entity.properties:
+            index = partition.property_indexes.get((kind, name))
+            if index is None:
+                continue
+            for sort_key in stored.sort_keys(name):
+                index.remove(sort_key, store_key)
+
+    def _index_entities(
+        self, partition: _Partition, items: List[Tuple[_SortKey, _StoredObject]]
+    ) -> None:
+        # Like _index_entity for many entities, extending and sorting each
+        # index once instead of inserting every entry
+        items_by_kind: Dict[str, List[Tuple[_SortKey, _StoredObject]]] = {}
+        for store_key, stored in items:
+            items_by_kind.setdefault(self._store_key_kind(store_key), []).append(
+                (store_key, stored)
+            )
+        for kind, kind_items in items_by_kind.items():
+            for composite_index in partition.composite_indexes.get(kind, []):
+                composite_index.add_many(kind_items)
+            if kind not in partition.unindexed_kinds:
+                self._add_to_property_indexes(partition, kind, kind_items)
+
+    @staticmethod
+    def _add_to_property_indexes(
+        partition: _Partition,
+        kind: str,
+        items: Iterable[Tuple[_SortKey, _StoredObject]],
+    ) -> None:
+        entries: Dict[str, List[Tuple[_SortKey, _SortKey]]] = {}
+        for store_key, stored in items:
+            for name in stored.entity.properties:
+                for sort_key in stored.sort_keys(name):
+                    entries.setdefault(name, []).append((sort_key, store_key))
+        for name, index_entries in entries.items():
+            index = partition.property_indexes.setdefault(
+                (kind, name), _PropertyIndex()
+            )
+            index.add_many(index_entries)
+
+    def _property_index(
+        self, partition_id: _PartitionId, kind: str, name: str
+    ) -> Optional[_PropertyIndex]:
+        # Indexes of kinds loaded from a snapshot are built on first use
+        partition = self._partitions.get(partition_id)
+        if partition is None:
+            return None
+        if kind in partition.unindexed_kinds:
+            with self._index_build_lock:
+                if kind in partition.unindexed_kinds:
+                    self._add_to_property_indexes(
+                        partition,
+                        kind,
+                        (
+                            (store_key, partition.store[store_key])
+                            for store_key in partition.sorted_keys(kind)
+                        ),
+                    )
+                    partition.unindexed_kinds.discard(kind)
+        return partition.property_indexes.get((kind, name))
+
+    @staticmethod
+    def _remove_sorted(store_keys: List[_SortKey], store_key: _SortKey) -> None:
+        i = bisect.bisect_left(store_keys, store_key)
+        if i < len(store_keys) and store_keys[i] == store_key:
+            del store_keys[i]
+
+    @staticmethod
+    def _store_key_kind(store_key: _SortKey) -> str:
+        # The kind of the last element of the key's path
+        return store_key[2][-1][0]
 
     def _mutation_conflict(
         self, key: types.Key, old_version: int
@@ -0,0 +1,374 @@
+import bisect
+from google.cloud.datastore_v1 import types
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+)
+
+# Datastore orders values of different types by type first, see
+# https://cloud.google.com/datastore/docs/concepts/entities#value_type_ordering
+# Integers and timestamps share a rank, timestamps sort as integer
+# microseconds. Entity values and arrays are never compared as a whole, so
+# they have no rank
+_VALUE_TYPE_RANK: Dict[str, int] = {
+    "null_value": 0,
+    "integer_value": 1,
+    "timestamp_value": 1,
+    "boolean_value": 2,
+    "blob_value": 3,
+    "string_value": 4,
+    "double_value": 5,
+    "geo_point_value": 6,
+    "key_value": 7,
+}
+_NULL_RANK = 0
+_KEY_RANK = _VALUE_TYPE_RANK["key_value"]
+
+_INDEXABLE_OPERATORS = {
+    types.PropertyFilter.Operator.LESS_THAN,
+    types.PropertyFilter.Operator.LESS_THAN_OR_EQUAL,
+    types.PropertyFilter.Operator.GREATER_THAN,
+    types.PropertyFilter.Operator.GREATER_THAN_OR_EQUAL,
+    types.PropertyFilter.Operator.EQUAL,
+}
+
+_SortKey = Tuple[Any, ...]
+# (sort key, inclusive), or None when a range is unbounded on that side
+_Bound = Optional[Tuple[_SortKey, bool]]
+_Interval = Tuple[_Bound, _Bound]
+
+
+class _Max(object):
+    # Compares greater than anything else, so (sort_key, _MAX) sits right
+    # after every index entry for sort_key
+    def __lt__(self, other: Any) -> bool:
+        return False
+
+    def __gt__(self, other: Any) -> bool:
+        return True
+
+
+_MAX = _Max()
+
+
+class _Desc(object):
+    # Wraps a sort key to invert its order, for descending index columns
+    __slots__ = ("sort_key",)
+
+    def __init__(self, sort_key: _SortKey) -> None:
+        self.sort_key = sort_key
+
+    def __eq__(self, other: Any) -> bool:
+        return isinstance(other, _Desc) and self.sort_key == other.sort_key
+
+    def __hash__(self) -> int:
+        return hash(self.sort_key)
+
+    def __lt__(self, other: Any) -> bool:
+        if not isinstance(other, _Desc):
+            return NotImplemented
+        return other.sort_key < self.sort_key
+
+    def __gt__(self, other: Any) -> bool:
+        if not isinstance(other, _Desc):
+            return NotImplemented
+        return self.sort_key < other.sort_key
+
+    def __le__(self, other: Any) -> bool:
+        if not isinstance(other, _Desc):
+            return NotImplemented
+        return other.sort_key <= self.sort_key
+
+    def __ge__(self, other: Any) -> bool:
+        if not isinstance(other, _Desc):
+            return NotImplemented
+        return self.sort_key <= other.sort_key
+
+
+def _path_sort_key(path: Sequence[types.Key.PathElement]) -> _SortKey:
+    # Numeric IDs sort before names, and ancestors before their descendants
+    return tuple(
+        (
+            (element.kind, 1, element.name)
+            if element.WhichOneof("id_type") == "name"
+            else (element.kind, 0, element.id)
+        )
+        for element in path
+    )
+
+
+def _key_sort_key(key: types.Key) -> _SortKey:
+    # Entities are stored by this, so it doubles as the canonical form of keys
+    return (
+        key.partition_id.project_id,
+        key.partition_id.namespace_id,
+        _path_sort_key(key.path),
+    )
+
+
+def _ancestor_sort_key(ancestor: types.Key) -> _SortKey:
+    # Ancestors are only shared within a partition
+    return _key_sort_key(ancestor)
+
+
+def _ancestor_paths(key: types.Key) -> List[_SortKey]:
+    # Like in production, an entity is part of its own ancestor queries
+    project, namespace, path = _key_sort_key(key)
+    return [(project, namespace, path[:i]) for i in range(1, len(path) + 1)]
+
+
+def _value_type(value_pb: types.Value) -> str:
+    return value_pb.WhichOneof("value_type") or "null_value"
+
+
+def _is_indexable_value(value_pb: types.Value) -> bool:
+    return _value_type(value_pb) in _VALUE_TYPE_RANK
+
+
+def _value_sort_key(value_pb: types.Value) -> _SortKey:
+    value_type = _value_type(value_pb)
+    rank = _VALUE_TYPE_RANK[value_type]
+    if value_type == "null_value":
+        return (rank,)
+    elif value_type == "timestamp_value":
+        timestamp = value_pb.timestamp_value
+        return (rank, timestamp.seconds * 1000000 + timestamp.nanos // 1000)
+    elif value_type == "double_value":
+        # NaN sorts before all other doubles
+        value = value_pb.double_value
+        return (rank, 0) if value != value else (rank, 1, value)
+    elif value_type == "geo_point_value":
+        return (
+            rank,
+            value_pb.geo_point_value.latitude,
+            value_pb.geo_point_value.longitude,
+        )
+    elif value_type == "key_value":
+        return (rank, _key_sort_key(value_pb.key_value))
+    return (rank, getattr(value_pb, value_type))
+
+
+def _index_sort_keys(value_pb: types.Value) -> List[_SortKey]:
+    # Repeated properties get one index entry per distinct element
+    if value_pb.WhichOneof("value_type") == "array_value":
+        sort_keys = {
+            _value_sort_key(v)
+            for v in value_pb.array_value.values
+            if _is_indexable_value(v)
+        }
+        return list(sort_keys)
+    elif _is_indexable_value(value_pb):
+        return [_value_sort_key(value_pb)]
+    return []
+
+
+def _filter_interval(prop_filter: types.PropertyFilter) -> _Interval:
+    op = prop_filter.op
+    sort_key = _value_sort_key(prop_filter.value)
+    rank = sort_key[0]
+
+    # Inequalities only match values of the same type, except for null
+    # which (like in python2) is smaller than anything else
+    rank_start: _Bound = ((rank,), True)
+    rank_end: _Bound = None if rank == _NULL_RANK else ((rank + 1,), False)
+
+    if op == types.PropertyFilter.Operator.EQUAL:
+        return (sort_key, True), (sort_key, True)
+    elif op == types.PropertyFilter.Operator.LESS_THAN:
+        return rank_start, (sort_key, False)
+    elif op == types.PropertyFilter.Operator.LESS_THAN_OR_EQUAL:
+        return rank_start, (sort_key, True)
+    elif op == types.PropertyFilter.Operator.GREATER_THAN:
+        return (sort_key, False), rank_end
+    elif op == types.PropertyFilter.Operator.GREATER_THAN_OR_EQUAL:
+        return (sort_key, True), rank_end
+    raise ValueError(f"Operator {op} can not be served from an index")
+
+
+def _intersect_intervals(intervals: List[_Interval]) -> _Interval:
+    lower: _Bound = None
+    upper: _Bound = None
+    for new_lower, new_upper in intervals:
+        if lower is None or (
+            new_lower is not None
+            and (new_lower[0], not new_lower[1]) > (lower[0], not lower[1])
+        ):
+            lower = new_lower
+        if upper is None or (new_upper is not None and new_upper < upper):
+            upper = new_upper
+    return lower, upper
+
+
+def _interval_bounds(
+    entries: Sequence[Tuple[Any, ...]],
+    prefix: Tuple[Any, ...],
+    descending: bool,
+    lower: _Bound,
+    upper: _Bound,
+) -> Tuple[int, int]:
+    # Finds the slice of sorted index entries starting with prefix, whose
+    # next column falls in the interval. Descending columns hold _Desc keys,
+    # so the interval is walked from its upper bound
+    wrap: Callable[[_SortKey], Any] = _Desc if descending else (lambda k: k)
+    first, last = (upper, lower) if descending else (lower, upper)
+
+    if first is None:
+        start = bisect.bisect_left(entries, prefix)
+    elif first[1]:
+        start = bisect.bisect_left(entries, prefix + (wrap(first[0]),))
+    else:
+        start = bisect.bisect_right(entries, prefix + (wrap(first[0]), _MAX))
+
+    if last is None:
+        end = bisect.bisect_right(entries, prefix + (_MAX,))
+    elif last[1]:
+        end = bisect.bisect_right(entries, prefix + (wrap(last[0]), _MAX))
+    else:
+        end = bisect.bisect_left(entries, prefix + (wrap(last[0]),))
+    return start, max(start, end)
+
+
+def _sorted_range(entries: Sequence[Any], lower: _Bound, upper: _Bound) -> range:
+    # Indices of the sorted entries within the interval
+    start = 0
+    if lower is not None:
+        bisect_start = bisect.bisect_left if lower[1] else bisect.bisect_right
+        start = bisect_start(entries, lower[0])
+    end = len(entries)
+    if upper is not None:
+        bisect_end = bisect.bisect_right if upper[1] else bisect.bisect_left
+        end = bisect_end(entries, upper[0])
+    return range(start, max(start, end))
+
+
+def _in_interval(sort_key: _SortKey, lower: _Bound, upper: _Bound) -> bool:
+    if lower is not None and (
+        sort_key < lower[0] or (not lower[1] and sort_key == lower[0])
+    ):
+        return False
+    if upper is not None and (
+        sort_key > upper[0] or (not upper[1] and sort_key == upper[0])
+    ):
+        return False
+    return True
+
+
+def _is_indexable_filter(prop_filter: types.PropertyFilter) -> bool:
+    return (
+        prop_filter.op in _INDEXABLE_OPERATORS
+        and prop_filter.property.name != "__key__"
+        and _is_indexable_value(prop_filter.value)
+    )
+
+
+def _is_key_filter(prop_filter: types.PropertyFilter) -> bool:
+    return (
+        prop_filter.op in _INDEXABLE_OPERATORS
+        and prop_filter.property.name == "__key__"
+        and prop_filter.value.WhichOneof("value_type") == "key_value"
+    )
+
+
+def _key_filter_interval(prop_filter: types.PropertyFilter) -> _Interval:
+    # Like _filter_interval, but over the keys entities are stored by.
+    # Bounds that only limit the value type don't limit the keys
+    lower, upper = _filter_interval(prop_filter)
+    return (
+        (lower[0][1], lower[1]) if lower is not None and len(lower[0]) > 1 else None,
+        (upper[0][1], upper[1]) if upper is not None and len(upper[0]) > 1 else None,
+    )
+
+
+def _ancestor_interval(ancestor: types.Key) -> _Interval:
+    # Keys of the ancestor and its descendants all start with its path, at
+    # any depth. _MAX sorts after every path element
+    project, namespace, path = _key_sort_key(ancestor)
+    return ((project, namespace, path), True), (
+        (project, namespace, path + (_MAX,)),
+        False,
+    )
+
+
+class _PropertyIndex(object):
+
+    # Sorted (value sort key, entity key sort key) pairs
+    _entries: List[Tuple[_SortKey, _SortKey]]
+
+    def __init__(self) -> None:
+        self._entries = []
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def add_many(self, entries: Iterable[Tuple[_SortKey, _SortKey]]) -> None:
+        # The existing entries are a sorted run, so sorting them with the
+        # new ones mostly costs sorting the new ones
+        self._entries.extend(entries)
+        self._entries.sort()
+
+    def add(self, sort_key: _SortKey, store_key: _SortKey) -> None:
+        bisect.insort(self._entries, (sort_key, store_key))
+
+    def remove(self, sort_key: _SortKey, store_key: _SortKey) -> None:
+        entry = (sort_key, store_key)
+        i = bisect.bisect_left(self._entries, entry)
+        if i < len(self._entries) and self._entries[i] == entry:
+            del self._entries[i]
+
+    def count(self, prop_filter: types.PropertyFilter) -> int:
+        start, end = self._bounds(prop_filter)
+        return end - start
+
+    def keys(self, prop_filter: types.PropertyFilter) -> Iterator[_SortKey]:
+        start, end = self._bounds(prop_filter)
+        return (store_key for _, store_key in self._entries[start:end])
+
+    def interval_count(self, lower: _Bound, upper: _Bound) -> int:
+        start, end = _interval_bounds(self._entries, (), False, lower, upper)
+        return end - start
+
+    def ordered_entries(
+        self,
+        descending: bool,
+        after: Optional[Tuple[_SortKey, _SortKey]],
+        bound: _Bound,
+    ) -> Iterator[Tuple[_SortKey, _SortKey]]:
+        # Entries in the order of queries sorted by the property: by value,
+        # then by key ascending even when the values are descending. The
+        # scan starts right after the (value, key) entry of a cursor, and
+        # ends at the bound, an upper one ascending and a lower one descending
+        if not descending:
+            start = 0 if after is None else bisect.bisect_right(self._entries, after)
+            end = _interval_bounds(self._entries, (), False, None, bound)[1]
+            return (self._entries[i] for i in range(start, end))
+        return self._descending_entries(after, bound)
+
+    def _bounds(self, prop_filter: types.PropertyFilter) -> Tuple[int, int]:
+        lower, upper = _filter_interval(prop_filter)
+        return _interval_bounds(self._entries, (), False, lower, upper)
+
+    def _descending_entries(
+        self, after: Optional[Tuple[_SortKey, _SortKey]], bound: _Bound
+    ) -> Iterator[Tuple[_SortKey, _SortKey]]:
+        # Walks runs of equal values from the largest down, each in key order
+        entries = self._entries
+        low = _interval_bounds(entries, (), False, bound, None)[0]
+        end = len(entries)
+        if after is not None:
+            value, _ = after
+            run_end = bisect.bisect_right(entries, (value, _MAX))
+            for i in range(bisect.bisect_right(entries, after), run_end):
+                yield entries[i]
+            end = bisect.bisect_left(entries, (value,))
+        while end > low:
+            run_start = max(bisect.bisect_left(entries, (entries[end - 1][0],)), low)
+            for i in range(run_start, end):
+                yield entries[i]
+            end = run_start
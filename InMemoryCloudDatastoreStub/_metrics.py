@@ -0,0 +1,161 @@
+import bisect
+import grpc
+import threading
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+# Upper bounds of the histogram buckets, the last bucket has no bound
+_LATENCY_BUCKETS = (
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+_SIZE_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 10000, 100000)
+
+# Sizes recorded for each method, from its request and response
+_LOOKUP_KEYS = "lookup_keys"
+_COMMIT_MUTATIONS = "commit_mutations"
+_QUERY_ENTITIES_RETURNED = "query_entities_returned"
+
+
+class RpcEvent(NamedTuple):
+    # Passed to the metrics hook after every call
+    method: str
+    code: grpc.StatusCode
+    seconds: float
+    # Sizes of the call, named like in stats()
+    sizes: Dict[str, int]
+
+
+class _Histogram(object):
+    bounds: Tuple[float, ...]
+    counts: List[int]
+    count: int
+    sum: float
+
+    def __init__(self, bounds: Tuple[float, ...]) -> None:
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def to_dict(self) -> Dict[str, Any]:
+        # Buckets are cumulative, like Prometheus' "le" buckets
+        buckets = []
+        total = 0
+        for bound, count in zip(self.bounds + (float("inf"),), self.counts):
+            total += count
+            buckets.append((bound, total))
+        return {"count": self.count, "sum": self.sum, "buckets": buckets}
+
+
+class _MethodStats(object):
+    calls: int
+    errors: Dict[str, int]
+    latency: _Histogram
+
+    def __init__(self) -> None:
+        self.calls = 0
+        self.errors = {}
+        self.latency = _Histogram(_LATENCY_BUCKETS)
+
+
+class _Metrics(object):
+    """
+    Counts calls, their latency and sizes per method. Handlers add sizes
+    only they know about (ex: entities scanned) to the running call with
+    note()
+    """
+
+    hook: Optional[Callable[[RpcEvent], Any]]
+    _lock: threading.Lock
+    _local: threading.local
+    _methods: Dict[str, _MethodStats]
+    _sizes: Dict[str, _Histogram]
+    _transaction_aborts: int
+
+    def __init__(self) -> None:
+        self.hook = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.reset()
+
+    def reset(self) -> None:
+        with self._lock:
+            self._methods = {}
+            self._sizes = {}
+            self._transaction_aborts = 0
+
+    def note(self, **sizes: int) -> None:
+        self._local.sizes = sizes
+
+    def record_call(
+        self,
+        method: str,
+        request: Any,
+        response: Any,
+        code: grpc.StatusCode,
+        seconds: float,
+    ) -> None:
+        sizes: Dict[str, int] = getattr(self._local, "sizes", {})
+        self._local.sizes = {}
+        if method == "Lookup":
+            sizes[_LOOKUP_KEYS] = len(request.keys)
+        elif method == "Commit":
+            sizes[_COMMIT_MUTATIONS] = len(request.mutations)
+        elif method == "RunQuery" and response is not None:
+            sizes[_QUERY_ENTITIES_RETURNED] = len(response.batch.entity_results)
+
+        with self._lock:
+            stats = self._methods.get(method)
+            if stats is None:
+                stats = self._methods[method] = _MethodStats()
+            stats.calls += 1
+            stats.latency.observe(seconds)
+            if code != grpc.StatusCode.OK:
+                stats.errors[code.name] = stats.errors.get(code.name, 0) + 1
+            if method == "Commit" and code == grpc.StatusCode.ABORTED:
+                self._transaction_aborts += 1
+            for name, size in sizes.items():
+                histogram = self._sizes.get(name)
+                if histogram is None:
+                    histogram = self._sizes[name] = _Histogram(_SIZE_BUCKETS)
+                histogram.observe(size)
+
+        hook = self.hook
+        if hook is not None:
+            hook(RpcEvent(method, code, seconds, sizes))
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "methods": {
+                    method: {
+                        "calls": stats.calls,
+                        "errors": dict(stats.errors),
+                        "latency": stats.latency.to_dict(),
+                    }
+                    for method, stats in self._methods.items()
+                },
+                "sizes": {
+                    name: histogram.to_dict() for name, histogram in self._sizes.items()
+                },
+                "transaction_aborts": self._transaction_aborts,
+            }
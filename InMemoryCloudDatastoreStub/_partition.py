@@ -0,0 +1,54 @@
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from ._composite_indexes import _CompositeIndex, _CompositeIndexDefinition
+from ._id_allocator import _IdAllocator
+from ._indexes import _PropertyIndex, _SortKey
+from ._stored_object import _StoredObject
+
+# (project ID, namespace ID), the first two items of every key's sort key
+_PartitionId = Tuple[str, str]
+
+
+class _Partition(object):
+    """
+    The committed entities of a project's namespace, with their indexes.
+    Nothing is shared between partitions, so dropping one is O(1)
+    """
+
+    # Entities are stored by their key's _key_sort_key
+    store: Dict[_SortKey, _StoredObject]
+    # Keys of all entities, and of the entities of each kind, in key order
+    keys: List[_SortKey]
+    kind_index: Dict[str, List[_SortKey]]
+    # Seqid of the last write to the partition, and to each of its kinds
+    seqid: int
+    kind_seqids: Dict[str, int]
+    # (kind, property name) -> sorted index of that property's values
+    property_indexes: Dict[Tuple[str, str], _PropertyIndex]
+    composite_indexes: Dict[str, List[_CompositeIndex]]
+    # Kinds whose property indexes are built on first use, after loading them
+    # from a snapshot without parsing their entities
+    unindexed_kinds: Set[str]
+    ids: _IdAllocator
+
+    def __init__(
+        self,
+        ids: _IdAllocator,
+        composite_definitions: Iterable[_CompositeIndexDefinition],
+    ) -> None:
+        self.store = {}
+        self.keys = []
+        self.kind_index = {}
+        self.seqid = 0
+        self.kind_seqids = {}
+        self.property_indexes = {}
+        self.composite_indexes = {}
+        for definition in composite_definitions:
+            self.composite_indexes.setdefault(definition.kind, []).append(
+                _CompositeIndex(definition)
+            )
+        self.unindexed_kinds = set()
+        self.ids = ids
+
+    def sorted_keys(self, kind: Optional[str] = None) -> List[_SortKey]:
+        return self.keys if kind is None else self.kind_index.get(kind, [])
@@ -0,0 +1,57 @@
+import collections
+import threading
+from google.cloud.datastore_v1 import types
+from typing import Optional, Tuple
+
+
+class _QueryResultCache(object):
+    """
+    LRU cache of RunQuery responses. Each response is stored with the seqid
+    of the last write to the queried kind, and is stale once that changes.
+    A max_size of 0 turns the cache off
+    """
+
+    max_size: int
+    hits: int
+    misses: int
+    _responses: "collections.OrderedDict[bytes, Tuple[int, types.RunQueryResponse]]"
+    _lock: threading.Lock
+
+    def __init__(self, max_size: int) -> None:
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._responses = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._responses)
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_size > 0
+
+    def get(self, cache_key: bytes, seqid: int) -> Optional[types.RunQueryResponse]:
+        with self._lock:
+            entry = self._responses.get(cache_key)
+            if entry is None or entry[0] != seqid:
+                self.misses += 1
+                return None
+            self._responses.move_to_end(cache_key)
+            self.hits += 1
+            return entry[1]
+
+    def put(
+        self, cache_key: bytes, seqid: int, response: types.RunQueryResponse
+    ) -> None:
+        with self._lock:
+            self._responses[cache_key] = (seqid, response)
+            self._responses.move_to_end(cache_key)
+            while len(self._responses) > self.max_size:
+                self._responses.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._responses.clear()
+            self.hits = 0
+            self.misses = 0
@@ -0,0 +1,231 @@
+import collections
+import operator
+import threading
+from google.cloud.datastore_v1 import types
+from typing import Callable, List, NamedTuple, Optional, Tuple
+
+from ._composite_indexes import _query_shape, _QueryShape
+from ._cursors import _query_orders, _QueryOrder
+from ._indexes import (
+    _ancestor_interval,
+    _filter_interval,
+    _in_interval,
+    _intersect_intervals,
+    _Interval,
+    _is_indexable_filter,
+    _is_key_filter,
+    _key_filter_interval,
+    _MAX,
+)
+from ._stored_object import _StoredObject
+
+_Predicate = Callable[[_StoredObject], bool]
+
+# Scans check the filters least likely to match first. Filters that can't
+# match anything go before all others
+_NEVER_MATCHES = 0
+_OPERATOR_SELECTIVITY = {
+    types.PropertyFilter.Operator.EQUAL: 1,
+    types.PropertyFilter.Operator.HAS_ANCESTOR: 2,
+}
+_INEQUALITY_SELECTIVITY = 3
+
+_ASCENDING = types.PropertyOrder.Direction.ASCENDING
+_DESCENDING = types.PropertyOrder.Direction.DESCENDING
+
+
+class _CompiledFilter(NamedTuple):
+    prop_filter: types.PropertyFilter
+    matches: _Predicate
+    # Whether the filter can be served from a property index
+    indexable: bool
+    # Lower is more selective
+    selectivity: int
+    # For __key__ and ancestor filters, the interval of keys they match
+    key_interval: Optional[_Interval] = None
+
+
+class _QueryPlan(NamedTuple):
+    kind: Optional[str]
+    # Used to pick a composite index, only kind queries have one
+    shape: Optional[_QueryShape]
+    # Ordered most selective first
+    filters: List[_CompiledFilter]
+    # The filters a composite index for shape can't answer
+    composite_residual: List[_Predicate]
+    # Interval of keys allowed by the __key__ and ancestor filters, None
+    # without such filters
+    key_interval: Optional[_Interval]
+    orders: List[_QueryOrder]
+    # Whether results are in key order, so they can be read off a key scan
+    key_ordered: bool
+    # For queries ordered by a single property, its name and whether it's
+    # descending, so results can be read off its index in order
+    ordered_property: Optional[Tuple[str, bool]] = None
+    # Interval of values allowed by the filters on the ordered property
+    order_interval: _Interval = (None, None)
+
+    def matches(self, stored: _StoredObject) -> bool:
+        return all(f.matches(stored) for f in self.filters)
+
+
+def _property_filters(query_filter: types.Filter) -> List[types.PropertyFilter]:
+    # Only AND composite filters exist, so any filter is a conjunction of
+    # property filters
+    filter_type = query_filter.WhichOneof("filter_type")
+    if filter_type == "property_filter":
+        return [query_filter.property_filter]
+    elif filter_type == "composite_filter":
+        assert query_filter.composite_filter.op == types.CompositeFilter.Operator.AND
+        return [
+            prop_filter
+            for f in query_filter.composite_filter.filters
+            for prop_filter in _property_filters(f)
+        ]
+    return []
+
+
+def _compile_ancestor_filter(prop_filter: types.PropertyFilter) -> _CompiledFilter:
+    assert (
+        prop_filter.property.name == "__key__"
+        and prop_filter.value.WhichOneof("value_type") == "key_value"
+    )
+    lower, upper = interval = _ancestor_interval(prop_filter.value.key_value)
+    return _CompiledFilter(
+        prop_filter,
+        lambda stored: _in_interval(stored.key_sort_key(), lower, upper),
+        False,
+        _OPERATOR_SELECTIVITY[prop_filter.op],
+        interval,
+    )
+
+
+def _compile_property_filter(prop_filter: types.PropertyFilter) -> _Predicate:
+    # Filters compare index sort keys, so a scan matches exactly the entities
+    # an index lookup would. Repeated properties match if any value does
+    name = prop_filter.property.name
+    lower, upper = _filter_interval(prop_filter)
+    if prop_filter.op == types.PropertyFilter.Operator.EQUAL:
+        value_key = lower[0]
+        return lambda stored: value_key in stored.sort_keys(name)
+
+    lower_key, lower_inclusive = lower
+    # Ranges starting at null are unbounded above, and _MAX is above any key
+    upper_key, upper_inclusive = upper if upper is not None else (_MAX, False)
+    above = operator.ge if lower_inclusive else operator.gt
+    below = operator.le if upper_inclusive else operator.lt
+
+    def matches(stored: _StoredObject) -> bool:
+        return any(
+            above(sort_key, lower_key) and below(sort_key, upper_key)
+            for sort_key in stored.sort_keys(name)
+        )
+
+    return matches
+
+
+def _compile_filter(prop_filter: types.PropertyFilter) -> _CompiledFilter:
+    op = prop_filter.op
+    selectivity = _OPERATOR_SELECTIVITY.get(op, _INEQUALITY_SELECTIVITY)
+    if op == types.PropertyFilter.Operator.HAS_ANCESTOR:
+        return _compile_ancestor_filter(prop_filter)
+    if _is_key_filter(prop_filter):
+        return _CompiledFilter(
+            prop_filter,
+            _compile_property_filter(prop_filter),
+            False,
+            selectivity,
+            _key_filter_interval(prop_filter),
+        )
+    if not _is_indexable_filter(prop_filter):
+        # Like in production, only indexed values can match a filter
+        return _CompiledFilter(prop_filter, lambda stored: False, False, _NEVER_MATCHES)
+    return _CompiledFilter(
+        prop_filter, _compile_property_filter(prop_filter), True, selectivity
+    )
+
+
+def _compile_query(query: types.Query) -> _QueryPlan:
+    kind = query.kind[0].name if query.kind else None
+    property_filters = _property_filters(query.filter)
+    compiled = {id(f): _compile_filter(f) for f in property_filters}
+
+    shape = None
+    composite_residual: List[_Predicate] = []
+    if kind is not None:
+        shape = _query_shape(kind, property_filters, query.order)
+        composite_residual = [compiled[id(f)].matches for f in shape.residual]
+
+    key_intervals = [
+        f.key_interval for f in compiled.values() if f.key_interval is not None
+    ]
+    orders = _query_orders(query)
+    ordered_property = None
+    order_interval: _Interval = (None, None)
+    if (
+        orders
+        and orders[0][0] != "__key__"
+        and orders[1:] in ([], [("__key__", _ASCENDING)])
+    ):
+        name, direction = orders[0]
+        ordered_property = (name, direction == _DESCENDING)
+        order_interval = _intersect_intervals(
+            [
+                _filter_interval(f.prop_filter)
+                for f in compiled.values()
+                if f.indexable and f.prop_filter.property.name == name
+            ]
+        )
+    return _QueryPlan(
+        kind=kind,
+        shape=shape,
+        filters=sorted(compiled.values(), key=lambda f: f.selectivity),
+        composite_residual=composite_residual,
+        key_interval=_intersect_intervals(key_intervals) if key_intervals else None,
+        orders=orders,
+        key_ordered=orders in ([], [("__key__", _ASCENDING)]),
+        ordered_property=ordered_property,
+        order_interval=order_interval,
+    )
+
+
+class _QueryPlanner(object):
+    """
+    Compiles queries into plans, and keeps the most recently used ones.
+    Plans only depend on the query, so they stay valid as data changes
+    """
+
+    cache_size: int
+    _plans: "collections.OrderedDict[Tuple[bytes, ...], _QueryPlan]"
+    _lock: threading.Lock
+
+    def __init__(self, cache_size: int) -> None:
+        self.cache_size = cache_size
+        self._plans = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._plans)
+
+    def plan(self, query: types.Query) -> _QueryPlan:
+        # Cursors, offsets and limits don't change the plan
+        cache_key = (
+            query.kind[0].name.encode() if query.kind else b"",
+            query.filter.SerializeToString(deterministic=True),
+            b"".join(order.SerializeToString() for order in query.order),
+        )
+        with self._lock:
+            plan = self._plans.get(cache_key)
+            if plan is not None:
+                self._plans.move_to_end(cache_key)
+                return plan
+
+            # Plans outlive the request, so they hold on to a copy of the query
+            query_copy = types.Query()
+            query_copy.CopyFrom(query)
+            plan = _compile_query(query_copy)
+            if self.cache_size > 0:
+                self._plans[cache_key] = plan
+                if len(self._plans) > self.cache_size:
+                    self._plans.popitem(last=False)
+            return plan
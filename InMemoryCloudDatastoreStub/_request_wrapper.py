@@ -1,17 +1,62 @@
 import grpc
-from .futures import InstantFuture
+import time
+from .futures import ExecutorFuture, InstantFuture
 
 
 class _RequestWrapper(grpc.UnaryUnaryMultiCallable):
-    def __init__(self, func):
+    def __init__(self, func, name="", metrics=None, executor=None, latency_model=None):
         self.func = func
+        self.name = name
+        self.metrics = metrics
+        # Without an executor, futures are resolved before they're returned
+        self.executor = executor
+        self.latency_model = latency_model
 
     def __call__(self, request, *args, **kwargs):
-        return self.func(request, *args, **kwargs)
+        if self.metrics is None:
+            return self._call(request, *args, **kwargs)
+
+        start = time.perf_counter()
+        resp = None
+        code = grpc.StatusCode.OK
+        try:
+            resp = self._call(request, *args, **kwargs)
+            return resp
+        except grpc.RpcError as e:
+            code = e.code() if isinstance(e, grpc.Call) else grpc.StatusCode.UNKNOWN
+            raise
+        except Exception:
+            code = grpc.StatusCode.UNKNOWN
+            raise
+        finally:
+            self.metrics.record_call(
+                self.name, request, resp, code, time.perf_counter() - start
+            )
 
     def with_call(self, request, *args, **kwargs):
         return self(request, *args, **kwargs)
 
     def future(self, request, *args, **kwargs):
-        resp = self(request, *args, **kwargs)
+        if self.executor is not None:
+            return ExecutorFuture(self.executor.submit(self, request, *args, **kwargs))
+        try:
+            resp = self(request, *args, **kwargs)
+        except grpc.RpcError as e:
+            return InstantFuture(None, exception=e)
         return InstantFuture(resp)
+
+    def _call(self, request, *args, **kwargs):
+        latency_model = self.latency_model
+        if latency_model is None:
+            return self.func(request, *args, **kwargs)
+
+        # Calls take their time on whatever thread runs them, so pending
+        # futures stay pending for as long
+        latency_model.before_call(self.name, request)
+        try:
+            resp = self.func(request, *args, **kwargs)
+        except grpc.RpcError:
+            latency_model.after_call(self.name, request, None)
+            raise
+        latency_model.after_call(self.name, request, resp)
+        return resp
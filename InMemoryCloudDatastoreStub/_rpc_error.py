@@ -0,0 +1,36 @@
+import grpc
+from typing import Any, Optional
+
+
+class _RpcError(grpc.RpcError, grpc.Call):
+    # An error as a real gRPC channel would raise it, so ndb translates it to
+    # the matching google.api_core exception (ex: FailedPrecondition)
+
+    def __init__(self, code: grpc.StatusCode, details: str) -> None:
+        super().__init__(details)
+        self._code = code
+        self._details = details
+
+    def code(self) -> grpc.StatusCode:
+        return self._code
+
+    def details(self) -> str:
+        return self._details
+
+    def initial_metadata(self) -> Optional[Any]:
+        return None
+
+    def trailing_metadata(self) -> Optional[Any]:
+        return None
+
+    def is_active(self) -> bool:
+        return False
+
+    def time_remaining(self) -> Optional[float]:
+        return None
+
+    def cancel(self) -> bool:
+        return False
+
+    def add_callback(self, callback: Any) -> bool:
+        return False
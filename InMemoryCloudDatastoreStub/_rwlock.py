@@ -0,0 +1,86 @@
+import contextlib
+import functools
+import threading
+from typing import Any, Callable, cast, Iterator, Optional, TypeVar
+
+_F = TypeVar("_F", bound=Callable[..., Any])
+
+
+class _ReadWriteLock(object):
+    """
+    Lets any number of readers, or a single writer, hold the lock. Writers
+    waiting for the lock keep new readers out, so they aren't starved.
+    Both sides are reentrant, and a writer can also read. A reader can't
+    start writing though, that would deadlock with other readers
+    """
+
+    def __init__(self) -> None:
+        self._condition = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._waiting_writers = 0
+        self._writer: Optional[int] = None
+        self._local = threading.local()
+
+    @contextlib.contextmanager
+    def read(self) -> Iterator[None]:
+        if self._writer == threading.get_ident():
+            yield
+            return
+
+        depth = getattr(self._local, "reads", 0)
+        if depth == 0:
+            with self._condition:
+                while self._writer is not None or self._waiting_writers:
+                    self._condition.wait()
+                self._readers += 1
+        self._local.reads = depth + 1
+        try:
+            yield
+        finally:
+            self._local.reads = depth
+            if depth == 0:
+                with self._condition:
+                    self._readers -= 1
+                    if self._readers == 0:
+                        self._condition.notify_all()
+
+    @contextlib.contextmanager
+    def write(self) -> Iterator[None]:
+        me = threading.get_ident()
+        if self._writer == me:
+            yield
+            return
+        if getattr(self._local, "reads", 0):
+            raise RuntimeError("Can't write while holding the lock for reading")
+
+        with self._condition:
+            self._waiting_writers += 1
+            while self._writer is not None or self._readers:
+                self._condition.wait()
+            self._waiting_writers -= 1
+            self._writer = me
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._writer = None
+                self._condition.notify_all()
+
+
+def _reads(method: _F) -> _F:
+    # Runs a method of an object with a `lock` while holding it for reading
+    @functools.wraps(method)
+    def locked(self: Any, *args: Any, **kwargs: Any) -> Any:
+        with self.lock.read():
+            return method(self, *args, **kwargs)
+
+    return cast(_F, locked)
+
+
+def _writes(method: _F) -> _F:
+    @functools.wraps(method)
+    def locked(self: Any, *args: Any, **kwargs: Any) -> Any:
+        with self.lock.write():
+            return method(self, *args, **kwargs)
+
+    return cast(_F, locked)
@@ -0,0 +1,92 @@
+import marshal
+import mmap
+from typing import Iterable, Iterator, List, NamedTuple, Tuple, Union
+
+from ._indexes import _SortKey
+
+# A snapshot file is laid out as:
+#   _MAGIC, then _FORMAT_VERSION as a varint
+#   the varint length of a table, then the table itself: a marshalled
+#   (next id, [(key sort key, version, offset, length), ...]) in key order
+#   the entities, as a stream of varint length prefixed Entity protos
+# The table lets entities be located without reading the stream, so they
+# are only parsed when first used
+_MAGIC = b"DSSNAP\x00\x00"
+_FORMAT_VERSION = 1
+
+
+class _SnapshotEntity(NamedTuple):
+    store_key: _SortKey
+    version: int
+    serialized: Union[bytes, memoryview]
+
+
+def _encode_varint(value: int) -> bytes:
+    encoded = bytearray()
+    while value > 0x7F:
+        encoded.append((value & 0x7F) | 0x80)
+        value >>= 7
+    encoded.append(value)
+    return bytes(encoded)
+
+
+def _decode_varint(
+    data: Union[bytes, memoryview, mmap.mmap], pos: int
+) -> Tuple[int, int]:
+    # Returns the value and the position right after it
+    value = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return value, pos
+        shift += 7
+
+
+def _write_snapshot(
+    path: str, next_id: int, entities: Iterable[_SnapshotEntity]
+) -> None:
+    table: List[Tuple[_SortKey, int, int, int]] = []
+    records: List[bytes] = []
+    offset = 0
+    for store_key, version, serialized in entities:
+        prefix = _encode_varint(len(serialized))
+        offset += len(prefix)
+        table.append((store_key, version, offset, len(serialized)))
+        records.append(prefix)
+        records.append(bytes(serialized))
+        offset += len(serialized)
+
+    encoded_table = marshal.dumps((next_id, table))
+    with open(path, "wb") as f:
+        f.write(_MAGIC)
+        f.write(_encode_varint(_FORMAT_VERSION))
+        f.write(_encode_varint(len(encoded_table)))
+        f.write(encoded_table)
+        f.writelines(records)
+
+
+def _read_snapshot(path: str) -> Tuple[int, Iterator[_SnapshotEntity]]:
+    # Returns the next id to allocate, and the entities in key order. The
+    # file is memory mapped, entities are views into it
+    with open(path, "rb") as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    if data[: len(_MAGIC)] != _MAGIC:
+        raise ValueError(f"{path} is not a datastore snapshot")
+    format_version, pos = _decode_varint(data, len(_MAGIC))
+    if format_version != _FORMAT_VERSION:
+        raise ValueError(f"Unsupported snapshot format version {format_version}")
+    table_length, pos = _decode_varint(data, pos)
+    next_id, table = marshal.loads(data[pos : pos + table_length])
+
+    base = pos + table_length
+    view = memoryview(data)
+    return next_id, (
+        _SnapshotEntity(
+            store_key, version, view[base + offset : base + offset + length]
+        )
+        for store_key, version, offset, length in table
+    )
@@ -1,7 +1,178 @@
+import threading
+import zlib
 from google.cloud.datastore_v1 import types
-from typing import NamedTuple
+from typing import Dict, List, Optional, Type, Union
 
+from ._indexes import _index_sort_keys, _KEY_RANK, _key_sort_key, _SortKey
+
+# How the store holds committed entities, see LocalDatastoreStub
+_OBJECTS = "objects"
+_SERIALIZED = "serialized"
+_COMPRESSED = "compressed"
+
+
+class _StoredObject(object):
+    # Stored entities are never modified, so everything derived from them is
+    # computed on first use and memoized for the lifetime of this version
+
+    __slots__ = (
+        "version",
+        "_entity",
+        "_serialized",
+        "_sort_keys",
+        "_key_sort_key",
+    )
 
-class _StoredObject(NamedTuple):
     version: int
-    entity: types.Entity
+    _entity: Optional[types.Entity]
+    # Entities loaded from a snapshot are only parsed when first used
+    _serialized: Optional[Union[bytes, memoryview]]
+    _sort_keys: Dict[str, List[_SortKey]]
+    _key_sort_key: Optional[_SortKey]
+
+    def __init__(
+        self,
+        version: int,
+        entity: types.Entity,
+        key_sort_key: Optional[_SortKey] = None,
+    ) -> None:
+        self.version = version
+        self._entity = entity
+        self._serialized = None
+        self._sort_keys = {}
+        self._key_sort_key = key_sort_key
+
+    @classmethod
+    def from_serialized(
+        cls,
+        version: int,
+        serialized: Union[bytes, memoryview],
+        key_sort_key: _SortKey,
+    ) -> "_StoredObject":
+        stored = cls.__new__(cls)
+        stored.version = version
+        stored._entity = None
+        stored._serialized = serialized
+        stored._sort_keys = {}
+        stored._key_sort_key = key_sort_key
+        return stored
+
+    @property
+    def entity(self) -> types.Entity:
+        # The serialized form is kept, so threads racing to parse it all succeed
+        if self._entity is None:
+            assert self._serialized is not None
+            self._entity = types.Entity.FromString(self._serialized)
+        return self._entity
+
+    def serialized(self) -> Union[bytes, memoryview]:
+        if self._serialized is not None:
+            return self._serialized
+        return self.entity.SerializeToString()
+
+    def sort_keys(self, name: str) -> List[_SortKey]:
+        if name not in self._sort_keys:
+            self._sort_keys[name] = self._compute_sort_keys(name)
+        return self._sort_keys[name]
+
+    def _compute_sort_keys(self, name: str) -> List[_SortKey]:
+        # Sorted index sort keys of a property, one per value for repeated
+        # properties. Empty when the entity has no indexable value for it.
+        # __key__ is the entity's key, so it can be filtered on like a property
+        if name == "__key__":
+            return [(_KEY_RANK, self.key_sort_key())]
+        properties = self.entity.properties
+        if name in properties:
+            return sorted(_index_sort_keys(properties[name]))
+        return []
+
+    def key_sort_key(self) -> _SortKey:
+        if self._key_sort_key is None:
+            self._key_sort_key = _key_sort_key(self.entity.key)
+        return self._key_sort_key
+
+
+# The serialized entity each thread parsed last. An entity is usually used
+# several times in a row (indexing each of its properties, checking each
+# filter, building a result and its cursor), which then parses it only once
+_last_parsed = threading.local()
+
+
+class _SerializedObject(_StoredObject):
+    """
+    Only holds the serialized entity and its key, and parses the entity
+    again whenever it's used instead of keeping it and its sort keys
+    """
+
+    __slots__ = ()
+
+    def __init__(
+        self,
+        version: int,
+        entity: types.Entity,
+        key_sort_key: Optional[_SortKey] = None,
+    ) -> None:
+        self.version = version
+        self._entity = None
+        self._serialized = self._encode(entity.SerializeToString())
+        self._key_sort_key = key_sort_key
+
+    @classmethod
+    def from_serialized(
+        cls,
+        version: int,
+        serialized: Union[bytes, memoryview],
+        key_sort_key: _SortKey,
+    ) -> "_StoredObject":
+        stored = cls.__new__(cls)
+        stored.version = version
+        stored._entity = None
+        stored._serialized = cls._encode(serialized)
+        stored._key_sort_key = key_sort_key
+        return stored
+
+    @staticmethod
+    def _encode(serialized: Union[bytes, memoryview]) -> Union[bytes, memoryview]:
+        return serialized
+
+    @property
+    def entity(self) -> types.Entity:
+        if getattr(_last_parsed, "stored", None) is not self:
+            _last_parsed.entity = types.Entity.FromString(self.serialized())
+            _last_parsed.stored = self
+        return _last_parsed.entity
+
+    def sort_keys(self, name: str) -> List[_SortKey]:
+        return self._compute_sort_keys(name)
+
+
+# zlib streams start with this byte, serialized entities never do since they
+# start with the tag of their key or properties field, if not empty
+_ZLIB_HEADER = 0x78
+
+
+class _CompressedObject(_SerializedObject):
+    """
+    Holds the serialized entity compressed with zlib, unless that doesn't
+    make it smaller, which is common for small entities
+    """
+
+    __slots__ = ()
+
+    @staticmethod
+    def _encode(serialized: Union[bytes, memoryview]) -> Union[bytes, memoryview]:
+        compressed = zlib.compress(serialized, 1)
+        return compressed if len(compressed) < len(serialized) else serialized
+
+    def serialized(self) -> Union[bytes, memoryview]:
+        assert self._serialized is not None
+        if self._serialized[:1] == bytes([_ZLIB_HEADER]):
+            return zlib.decompress(self._serialized)
+        return self._serialized
+
+
+_STORED_TYPES: Dict[str, Type[_StoredObject]] = {
+    _OBJECTS: _StoredObject,
+    _SERIALIZED: _SerializedObject,
+    _COMPRESSED: _CompressedObject,
+}
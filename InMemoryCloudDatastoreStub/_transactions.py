@@ -1,7 +1,8 @@
 import enum
 from google.cloud.datastore_v1 import types
-from typing import Dict, List, NamedTuple
-from ._stored_object import _StoredObject
+from typing import List, NamedTuple, Set
+
+from ._indexes import _SortKey
 
 
 class _TransactionType(enum.Enum):
@@ -12,5 +13,6 @@ class _TransactionType(enum.Enum):
 class _InFlightTransaction(NamedTuple):
     mode: _TransactionType
     initial_seqid: int
-    snapshot: Dict[str, _StoredObject]
     mutations: List[types.Mutation]
+    # Keys read by lookups and queries, to detect conflicts at commit time
+    read_set: Set[_SortKey]
@@ -1,53 +1,232 @@
-import google.cloud.datastore.helpers as ds_helpers
+import grpc
+import heapq
+import time
+from concurrent import futures
 from google.cloud import ndb
 from google.cloud.datastore_v1 import types
 from google.cloud.datastore_v1.proto import datastore_pb2_grpc
-from typing import List
-
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from ._bulk_load import _bulk_entities, _BulkSource
+from ._composite_indexes import (
+    _load_index_yaml,
+    _needs_composite_index,
+    _parse_index_definitions,
+    _recommended_index,
+)
+from ._cursors import (
+    _decode_cursor,
+    _encode_cursor,
+    _Position,
+    _result_position,
+)
 from ._in_memory_store import _InMemoryStore
+from ._indexes import _Bound, _intersect_intervals
+from .latency import LatencyModel
+from ._query_cache import _QueryResultCache
+from ._explain import (
+    _COMPOSITE_INDEX,
+    _describe_index,
+    _explain,
+    _HEAP,
+    _KEY_RANGE,
+    _ORDERED_INDEX,
+    _PROPERTY_INDEX,
+    _QueryExplainer,
+    _QueryProfile,
+    _SORT,
+    QueryExplanation,
+    QueryShapeStats,
+)
+from ._metrics import _Metrics, RpcEvent
+from ._partition import _PartitionId
+from ._query_planner import _CompiledFilter, _Predicate, _QueryPlan, _QueryPlanner
 from ._request_wrapper import _RequestWrapper
+from ._rpc_error import _RpcError
 from ._stored_object import _StoredObject
 from ._transactions import _TransactionType
 
 
 class LocalDatastoreStub(datastore_pb2_grpc.DatastoreStub):
 
-    _OPERATOR_TO_CMP_METHOD_NAME = {
-        types.PropertyFilter.Operator.LESS_THAN: "__lt__",
-        types.PropertyFilter.Operator.LESS_THAN_OR_EQUAL: "__le__",
-        types.PropertyFilter.Operator.GREATER_THAN: "__gt__",
-        types.PropertyFilter.Operator.GREATER_THAN_OR_EQUAL: "__ge__",
-        types.PropertyFilter.Operator.EQUAL: "__eq__",
-    }
+    # Limited queries use heap selection when they need less than
+    # 1/_TOP_K_MAX_FRACTION of the matching entities, and a full sort otherwise
+    _TOP_K_MAX_FRACTION = 4
+    # Queries ordered by a property read its index in order, unless other
+    # indexes narrow the candidates down to less than 1/_ORDERED_SCAN_MAX_RATIO
+    _ORDERED_SCAN_MAX_RATIO = 4
 
     store: _InMemoryStore
+    require_indexes: bool
+    _query_planner: _QueryPlanner
+    max_batch_size: Optional[int]
+    query_cache: _QueryResultCache
 
     Lookup: _RequestWrapper
     Commit: _RequestWrapper
     RunQuery: _RequestWrapper
     BeginTransaction: _RequestWrapper
     Rollback: _RequestWrapper
-    # AllocateIds: _RequestWrapper
-    # ReserveIds: _RequestWrapper
-
-    def __init__(self) -> None:
-        self.store = _InMemoryStore()
-
-        self.Lookup = _RequestWrapper(self._lookup)
-        self.Commit = _RequestWrapper(self._commit)
-        self.RunQuery = _RequestWrapper(self._run_query)
-        self.BeginTransaction = _RequestWrapper(self._begin_transaction)
-        self.Rollback = _RequestWrapper(self._rollback)
+    AllocateIds: _RequestWrapper
+    ReserveIds: _RequestWrapper
+
+    def __init__(
+        self,
+        index_yaml: Optional[str] = None,
+        indexes: Optional[Iterable[Dict[str, Any]]] = None,
+        require_indexes: bool = False,
+        max_batch_size: Optional[int] = None,
+        plan_cache_size: int = 256,
+        query_cache_size: int = 0,
+        executor: Optional[futures.Executor] = None,
+        latency_model: Optional[LatencyModel] = None,
+        explain: bool = False,
+        max_explanations: int = 1000,
+        scattered_ids: bool = False,
+        entity_storage: str = "objects",
+    ) -> None:
+        """
+        Composite indexes can be loaded from an index.yaml file, or passed as
+        `indexes`, a list of dicts shaped like the entries in index.yaml.
+        With `require_indexes`, queries that need a composite index fail
+        without one, like they do in production.
+        `max_batch_size` caps the number of results per RunQuery response,
+        the client then fetches the rest in further batches using cursors.
+        Compiled query plans are cached for the last `plan_cache_size`
+        distinct queries (ignoring cursors, offsets and limits).
+        With a `query_cache_size`, responses to the last that many distinct
+        RunQuery requests are cached until the queried kind is written to.
+        `query_cache` holds its hit and miss counts, and setting its
+        `max_size` to 0 turns it off.
+        With an `executor`, asynchronous calls (the ones ndb makes) run on it
+        and return pending futures, like over a real channel. Otherwise they
+        complete before returning. It can be changed through `executor`.
+        A `latency_model` makes calls take as long as it says, see
+        LatencyModel. It can be changed through `latency_model`.
+        With `explain`, every query records a QueryExplanation of how it ran,
+        the latest `max_explanations` of them are kept in `explanations`.
+        `explain_query` explains a single query.
+        IDs are allocated sequentially for each parent and kind, or with
+        `scattered_ids`, spread out over a large range like production does.
+        `entity_storage` is how committed entities are held in memory:
+        "objects" keeps them parsed, "serialized" keeps their serialized
+        bytes and parses them whenever they're read, and "compressed" also
+        compresses those with zlib. The last two take a fraction of the
+        memory, at the cost of slower reads and unindexed filters
+        """
+        self.store = _InMemoryStore(scattered_ids, entity_storage)
+        self.require_indexes = require_indexes
+        self.max_batch_size = max_batch_size
+        self._query_planner = _QueryPlanner(plan_cache_size)
+        self.query_cache = _QueryResultCache(query_cache_size)
+
+        index_definitions = _parse_index_definitions(indexes or [])
+        if index_yaml:
+            index_definitions.extend(_load_index_yaml(index_yaml))
+        for definition in index_definitions:
+            self.store.add_composite_index(definition)
+
+        self.explain = explain
+        self._explainer = _QueryExplainer(max_explanations)
+        self._metrics = _Metrics()
+        self.Lookup = _RequestWrapper(self._lookup, "Lookup", self._metrics)
+        self.Commit = _RequestWrapper(self._commit, "Commit", self._metrics)
+        self.RunQuery = _RequestWrapper(self._run_query, "RunQuery", self._metrics)
+        self.BeginTransaction = _RequestWrapper(
+            self._begin_transaction, "BeginTransaction", self._metrics
+        )
+        self.Rollback = _RequestWrapper(self._rollback, "Rollback", self._metrics)
+        self.AllocateIds = _RequestWrapper(
+            self._allocate_ids, "AllocateIds", self._metrics
+        )
+        self.ReserveIds = _RequestWrapper(
+            self._reserve_ids, "ReserveIds", self._metrics
+        )
+        self.executor = executor
+        self.latency_model = latency_model
+
+    @property
+    def executor(self) -> Optional[futures.Executor]:
+        return self.Lookup.executor
+
+    @executor.setter
+    def executor(self, executor: Optional[futures.Executor]) -> None:
+        for method in self._methods():
+            method.executor = executor
+
+    @property
+    def latency_model(self) -> Optional[LatencyModel]:
+        return self.Lookup.latency_model
+
+    @latency_model.setter
+    def latency_model(self, latency_model: Optional[LatencyModel]) -> None:
+        for method in self._methods():
+            method.latency_model = latency_model
+
+    @property
+    def metrics_hook(self) -> Optional[Callable[[RpcEvent], Any]]:
+        """
+        Called with an RpcEvent after every call, to export metrics
+        """
+        return self._metrics.hook
+
+    @metrics_hook.setter
+    def metrics_hook(self, hook: Optional[Callable[[RpcEvent], Any]]) -> None:
+        self._metrics.hook = hook
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Metrics of the calls made so far. "methods" has the number of calls,
+        errors by status code and a latency histogram per method. "sizes" has
+        histograms of keys per Lookup, mutations per Commit, and entities
+        scanned and returned per RunQuery. "transaction_aborts" counts
+        commits that failed with contention. Histograms hold a count, a sum
+        and cumulative (upper bound, count) buckets
+        """
+        return self._metrics.stats()
+
+    def reset_stats(self) -> None:
+        self._metrics.reset()
+
+    def _methods(self) -> List[_RequestWrapper]:
+        return [
+            self.Lookup,
+            self.Commit,
+            self.RunQuery,
+            self.BeginTransaction,
+            self.Rollback,
+            self.AllocateIds,
+            self.ReserveIds,
+        ]
+
+    def bulk_load(
+        self, source: _BulkSource, source_format: Optional[str] = None
+    ) -> int:
+        """
+        Writes many entities at once, much faster than inserting them one by
+        one. `source` is an iterable of ndb models and/or Entity protos, or a
+        path or binary file holding Entity protos, either as JSON lines
+        (`source_format="jsonl"`, the default for paths ending in .jsonl) or
+        varint length delimited (`source_format="delimited"`).
+        Existing entities are overwritten. Returns the number of entities
+        """
+        return self.store.put_multi(_bulk_entities(source, source_format))
 
     def _insert_model(self, model: ndb.Model) -> None:
         ds_key = model.key._key.to_protobuf()
-        assert self.store.get(ds_key, None) is None
         entity_proto = ndb.model._entity_to_protobuf(model)
-        self.store.put(entity_proto, 0, None)
+        with self.store.lock.write():
+            assert self.store.get(ds_key, None) is None
+            self.store.put(entity_proto, 0, None)
 
     def _lookup(
         self, request: types.LookupRequest, *args, **kwargs
     ) -> types.LookupResponse:
+        # Keys are all read from the same version of the store
+        with self.store.lock.read():
+            return self._lookup_keys(request)
+
+    def _lookup_keys(self, request: types.LookupRequest) -> types.LookupResponse:
         found: List[types.EntityResult] = []
         missing: List[types.EntityResult] = []
         transaction_id = request.read_options.transaction
@@ -76,13 +255,11 @@ class LocalDatastoreStub(datastore_pb2_grpc.DatastoreStub):
     def _begin_transaction(
         self, request: types.BeginTransactionRequest, *args, **kwargs
     ) -> types.BeginTransactionResponse:
-        transaction_mode = None
-        request_type = request.transaction_options.WhichOneof("mode")
-        if request_type == "read_write":
-            transaction_mode = _TransactionType.READ_WRITE
-        elif request_type == "read_only":
+        # Like in production, transactions are read-write unless asked for
+        # otherwise
+        transaction_mode = _TransactionType.READ_WRITE
+        if request.transaction_options.WhichOneof("mode") == "read_only":
             transaction_mode = _TransactionType.READ_ONLY
-        assert transaction_mode is not None
         transaction_id = self.store.beginTransaction(transaction_mode)
 
         return types.BeginTransactionResponse(
@@ -106,8 +283,113 @@ class LocalDatastoreStub(datastore_pb2_grpc.DatastoreStub):
         self.store.rollbackTransaction(request.transaction)
         return types.RollbackResponse()
 
+    def _allocate_ids(
+        self, request: types.AllocateIdsRequest, *args, **kwargs
+    ) -> types.AllocateIdsResponse:
+        keys = [types.Key() for _ in request.keys]
+        for key, requested in zip(keys, request.keys):
+            if requested.path[-1].WhichOneof("id_type") is not None:
+                raise _RpcError(
+                    grpc.StatusCode.INVALID_ARGUMENT,
+                    "Key path element must not be complete.",
+                )
+            key.CopyFrom(requested)
+        self.store.allocate_ids(keys)
+        return types.AllocateIdsResponse(keys=keys)
+
+    def _reserve_ids(
+        self, request: types.ReserveIdsRequest, *args, **kwargs
+    ) -> types.ReserveIdsResponse:
+        if any(key.path[-1].WhichOneof("id_type") is None for key in request.keys):
+            raise _RpcError(
+                grpc.StatusCode.INVALID_ARGUMENT,
+                "Key path element must not be incomplete.",
+            )
+        self.store.reserve_ids(request.keys)
+        return types.ReserveIdsResponse()
+
     def _run_query(
         self, request: types.RunQueryRequest, *args, **kwargs
+    ) -> types.RunQueryResponse:
+        response, _ = self._profiled_query(request, self.explain)
+        return response
+
+    def explain_query(
+        self, request: types.RunQueryRequest
+    ) -> Tuple[types.RunQueryResponse, QueryExplanation]:
+        """
+        Runs a query, and explains how it ran. The explanation is recorded
+        like with `explain`
+        """
+        response, explanation = self._profiled_query(request, True)
+        assert explanation is not None
+        return response, explanation
+
+    @property
+    def explanations(self) -> List[QueryExplanation]:
+        """
+        Explanations of the latest queries that were explained
+        """
+        return self._explainer.recent()
+
+    def expensive_queries(
+        self, n: int = 10, by: str = "entities_scanned"
+    ) -> List[QueryShapeStats]:
+        """
+        Totals for the `n` most expensive shapes of the queries explained so
+        far, by any QueryShapeStats field (ex: "elapsed")
+        """
+        return self._explainer.most_expensive(n, by)
+
+    def clear_explanations(self) -> None:
+        self._explainer.clear()
+
+    def _profiled_query(
+        self, request: types.RunQueryRequest, explain: bool
+    ) -> Tuple[types.RunQueryResponse, Optional[QueryExplanation]]:
+        start = time.perf_counter()
+        profile = _QueryProfile()
+        response = self._cached_query(request, profile)
+        self._metrics.note(query_entities_scanned=profile.scanned)
+        if not explain:
+            return response, None
+
+        explanation = _explain(
+            request.query,
+            profile,
+            len(response.batch.entity_results),
+            time.perf_counter() - start,
+        )
+        self._explainer.record(explanation)
+        return response, explanation
+
+    def _cached_query(
+        self, request: types.RunQueryRequest, profile: _QueryProfile
+    ) -> types.RunQueryResponse:
+        # Transactions read from snapshots and record what they read, so
+        # their queries always run
+        if not self.query_cache.enabled or request.read_options.transaction:
+            return self._execute_query(request, profile)
+
+        kind = request.query.kind[0].name if request.query.kind else None
+        seqid = self.store.kind_seqid(self._partition_id(request), kind)
+        cache_key = request.SerializeToString(deterministic=True)
+        response = self.query_cache.get(cache_key, seqid)
+        if response is None:
+            response = self._execute_query(request, profile)
+            self.query_cache.put(cache_key, seqid, response)
+        return response
+
+    def _execute_query(
+        self, request: types.RunQueryRequest, profile: _QueryProfile
+    ) -> types.RunQueryResponse:
+        # Entities are streamed out of the store's indexes, which mustn't
+        # change in the meantime
+        with self.store.lock.read():
+            return self._query_entities(request, profile)
+
+    def _query_entities(
+        self, request: types.RunQueryRequest, profile: _QueryProfile
     ) -> types.RunQueryResponse:
         # Don't support cloud sql
         # TODO also figire out error handling
@@ -116,39 +398,91 @@ class LocalDatastoreStub(datastore_pb2_grpc.DatastoreStub):
         # Query processing will be very naive.
         query: types.Query = request.query
         transaction_id: bytes = request.read_options.transaction
-        resp_data: List[_StoredObject] = []
-        for _, stored in self.store.items(transaction_id):
-            if query.kind and stored.entity.key.path[-1].kind != query.kind[0].name:
+        plan = self._query_planner.plan(query)
+
+        # Results are sorted by their position in the query's order (key
+        # order when unordered), and cursors encode those positions
+        orders = plan.orders
+        start_position = None
+        if query.start_cursor:
+            start_position = _decode_cursor(query.start_cursor, orders)
+        end_position = None
+        if query.end_cursor:
+            end_position = _decode_cursor(query.end_cursor, orders)
+
+        filtered, in_order = self._filtered_entities(
+            self._partition_id(request), plan, transaction_id, start_position, profile
+        )
+        # When entities come in the query's order, the scan can stop once it
+        # found enough results. One extra tells whether more are left
+        scan_limit = None
+        if in_order and query.HasField("limit"):
+            scan_limit = query.offset + query.limit.value + 1
+        if in_order and self.max_batch_size is not None:
+            batch_limit = query.offset + self.max_batch_size + 1
+            scan_limit = min(scan_limit or batch_limit, batch_limit)
+
+        candidates: List[Tuple[_Position, _StoredObject]] = []
+        results_after_end_cursor = False
+        for stored in filtered:
+            position = _result_position(stored, orders)
+            if position is None:
+                continue
+            if start_position is not None and position <= start_position:
                 continue
+            if end_position is not None and position > end_position:
+                results_after_end_cursor = True
+                if in_order:
+                    break
+                continue
+            candidates.append((position, stored))
+            if len(candidates) == scan_limit:
+                break
 
-            if self._matches_filter(stored, query.filter):
-                resp_data.append(stored)
+        num_results = len(candidates)
+        offset_end = min(query.offset, num_results)
+        limit_end = num_results
+        if query.HasField("limit"):
+            limit_end = min(offset_end + query.limit.value, num_results)
+        batch_end = limit_end
+        if self.max_batch_size is not None:
+            batch_end = min(offset_end + self.max_batch_size, limit_end)
+
+        # Only the first batch_end results are needed. When that's a small
+        # part of the matches, a heap selects them in O(n log k). Entities
+        # that came in the query's order are sorted already
+        if in_order:
+            positioned = candidates[:batch_end]
+        elif batch_end < num_results // self._TOP_K_MAX_FRACTION:
+            profile.sort = _HEAP
+            positioned = heapq.nsmallest(batch_end, candidates, key=lambda r: r[0])
+        else:
+            profile.sort = _SORT
+            positioned = sorted(candidates, key=lambda r: r[0])[:batch_end]
+
+        skipped_results = offset_end
+        resp_data = [stored for _, stored in positioned[offset_end:batch_end]]
+        if resp_data:
+            end_cursor = _encode_cursor(resp_data[-1].entity, orders)
+        elif skipped_results:
+            end_cursor = _encode_cursor(positioned[offset_end - 1][1].entity, orders)
+        else:
+            end_cursor = query.start_cursor
 
-        if query.order:
-            # TODO
-            assert len(query.order) == 1
-            order = query.order[0]
-            assert order.direction in [
-                types.PropertyOrder.Direction.DESCENDING,
-                types.PropertyOrder.Direction.ASCENDING,
-            ]
-            resp_data.sort(
-                key=lambda d: ds_helpers._get_value_from_value_pb(
-                    d.entity.properties.get(order.property.name)
-                ),
-                reverse=order.direction == types.PropertyOrder.Direction.DESCENDING,
+        if batch_end < limit_end:
+            more_results = types.QueryResultBatch.MoreResultsType.NOT_FINISHED
+        elif limit_end < num_results:
+            more_results = (
+                types.QueryResultBatch.MoreResultsType.MORE_RESULTS_AFTER_LIMIT
             )
+        elif results_after_end_cursor:
+            more_results = (
+                types.QueryResultBatch.MoreResultsType.MORE_RESULTS_AFTER_CURSOR
+            )
+        else:
+            more_results = types.QueryResultBatch.MoreResultsType.NO_MORE_RESULTS
 
-        original_length = len(resp_data)
-        skipped_results = 0
-        results_after_limit = 0
-
-        # Handle offset
-        resp_data = resp_data[query.offset :]
-        skipped_results = original_length - len(resp_data)
-
-        if query.HasField("limit"):
-            resp_data = resp_data[: query.limit.value]
+        self.store.record_reads(transaction_id, (r.key_sort_key() for r in resp_data))
 
         if query.projection:
             projection_fields = [p.property.name for p in query.projection]
@@ -156,7 +490,9 @@ class LocalDatastoreStub(datastore_pb2_grpc.DatastoreStub):
                 result_type = types.EntityResult.ResultType.KEY_ONLY
                 entity_results = [
                     types.EntityResult(
-                        entity=types.Entity(key=resp.entity.key), version=resp.version
+                        entity=types.Entity(key=resp.entity.key),
+                        version=resp.version,
+                        cursor=_encode_cursor(resp.entity, orders),
                     )
                     for resp in resp_data
                 ]
@@ -173,108 +509,229 @@ class LocalDatastoreStub(datastore_pb2_grpc.DatastoreStub):
                             },
                         ),
                         version=resp.version,
+                        cursor=_encode_cursor(resp.entity, orders),
                     )
                     for resp in resp_data
                 ]
         else:
             result_type = types.EntityResult.ResultType.FULL
             entity_results = [
-                types.EntityResult(entity=resp.entity, version=resp.version)
+                types.EntityResult(
+                    entity=resp.entity,
+                    version=resp.version,
+                    cursor=_encode_cursor(resp.entity, orders),
+                )
                 for resp in resp_data
             ]
 
-        if results_after_limit > 0:
-            more_results = (
-                types.QueryResultBatch.MoreResultsType.MORE_RESULTS_AFTER_LIMIT
-            )
-        else:
-            more_results = types.QueryResultBatch.MoreResultsType.NO_MORE_RESULTS
-
         return types.RunQueryResponse(
             batch=types.QueryResultBatch(
                 skipped_results=skipped_results,
+                skipped_cursor=end_cursor if skipped_results else b"",
                 more_results=more_results,
                 entity_result_type=result_type,
                 entity_results=entity_results,
+                end_cursor=end_cursor,
                 snapshot_version=self.store.seqid(transaction_id),
             )
         )
 
-    def _matches_filter(
-        self, stored_obj: _StoredObject, query_filter: types.Filter
-    ) -> bool:
-        filter_type = query_filter.WhichOneof("filter_type")
-        if filter_type is None:
-            # If doing a query for all entities, filter will be None
-            return True
-
-        assert filter_type in ["property_filter", "composite_filter"]
-        if filter_type == "property_filter":
-            return self._matches_property_filter(
-                stored_obj, query_filter.property_filter
-            )
-        elif filter_type == "composite_filter":
-            return self._matches_composite_filter(
-                stored_obj, query_filter.composite_filter
+    @staticmethod
+    def _partition_id(request: types.RunQueryRequest) -> _PartitionId:
+        # Queries only see the namespace they run in. Its project defaults to
+        # the request's
+        return (
+            request.partition_id.project_id or request.project_id,
+            request.partition_id.namespace_id,
+        )
+
+    def _filtered_entities(
+        self,
+        partition_id: _PartitionId,
+        plan: _QueryPlan,
+        transaction_id: bytes,
+        start_position: Optional[_Position],
+        profile: _QueryProfile,
+    ) -> Tuple[Iterable[_StoredObject], bool]:
+        # Returns the entities matching the plan's filters, and whether they
+        # are in the query's order
+        kind = plan.kind
+        # Indexes only hold the latest data, which transactions can't see
+        # once something was written after they began
+        use_indexes = self.store.reads_latest(transaction_id)
+
+        if plan.shape is not None:
+            shape = plan.shape
+            composite_index = self.store.composite_index(partition_id, shape)
+            if composite_index is None and _needs_composite_index(shape):
+                profile.recommended_index = _recommended_index(shape)
+                if self.require_indexes:
+                    raise _RpcError(
+                        grpc.StatusCode.FAILED_PRECONDITION,
+                        "no matching index found. recommended index is:\n"
+                        + profile.recommended_index,
+                    )
+            if composite_index is not None and use_indexes:
+                # Composite indexes return entities in the query's order,
+                # unless a repeated property's values are cut by an inequality
+                # or an equality filter. The query's order could then pick a
+                # value outside of the index range, so those get sorted
+                in_order = shape.inequality is None and not any(
+                    name in shape.equalities for name, _ in plan.orders
+                )
+                after = start_position if in_order else None
+                residual = plan.composite_residual
+                profile.strategy = _COMPOSITE_INDEX
+                profile.index = _describe_index(composite_index.definition)
+                profile.indexed_filters = [
+                    f.prop_filter for f in plan.filters if f.matches not in residual
+                ]
+                return (
+                    self._scan(
+                        self.store.composite_items(
+                            partition_id, composite_index, shape, after
+                        ),
+                        residual,
+                        profile,
+                    ),
+                    in_order,
+                )
+
+        # Entities are kept in key order, so __key__ and ancestor filters
+        # are served by scanning a range of keys. Key ordered queries can
+        # start that scan right after their start cursor. Transactions read
+        # their snapshot this way too
+        key_intervals = [plan.key_interval or (None, None)]
+        if plan.key_ordered and start_position is not None:
+            key_intervals.append(((start_position[-1], False), None))
+        lower, upper = _intersect_intervals(key_intervals)
+
+        # Serve the most selective of the key range, the property indexes
+        # and the index of the property the query is ordered by, and check
+        # the remaining filters against each candidate, smallest index first
+        indexed_filters = [f for f in plan.filters if f.indexable]
+        if kind is None or not use_indexes:
+            return self._key_range_entities(
+                partition_id,
+                plan,
+                transaction_id,
+                indexed_filters,
+                lower,
+                upper,
+                profile,
             )
-        return False
-
-    def _matches_composite_filter(
-        self, stored_obj: _StoredObject, comp_filter: types.CompositeFilter
-    ) -> bool:
-        assert comp_filter.op == types.CompositeFilter.Operator.AND
-        results = [self._matches_filter(stored_obj, f) for f in comp_filter.filters]
-        return all(results)
-
-    def _matches_property_filter(
-        self, stored_obj: _StoredObject, prop_filter: types.PropertyFilter
-    ) -> bool:
-        op = prop_filter.op
-        name = prop_filter.property.name
-        filter_val = ds_helpers._get_value_from_value_pb(prop_filter.value)
-
-        # Handle ancestor queries. Only supports a single level for now
-        if op == types.PropertyFilter.Operator.HAS_ANCESTOR:
-            assert (
-                name == "__key__"
-                and prop_filter.value.WhichOneof("value_type") == "key_value"
+
+        indexed_filters.sort(
+            key=lambda f: self.store.index_size(partition_id, kind, f.prop_filter)
+        )
+        key_range_size = self.store.key_range_size(partition_id, kind, lower, upper)
+        index_size = (
+            self.store.index_size(partition_id, kind, indexed_filters[0].prop_filter)
+            if indexed_filters
+            else key_range_size
+        )
+        if plan.ordered_property is not None:
+            name, descending = plan.ordered_property
+            # Entities are ordered by their smallest value ascending, and their
+            # largest descending, which can be outside of the filters' interval.
+            # Only its far end bounds the scan
+            order_lower, order_upper = plan.order_interval
+            bound = order_lower if descending else order_upper
+            ordered_size = self.store.ordered_index_size(
+                partition_id,
+                kind,
+                name,
+                *((bound, None) if descending else (None, bound))
             )
-            assert len(prop_filter.value.key_value.path) == 1
-            return (
-                prop_filter.value.key_value.path[0] in stored_obj.entity.key.path[:-1]
+            # Scanning in order stops once the batch is full, and resumes at
+            # the start cursor, while the other candidates all get sorted
+            if ordered_size <= self._ORDERED_SCAN_MAX_RATIO * min(
+                key_range_size, index_size
+            ):
+                after = None
+                if start_position is not None:
+                    value = start_position[0]
+                    after = (
+                        value.sort_key if descending else value,
+                        start_position[-1],
+                    )
+                residual = [f.matches for f in plan.filters]
+                profile.strategy = _ORDERED_INDEX
+                profile.index = name
+                return (
+                    self._scan(
+                        self.store.ordered_items(
+                            partition_id, kind, name, descending, after, bound
+                        ),
+                        residual,
+                        profile,
+                    ),
+                    True,
+                )
+
+        if not indexed_filters or key_range_size <= index_size:
+            return self._key_range_entities(
+                partition_id,
+                plan,
+                transaction_id,
+                indexed_filters,
+                lower,
+                upper,
+                profile,
             )
 
-        # If the field we're looking for doesn't exist on this model, bail
-        if name not in stored_obj.entity.properties:
-            return False
-
-        # Otherwise, compare the field against the value in the filter
-        prop_val_pb = stored_obj.entity.properties[name]
-        prop_val = ds_helpers._get_value_from_value_pb(prop_val_pb)
-        method_name = self._OPERATOR_TO_CMP_METHOD_NAME.get(op)
-        assert method_name
-
-        prop_type = prop_val_pb.WhichOneof("value_type")
-        if prop_type == "array_value":
-            # For repeated properties, we need to unpack them
-            res = any(getattr(p, method_name)(filter_val) is True for p in prop_val)
-        elif filter_val is None:
-            # Need to mimic python2 comparisons, where None is smaller than anything
-            if op == types.PropertyFilter.Operator.GREATER_THAN_OR_EQUAL:
-                res = True
-            elif op == types.PropertyFilter.Operator.LESS_THAN_OR_EQUAL:
-                res = prop_val is None
-            elif op == types.PropertyFilter.Operator.LESS_THAN:
-                res = False
-            elif op == types.PropertyFilter.Operator.GREATER_THAN:
-                res = prop_val is not None
-            elif op == types.PropertyFilter.Operator.EQUAL:
-                res = prop_val is None
-            else:
-                res = False
-        else:
-            res = getattr(prop_val, method_name)(filter_val)
+        best = indexed_filters[0]
+        residual = [f.matches for f in plan.filters if not f.indexable] + [
+            f.matches for f in indexed_filters[1:]
+        ]
+        profile.strategy = _PROPERTY_INDEX
+        profile.index = best.prop_filter.property.name
+        profile.indexed_filters = [best.prop_filter]
+        return (
+            self._scan(
+                self.store.indexed_items(partition_id, kind, best.prop_filter),
+                residual,
+                profile,
+            ),
+            False,
+        )
+
+    def _key_range_entities(
+        self,
+        partition_id: _PartitionId,
+        plan: _QueryPlan,
+        transaction_id: bytes,
+        indexed_filters: List[_CompiledFilter],
+        lower: _Bound,
+        upper: _Bound,
+        profile: _QueryProfile,
+    ) -> Tuple[Iterable[_StoredObject], bool]:
+        residual = [
+            f.matches
+            for f in plan.filters
+            if not f.indexable and f.key_interval is None
+        ] + [f.matches for f in indexed_filters]
+        profile.strategy = _KEY_RANGE
+        profile.indexed_filters = [
+            f.prop_filter for f in plan.filters if f.key_interval is not None
+        ]
+        return (
+            self._scan(
+                self.store.items(partition_id, transaction_id, plan.kind, lower, upper),
+                residual,
+                profile,
+            ),
+            plan.key_ordered,
+        )
 
-        if res is NotImplemented:
-            return False
-        return res
+    @staticmethod
+    def _scan(
+        items: Iterable[Tuple[Any, _StoredObject]],
+        residual: List[_Predicate],
+        profile: _QueryProfile,
+    ) -> Iterator[_StoredObject]:
+        for _, stored in items:
+            profile.scanned += 1
+            if all(matches(stored) for matches in residual):
+                profile.matched += 1
+                yield stored
@@ -1,9 +1,11 @@
+import concurrent.futures
 import grpc
 
 
 class InstantFuture(grpc.Future):
-    def __init__(self, resp):
+    def __init__(self, resp, exception=None):
         self.resp = resp
+        self._exception = exception
 
     def cancel(self):
         return False
@@ -18,13 +20,64 @@ class InstantFuture(grpc.Future):
         return True
 
     def result(self, timeout=None):
+        if self._exception is not None:
+            raise self._exception
         return self.resp
 
     def exception(self, timeout=None):
-        return None
+        return self._exception
 
     def traceback(self, timeout=None):
+        if self._exception is not None:
+            return self._exception.__traceback__
         return None
 
     def add_done_callback(self, fn):
         fn(self)
+
+
+class ExecutorFuture(grpc.Future):
+    """
+    A grpc.Future for a call running on a concurrent.futures executor, so
+    callers see calls that are actually pending, like over a real channel
+    """
+
+    def __init__(self, future):
+        self._future = future
+
+    def cancel(self):
+        return self._future.cancel()
+
+    def cancelled(self):
+        return self._future.cancelled()
+
+    def running(self):
+        return self._future.running()
+
+    def done(self):
+        return self._future.done()
+
+    def result(self, timeout=None):
+        try:
+            return self._future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            raise grpc.FutureTimeoutError()
+        except concurrent.futures.CancelledError:
+            raise grpc.FutureCancelledError()
+
+    def exception(self, timeout=None):
+        try:
+            return self._future.exception(timeout)
+        except concurrent.futures.TimeoutError:
+            raise grpc.FutureTimeoutError()
+        except concurrent.futures.CancelledError:
+            raise grpc.FutureCancelledError()
+
+    def traceback(self, timeout=None):
+        exception = self.exception(timeout)
+        if exception is not None:
+            return exception.__traceback__
+        return None
+
+    def add_done_callback(self, fn):
+        self._future.add_done_callback(lambda _: fn(self))
@@ -0,0 +1,139 @@
+import threading
+import time
+from google.cloud.datastore_v1 import types
+from typing import Any, Callable, Dict, Hashable, List, Optional, Union
+
+# A latency in seconds, or a function drawing one from a distribution
+_Latency = Union[float, Callable[[], float]]
+
+
+def _sample(latency: Optional[_Latency]) -> float:
+    if latency is None:
+        return 0.0
+    value = latency() if callable(latency) else latency
+    return max(value, 0.0)
+
+
+class LatencyModel(object):
+    """
+    Makes stub calls take as long as they would against Datastore.
+
+    `latency` maps method names (ex: "Lookup") to the fixed or sampled time
+    every call takes, and `per_entity` to the extra time per key looked up,
+    mutation committed or query result returned.
+
+    With `entity_group_writes_per_second`, commits writing to an entity group
+    faster than that are delayed until the group can take another write.
+    Production only sustains about 1 write per second per entity group.
+
+    `clock` and `sleep` can be replaced to simulate time instead of
+    spending it
+    """
+
+    latency: Dict[str, _Latency]
+    per_entity: Dict[str, _Latency]
+    entity_group_writes_per_second: Optional[float]
+    clock: Callable[[], float]
+    sleep: Callable[[float], Any]
+    _lock: threading.Lock
+    # When each entity group was last allowed a write
+    _group_writes: Dict[Hashable, float]
+
+    def __init__(
+        self,
+        latency: Optional[Dict[str, _Latency]] = None,
+        per_entity: Optional[Dict[str, _Latency]] = None,
+        entity_group_writes_per_second: Optional[float] = None,
+        clock: Callable[[], float] = time.monotonic,
+        sleep: Callable[[float], Any] = time.sleep,
+    ) -> None:
+        self.latency = latency or {}
+        self.per_entity = per_entity or {}
+        self.entity_group_writes_per_second = entity_group_writes_per_second
+        self.clock = clock
+        self.sleep = sleep
+        self._lock = threading.Lock()
+        self._group_writes = {}
+
+    def before_call(self, method: str, request: Any) -> None:
+        delay = self.throttle_delay(method, request)
+        if delay > 0:
+            self.sleep(delay)
+
+    def after_call(self, method: str, request: Any, response: Any) -> None:
+        delay = self.call_latency(method, request, response)
+        if delay > 0:
+            self.sleep(delay)
+
+    def call_latency(self, method: str, request: Any, response: Any) -> float:
+        # response is None when the call failed
+        latency = _sample(self.latency.get(method))
+        per_entity = self.per_entity.get(method)
+        if per_entity is not None:
+            for _ in range(self._entity_count(method, request, response)):
+                latency += _sample(per_entity)
+        return latency
+
+    def throttle_delay(self, method: str, request: Any) -> float:
+        # How long a commit has to wait for its entity groups to take
+        # another write. The write is booked for when that wait is over
+        if method != "Commit" or not self.entity_group_writes_per_second:
+            return 0.0
+        groups = _entity_groups(request.mutations)
+        if not groups:
+            return 0.0
+
+        interval = 1.0 / self.entity_group_writes_per_second
+        with self._lock:
+            now = self.clock()
+            allowed_at = max(
+                [now]
+                + [
+                    self._group_writes[group] + interval
+                    for group in groups
+                    if group in self._group_writes
+                ]
+            )
+            for group in groups:
+                self._group_writes[group] = allowed_at
+        return allowed_at - now
+
+    @staticmethod
+    def _entity_count(method: str, request: Any, response: Any) -> int:
+        if method == "Lookup":
+            return len(request.keys)
+        elif method == "Commit":
+            return len(request.mutations)
+        elif method == "RunQuery" and response is not None:
+            return len(response.batch.entity_results)
+        return 0
+
+
+def _entity_groups(mutations: List[types.Mutation]) -> List[Hashable]:
+    # Entity groups are identified by their root key. Inserts with an
+    # incomplete root key start a new group each
+    groups = []
+    for mutation in mutations:
+        operation = mutation.WhichOneof("operation")
+        if operation is None:
+            continue
+        key = (
+            mutation.delete
+            if operation == "delete"
+            else getattr(mutation, operation).key
+        )
+        if not key.path:
+            continue
+        root = key.path[0]
+        root_id = root.WhichOneof("id_type")
+        if root_id is None:
+            continue
+        groups.append(
+            (
+                key.partition_id.project_id,
+                key.partition_id.namespace_id,
+                root.kind,
+                getattr(root, root_id),
+            )
+        )
+    return list(dict.fromkeys(groups))
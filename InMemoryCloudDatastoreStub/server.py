@@ -0,0 +1,137 @@
+"""
+Serves a LocalDatastoreStub as a Datastore gRPC service, so several
+processes can share one in-memory store. Clients connect to it like to the
+Datastore emulator, by setting DATASTORE_EMULATOR_HOST:
+
+    $ python -m InMemoryCloudDatastoreStub.server --port 8081
+    $ DATASTORE_EMULATOR_HOST=localhost:8081 pytest
+"""
+
+import argparse
+import grpc
+import sys
+from concurrent import futures
+from google.cloud.datastore_v1.proto import datastore_pb2_grpc
+from typing import Any, Callable, List, Optional, Tuple
+
+from .datastore_stub import LocalDatastoreStub
+
+
+class _DatastoreServicer(datastore_pb2_grpc.DatastoreServicer):
+    def __init__(self, stub: LocalDatastoreStub) -> None:
+        self.stub = stub
+
+    def Lookup(self, request: Any, context: grpc.ServicerContext) -> Any:
+        return self._call(self.stub.Lookup, request, context)
+
+    def RunQuery(self, request: Any, context: grpc.ServicerContext) -> Any:
+        return self._call(self.stub.RunQuery, request, context)
+
+    def BeginTransaction(self, request: Any, context: grpc.ServicerContext) -> Any:
+        return self._call(self.stub.BeginTransaction, request, context)
+
+    def Commit(self, request: Any, context: grpc.ServicerContext) -> Any:
+        return self._call(self.stub.Commit, request, context)
+
+    def Rollback(self, request: Any, context: grpc.ServicerContext) -> Any:
+        return self._call(self.stub.Rollback, request, context)
+
+    def AllocateIds(self, request: Any, context: grpc.ServicerContext) -> Any:
+        return self._call(self.stub.AllocateIds, request, context)
+
+    def ReserveIds(self, request: Any, context: grpc.ServicerContext) -> Any:
+        return self._call(self.stub.ReserveIds, request, context)
+
+    @staticmethod
+    def _call(
+        method: Callable[[Any], Any], request: Any, context: grpc.ServicerContext
+    ) -> Any:
+        # The stub raises errors the way a channel would, they're sent back
+        # to the client with the same status
+        try:
+            return method(request)
+        except grpc.RpcError as e:
+            if not isinstance(e, grpc.Call):
+                raise
+            context.abort(e.code(), e.details())
+
+
+def serve(
+    stub: LocalDatastoreStub,
+    port: int = 8081,
+    host: str = "localhost",
+    max_workers: int = 16,
+) -> Tuple[grpc.Server, int]:
+    """
+    Starts serving the stub on a pool of `max_workers` threads. Returns the
+    running server and its port, port 0 picks a free one
+    """
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=max_workers))
+    datastore_pb2_grpc.add_DatastoreServicer_to_server(_DatastoreServicer(stub), server)
+    bound_port = server.add_insecure_port(f"{host}:{port}")
+    if not bound_port:
+        raise OSError(f"Can't listen on {host}:{port}")
+    server.start()
+    return server, bound_port
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(
+        prog="python -m InMemoryCloudDatastoreStub.server",
+        description="Serve an in-memory Datastore over gRPC",
+    )
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument(
+        "--max-workers", type=int, default=16, help="Threads serving requests"
+    )
+    parser.add_argument("--index-yaml", help="Composite indexes to load")
+    parser.add_argument(
+        "--require-indexes",
+        action="store_true",
+        help="Fail queries that need a missing composite index",
+    )
+    parser.add_argument("--max-batch-size", type=int)
+    parser.add_argument(
+        "--scattered-ids",
+        action="store_true",
+        help="Allocate IDs spread out like production, instead of sequentially",
+    )
+    parser.add_argument(
+        "--entity-storage",
+        choices=["objects", "serialized", "compressed"],
+        default="objects",
+        help="Keep entities parsed, or serialized to save memory",
+    )
+    parser.add_argument("--snapshot", help="Snapshot file to load the data from")
+    parser.add_argument(
+        "--bulk-load",
+        action="append",
+        default=[],
+        metavar="PATH",
+        help="Entities to load, as .jsonl or varint delimited protos",
+    )
+    args = parser.parse_args(argv)
+
+    stub = LocalDatastoreStub(
+        index_yaml=args.index_yaml,
+        require_indexes=args.require_indexes,
+        max_batch_size=args.max_batch_size,
+        scattered_ids=args.scattered_ids,
+        entity_storage=args.entity_storage,
+    )
+    if args.snapshot:
+        stub.store.load_snapshot(args.snapshot)
+    for path in args.bulk_load:
+        stub.bulk_load(path)
+
+    server, port = serve(stub, args.port, args.host, args.max_workers)
+    print(f"DATASTORE_EMULATOR_HOST={args.host}:{port}", flush=True)
+    try:
+        server.wait_for_termination()
+    except KeyboardInterrupt:
+        server.stop(grace=None)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,442 @@
+"""
+Times LocalDatastoreStub calls against stores of growing sizes, both
+directly and through ndb, and writes the results as JSON so they can be
+compared between commits:
+
+    $ python -m benchmarks.run --sizes 1000,100000 --output bench.json
+"""
+
+import argparse
+import datetime
+import fnmatch
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+from contextlib import contextmanager
+from google.cloud import ndb
+from google.cloud.datastore_v1 import types
+from google.cloud.ndb import _datastore_api
+from typing import Any, Callable, Dict, Iterator, List, NamedTuple, Optional
+
+from InMemoryCloudDatastoreStub.datastore_stub import LocalDatastoreStub
+
+_PROJECT = "datastore-stub-bench"
+_KIND = "BenchEntity"
+_PARENT_KIND = "BenchParent"
+# Entities are spread over this many categories, and each parent has about
+# this many children
+_CATEGORIES = 100
+_CHILDREN = 10
+# Keys looked up, entities written and results fetched per call
+_BATCH = 100
+
+_DEFAULT_SIZES = "1000,100000,1000000"
+
+
+class BenchEntity(ndb.Model):
+    category = ndb.StringProperty()
+    value = ndb.IntegerProperty()
+    label = ndb.StringProperty()
+
+
+class _Result(NamedTuple):
+    benchmark: str
+    entities: int
+    rounds: int
+    min: float
+    median: float
+    mean: float
+    max: float
+    stdev: float
+
+
+class _Bench(object):
+    """
+    The store a round of benchmarks runs against
+    """
+
+    stub: LocalDatastoreStub
+    size: int
+
+    def __init__(self, size: int, entity_storage: str = "objects") -> None:
+        self.stub = LocalDatastoreStub(entity_storage=entity_storage)
+        self.size = size
+        self.stub.store.put_multi(_entity(i, size) for i in range(size))
+        # Keys written in each round are new, so inserts never collide
+        self._next_id = size + 1
+
+    def new_ids(self, count: int) -> List[int]:
+        ids = list(range(self._next_id, self._next_id + count))
+        self._next_id += count
+        return ids
+
+
+def _parent_count(size: int) -> int:
+    return max(size // _CHILDREN, 1)
+
+
+def _key(entity_id: int, size: int) -> types.Key:
+    return types.Key(
+        partition_id=types.PartitionId(project_id=_PROJECT),
+        path=[
+            types.Key.PathElement(
+                kind=_PARENT_KIND, id=entity_id % _parent_count(size) + 1
+            ),
+            types.Key.PathElement(kind=_KIND, id=entity_id),
+        ],
+    )
+
+
+def _entity(i: int, size: int) -> types.Entity:
+    entity_id = i + 1
+    return types.Entity(
+        key=_key(entity_id, size),
+        properties={
+            "category": types.Value(string_value=f"c{i % _CATEGORIES}"),
+            "value": types.Value(integer_value=(i * 7919) % size),
+            "label": types.Value(string_value=f"label{i}"),
+        },
+    )
+
+
+def _ndb_key(entity_id: int, size: int) -> ndb.Key:
+    return ndb.Key(_PARENT_KIND, entity_id % _parent_count(size) + 1, _KIND, entity_id)
+
+
+def _query(**kwargs: Any) -> types.RunQueryRequest:
+    return types.RunQueryRequest(
+        partition_id=types.PartitionId(project_id=_PROJECT),
+        query=types.Query(kind=[types.KindExpression(name=_KIND)], **kwargs),
+    )
+
+
+def _property_filter(name: str, op: int, value: types.Value) -> types.Filter:
+    return types.Filter(
+        property_filter=types.PropertyFilter(
+            property=types.PropertyReference(name=name), op=op, value=value
+        )
+    )
+
+
+def _lookup(bench: _Bench) -> Callable[[], Any]:
+    step = max(bench.size // _BATCH, 1)
+    keys = [_key(i, bench.size) for i in range(1, bench.size + 1, step)][:_BATCH]
+    request = types.LookupRequest(project_id=_PROJECT, keys=keys)
+    return lambda: bench.stub.Lookup(request)
+
+
+def _commit_insert(bench: _Bench) -> Callable[[], Any]:
+    def run() -> None:
+        mutations = [
+            types.Mutation(insert=_entity(entity_id - 1, bench.size))
+            for entity_id in bench.new_ids(_BATCH)
+        ]
+        bench.stub.Commit(types.CommitRequest(project_id=_PROJECT, mutations=mutations))
+
+    return run
+
+
+def _commit_upsert(bench: _Bench) -> Callable[[], Any]:
+    mutations = [
+        types.Mutation(upsert=_entity(i, bench.size))
+        for i in range(min(_BATCH, bench.size))
+    ]
+    request = types.CommitRequest(project_id=_PROJECT, mutations=mutations)
+    return lambda: bench.stub.Commit(request)
+
+
+def _query_filtered(bench: _Bench) -> Callable[[], Any]:
+    request = _query(
+        filter=_property_filter(
+            "category",
+            types.PropertyFilter.Operator.EQUAL,
+            types.Value(string_value="c7"),
+        ),
+        limit={"value": _BATCH},
+    )
+    return lambda: bench.stub.RunQuery(request)
+
+
+def _query_range(bench: _Bench) -> Callable[[], Any]:
+    # An inequality matching 1% of the entities, returned in full
+    request = _query(
+        filter=_property_filter(
+            "value",
+            types.PropertyFilter.Operator.LESS_THAN,
+            types.Value(integer_value=bench.size // 100),
+        )
+    )
+    return lambda: bench.stub.RunQuery(request)
+
+
+def _query_ordered(bench: _Bench) -> Callable[[], Any]:
+    request = _query(
+        order=[
+            types.PropertyOrder(
+                property=types.PropertyReference(name="value"),
+                direction=types.PropertyOrder.Direction.DESCENDING,
+            )
+        ],
+        limit={"value": _BATCH},
+    )
+    return lambda: bench.stub.RunQuery(request)
+
+
+def _query_ancestor(bench: _Bench) -> Callable[[], Any]:
+    parent = types.Key(
+        partition_id=types.PartitionId(project_id=_PROJECT),
+        path=[types.Key.PathElement(kind=_PARENT_KIND, id=1)],
+    )
+    request = _query(
+        filter=_property_filter(
+            "__key__",
+            types.PropertyFilter.Operator.HAS_ANCESTOR,
+            types.Value(key_value=parent),
+        )
+    )
+    return lambda: bench.stub.RunQuery(request)
+
+
+def _query_projection(bench: _Bench) -> Callable[[], Any]:
+    request = _query(
+        projection=[types.Projection(property=types.PropertyReference(name="value"))],
+        filter=_property_filter(
+            "category",
+            types.PropertyFilter.Operator.EQUAL,
+            types.Value(string_value="c7"),
+        ),
+        limit={"value": _BATCH},
+    )
+    return lambda: bench.stub.RunQuery(request)
+
+
+def _query_keys_only(bench: _Bench) -> Callable[[], Any]:
+    request = _query(
+        projection=[types.Projection(property=types.PropertyReference(name="__key__"))],
+        limit={"value": _BATCH},
+    )
+    return lambda: bench.stub.RunQuery(request)
+
+
+def _transaction(bench: _Bench) -> Callable[[], Any]:
+    # Read-modify-write of one entity
+    entity = _entity(0, bench.size)
+    lookup = types.LookupRequest(project_id=_PROJECT, keys=[entity.key])
+
+    def run() -> None:
+        transaction = bench.stub.BeginTransaction(
+            types.BeginTransactionRequest(project_id=_PROJECT)
+        ).transaction
+        lookup.read_options.transaction = transaction
+        bench.stub.Lookup(lookup)
+        bench.stub.Commit(
+            types.CommitRequest(
+                project_id=_PROJECT,
+                transaction=transaction,
+                mutations=[types.Mutation(upsert=entity)],
+            )
+        )
+
+    return run
+
+
+def _ndb_get_multi(bench: _Bench) -> Callable[[], Any]:
+    step = max(bench.size // _BATCH, 1)
+    keys = [_ndb_key(i, bench.size) for i in range(1, bench.size + 1, step)][:_BATCH]
+    return lambda: ndb.get_multi(keys)
+
+
+def _ndb_put_multi(bench: _Bench) -> Callable[[], Any]:
+    def run() -> None:
+        ndb.put_multi(
+            [
+                BenchEntity(
+                    key=_ndb_key(entity_id, bench.size),
+                    category="c0",
+                    value=entity_id,
+                    label="new",
+                )
+                for entity_id in bench.new_ids(_BATCH)
+            ]
+        )
+
+    return run
+
+
+def _ndb_query(bench: _Bench) -> Callable[[], Any]:
+    query = BenchEntity.query(BenchEntity.category == "c7").order(-BenchEntity.value)
+    return lambda: query.fetch(_BATCH)
+
+
+def _ndb_transaction(bench: _Bench) -> Callable[[], Any]:
+    key = _ndb_key(1, bench.size)
+
+    def increment() -> None:
+        entity = key.get()
+        entity.value += 1
+        entity.put()
+
+    return lambda: ndb.transaction(increment)
+
+
+class _Benchmark(NamedTuple):
+    name: str
+    setup: Callable[[_Bench], Callable[[], Any]]
+    # Whether it needs an ndb context
+    uses_ndb: bool = False
+
+
+_BENCHMARKS = [
+    _Benchmark("lookup", _lookup),
+    _Benchmark("commit_insert", _commit_insert),
+    _Benchmark("commit_upsert", _commit_upsert),
+    _Benchmark("query_filtered", _query_filtered),
+    _Benchmark("query_range", _query_range),
+    _Benchmark("query_ordered", _query_ordered),
+    _Benchmark("query_ancestor", _query_ancestor),
+    _Benchmark("query_projection", _query_projection),
+    _Benchmark("query_keys_only", _query_keys_only),
+    _Benchmark("transaction", _transaction),
+    _Benchmark("ndb_get_multi", _ndb_get_multi, True),
+    _Benchmark("ndb_put_multi", _ndb_put_multi, True),
+    _Benchmark("ndb_query", _ndb_query, True),
+    _Benchmark("ndb_transaction", _ndb_transaction, True),
+]
+
+
+@contextmanager
+def _ndb_context(stub: LocalDatastoreStub) -> Iterator[None]:
+    # Like the tests, ndb is pointed at the stub instead of a channel. Its
+    # caches are off, so every call reaches the stub
+    os.environ.setdefault("DATASTORE_EMULATOR_HOST", "localhost")
+    original_stub = _datastore_api.stub
+    _datastore_api.stub = lambda: stub
+    try:
+        client = ndb.Client(project=_PROJECT)
+        with client.context(cache_policy=False, global_cache_policy=False):
+            yield
+    finally:
+        _datastore_api.stub = original_stub
+
+
+def _time(run: Callable[[], Any], rounds: int) -> List[float]:
+    run()
+    timings = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        run()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def _result(name: str, size: int, timings: List[float]) -> _Result:
+    return _Result(
+        benchmark=name,
+        entities=size,
+        rounds=len(timings),
+        min=min(timings),
+        median=statistics.median(timings),
+        mean=statistics.mean(timings),
+        max=max(timings),
+        stdev=statistics.stdev(timings) if len(timings) > 1 else 0.0,
+    )
+
+
+def run_benchmarks(
+    sizes: List[int],
+    rounds: int = 20,
+    patterns: Optional[List[str]] = None,
+    report: Callable[[_Result], Any] = lambda result: None,
+    entity_storage: str = "objects",
+) -> List[_Result]:
+    """
+    Runs the benchmarks whose names match any of `patterns` (all by
+    default) at every store size, with stores holding entities as
+    `entity_storage`. The time to load each store is reported as the
+    "load" benchmark
+    """
+    benchmarks = [
+        b
+        for b in _BENCHMARKS
+        if not patterns or any(fnmatch.fnmatch(b.name, p) for p in patterns)
+    ]
+    results = []
+    for size in sizes:
+        start = time.perf_counter()
+        bench = _Bench(size, entity_storage)
+        results.append(_result("load", size, [time.perf_counter() - start]))
+        report(results[-1])
+
+        for benchmark in benchmarks:
+            if benchmark.uses_ndb:
+                with _ndb_context(bench.stub):
+                    timings = _time(benchmark.setup(bench), rounds)
+            else:
+                timings = _time(benchmark.setup(bench), rounds)
+            results.append(_result(benchmark.name, size, timings))
+            report(results[-1])
+    return results
+
+
+def _print_result(result: _Result) -> None:
+    print(
+        f"{result.benchmark:<20} {result.entities:>9} entities  "
+        f"median {result.median * 1000:10.3f} ms  "
+        f"min {result.min * 1000:10.3f} ms",
+        file=sys.stderr,
+        flush=True,
+    )
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks.run",
+        description="Benchmark LocalDatastoreStub",
+    )
+    parser.add_argument(
+        "--sizes",
+        default=_DEFAULT_SIZES,
+        help=f"Comma separated store sizes (default: {_DEFAULT_SIZES})",
+    )
+    parser.add_argument("--rounds", type=int, default=20, help="Timed calls per size")
+    parser.add_argument(
+        "-k",
+        dest="patterns",
+        action="append",
+        metavar="PATTERN",
+        help="Only run benchmarks matching this glob, can be repeated",
+    )
+    parser.add_argument(
+        "--entity-storage",
+        choices=["objects", "serialized", "compressed"],
+        default="objects",
+        help="How the stub holds entities (default: objects)",
+    )
+    parser.add_argument("--output", help="JSON file to write, stdout by default")
+    args = parser.parse_args(argv)
+
+    sizes = [int(size) for size in args.sizes.split(",")]
+    started_at = datetime.datetime.now(datetime.timezone.utc)
+    results = run_benchmarks(
+        sizes, args.rounds, args.patterns, _print_result, args.entity_storage
+    )
+    report: Dict[str, Any] = {
+        "started_at": started_at.isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "entity_storage": args.entity_storage,
+        "results": [result._asdict() for result in results],
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -10,7 +10,8 @@ setuptools.setup(
     long_description=long_description,
     long_description_content_type="text/markdown",
     url="https://github.com/phil-lopreiato/google-cloud-datastore-stub/",
-    packages=setuptools.find_packages(),
+    packages=setuptools.find_packages(exclude=["benchmarks"]),
     python_requires=">=3",
     install_requires=["google-cloud-ndb > 1.2.1"],
+    extras_require={"yaml": ["PyYAML"]},
 )
@@ -0,0 +1,107 @@
+import grpc
+import pytest
+from google.cloud import ndb
+from google.cloud.datastore_v1 import types
+from InMemoryCloudDatastoreStub import datastore_stub
+from InMemoryCloudDatastoreStub._id_allocator import (
+    _MAX_SEQUENTIAL_ID,
+    _scattered_counter,
+    _scattered_id,
+)
+from tests.models import ChildModel, SimpleModel
+
+
+def _incomplete_key(kind: str, *parent: object) -> types.Key:
+    key = ndb.Key(*parent, kind, None) if parent else ndb.Key(kind, None)
+    return key._key.to_protobuf()
+
+
+def test_allocate_ids(ndb_stub: datastore_stub.LocalDatastoreStub) -> None:
+    keys = SimpleModel.allocate_ids(size=1000)
+    assert [k.id() for k in keys] == list(range(1, 1001))
+
+    # Allocated IDs aren't handed out again, even once written
+    ndb.put_multi([SimpleModel(key=k, int_prop=1) for k in keys[:10]])
+    key = SimpleModel(int_prop=2).put()
+    assert key.id() == 1001
+
+
+def test_allocate_ids_per_kind_and_parent(
+    ndb_stub: datastore_stub.LocalDatastoreStub,
+) -> None:
+    assert SimpleModel(int_prop=1).put().id() == 1
+    assert ChildModel(str_prop="a").put().id() == 1
+    parent = ndb.Key(SimpleModel, 1)
+    children = [ChildModel(parent=parent, str_prop=str(i)) for i in range(3)]
+    assert [k.id() for k in ndb.put_multi(children)] == [1, 2, 3]
+    other = ChildModel(parent=ndb.Key(SimpleModel, 2), str_prop="b")
+    assert other.put().id() == 1
+    assert ChildModel(str_prop="c").put().id() == 2
+
+
+def test_reserve_ids(ndb_stub: datastore_stub.LocalDatastoreStub) -> None:
+    reserved = types.Key()
+    reserved.CopyFrom(_incomplete_key("SimpleModel"))
+    reserved.path[-1].id = 5
+    ndb_stub.ReserveIds(types.ReserveIdsRequest(keys=[reserved]))
+
+    resp = ndb_stub.AllocateIds(
+        types.AllocateIdsRequest(keys=[_incomplete_key("SimpleModel")] * 2)
+    )
+    assert [k.path[-1].id for k in resp.keys] == [6, 7]
+    # Other kinds are unaffected
+    assert ChildModel(str_prop="a").put().id() == 1
+
+
+def test_allocate_and_reserve_ids_errors(
+    ndb_stub: datastore_stub.LocalDatastoreStub,
+) -> None:
+    complete = ndb.Key(SimpleModel, 1)._key.to_protobuf()
+    with pytest.raises(grpc.RpcError) as e:
+        ndb_stub.AllocateIds(types.AllocateIdsRequest(keys=[complete]))
+    assert e.value.code() == grpc.StatusCode.INVALID_ARGUMENT
+
+    with pytest.raises(grpc.RpcError) as e:
+        ndb_stub.ReserveIds(
+            types.ReserveIdsRequest(keys=[_incomplete_key("SimpleModel")])
+        )
+    assert e.value.code() == grpc.StatusCode.INVALID_ARGUMENT
+
+
+def test_scattered_ids(ndb_stub: datastore_stub.LocalDatastoreStub) -> None:
+    stub = datastore_stub.LocalDatastoreStub(scattered_ids=True)
+    resp = stub.AllocateIds(
+        types.AllocateIdsRequest(keys=[_incomplete_key("SimpleModel")] * 100)
+    )
+    ids = [k.path[-1].id for k in resp.keys]
+    assert len(set(ids)) == 100
+    assert all(_MAX_SEQUENTIAL_ID < i < 2**63 for i in ids)
+    assert ids != sorted(ids)
+    assert [_scattered_counter(i) for i in ids] == list(range(1, 101))
+    assert _scattered_id(1) == ids[0]
+
+    # Reserving a scattered ID skips every ID scattered before it
+    reserved = types.Key()
+    reserved.CopyFrom(_incomplete_key("SimpleModel"))
+    reserved.path[-1].id = _scattered_id(200)
+    stub.ReserveIds(types.ReserveIdsRequest(keys=[reserved]))
+    resp = stub.AllocateIds(
+        types.AllocateIdsRequest(keys=[_incomplete_key("SimpleModel")])
+    )
+    assert resp.keys[0].path[-1].id == _scattered_id(201)
+
+
+def test_snapshot_keeps_allocated_ids(
+    ndb_stub: datastore_stub.LocalDatastoreStub, tmp_path: object
+) -> None:
+    SimpleModel.allocate_ids(size=10)
+    ChildModel(str_prop="a").put()
+    path = str(tmp_path / "data.snap")  # type: ignore
+    ndb_stub.store.save_snapshot(path)
+
+    stub = datastore_stub.LocalDatastoreStub(scattered_ids=False)
+    stub.store.load_snapshot(path)
+    resp = stub.AllocateIds(
+        types.AllocateIdsRequest(keys=[_incomplete_key("SimpleModel")])
+    )
+    assert resp.keys[0].path[-1].id == 11
@@ -0,0 +1,74 @@
+import grpc
+import pytest
+import threading
+from concurrent import futures
+from google.cloud import ndb
+from google.cloud.datastore_v1 import types
+from typing import Any, Iterator, List
+from InMemoryCloudDatastoreStub import datastore_stub
+from tests.models import SimpleModel
+
+
+@pytest.fixture()
+def executor(
+    ndb_stub: datastore_stub.LocalDatastoreStub,
+) -> Iterator[futures.ThreadPoolExecutor]:
+    with futures.ThreadPoolExecutor(max_workers=4) as executor:
+        ndb_stub.executor = executor
+        yield executor
+        ndb_stub.executor = None
+
+
+def test_ndb_with_executor(executor: futures.ThreadPoolExecutor) -> None:
+    keys = ndb.put_multi([SimpleModel(id=f"test{i}", int_prop=i) for i in range(10)])
+    ndb.get_context().clear_cache()
+
+    assert [m.int_prop for m in ndb.get_multi(keys)] == list(range(10))
+    resp = SimpleModel.query(SimpleModel.int_prop >= 5).order(SimpleModel.int_prop)
+    assert [m.int_prop for m in resp.fetch()] == [5, 6, 7, 8, 9]
+
+    @ndb.transactional()
+    def increment() -> None:
+        model = SimpleModel.get_by_id("test0")
+        model.int_prop += 1
+        model.put()
+
+    increment()
+    assert SimpleModel.get_by_id("test0").int_prop == 1
+
+
+def test_futures_are_pending_until_run(
+    ndb_stub: datastore_stub.LocalDatastoreStub,
+) -> None:
+    release = threading.Event()
+    with futures.ThreadPoolExecutor(max_workers=1) as executor:
+        ndb_stub.executor = executor
+        executor.submit(release.wait)
+        key = ndb.Key(SimpleModel, "test")._key.to_protobuf()
+
+        first = ndb_stub.Lookup.future(types.LookupRequest(keys=[key]))
+        second = ndb_stub.Lookup.future(types.LookupRequest(keys=[key]))
+        done: List[Any] = []
+        first.add_done_callback(done.append)
+        assert not first.done()
+        with pytest.raises(grpc.FutureTimeoutError):
+            first.result(timeout=0.01)
+
+        assert second.cancel()
+        release.set()
+        assert len(first.result(timeout=5).missing) == 1
+        assert done == [first]
+        assert second.cancelled()
+        with pytest.raises(grpc.FutureCancelledError):
+            second.result()
+
+
+def test_future_exceptions(executor: futures.ThreadPoolExecutor) -> None:
+    ndb_stub = datastore_stub.LocalDatastoreStub(executor=executor)
+    future = ndb_stub.Commit.future(types.CommitRequest(transaction=b"expired"))
+
+    assert isinstance(future.exception(timeout=5), grpc.RpcError)
+    with pytest.raises(grpc.RpcError) as e:
+        future.result()
+    assert e.value.code() == grpc.StatusCode.INVALID_ARGUMENT
+    assert future.traceback() is not None
@@ -0,0 +1,19 @@
+from benchmarks.run import run_benchmarks
+
+
+def test_benchmarks_run() -> None:
+    # ndb benchmarks open their own context, which the tests already have
+    results = run_benchmarks([50], rounds=2, patterns=["lookup", "commit_*", "query_*"])
+    assert [r.benchmark for r in results] == [
+        "load",
+        "lookup",
+        "commit_insert",
+        "commit_upsert",
+        "query_filtered",
+        "query_range",
+        "query_ordered",
+        "query_ancestor",
+        "query_projection",
+        "query_keys_only",
+    ]
+    assert all(r.entities == 50 and r.min <= r.median <= r.max for r in results)
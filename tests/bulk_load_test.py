@@ -0,0 +1,118 @@
+import io
+import pytest
+from typing import Any
+from google.cloud import ndb
+from google.protobuf import json_format
+from InMemoryCloudDatastoreStub import datastore_stub
+from tests.models import ChildModel, SimpleModel
+
+
+def _delimited(messages: Any) -> bytes:
+    stream = b""
+    for message in messages:
+        serialized = message.SerializeToString()
+        assert len(serialized) < 128
+        stream += bytes([len(serialized)]) + serialized
+    return stream
+
+
+def test_bulk_load_models(ndb_stub: datastore_stub.LocalDatastoreStub) -> None:
+    SimpleModel(id="test0", int_prop=100).put()
+    seqid = ndb_stub.store.seqid(None)
+
+    models = [SimpleModel(id=f"test{i}", int_prop=i) for i in range(10)]
+    entities = [
+        ndb.model._entity_to_protobuf(ChildModel(id=f"child{i}", str_prop=f"{i}"))
+        for i in range(3)
+    ]
+    assert ndb_stub.bulk_load(models + entities) == 13
+    assert ndb_stub.store.seqid(None) == seqid + 1
+    ndb.get_context().clear_cache()
+
+    assert SimpleModel.get_by_id("test0").int_prop == 0
+    resp = SimpleModel.query(SimpleModel.int_prop >= 7).fetch()
+    assert [m.int_prop for m in resp] == [7, 8, 9]
+    resp = ChildModel.query(ChildModel.str_prop == "1").fetch()
+    assert [m.key.id() for m in resp] == ["child1"]
+    assert SimpleModel.query().count() == 10
+
+
+def test_bulk_load_incomplete_keys(
+    ndb_stub: datastore_stub.LocalDatastoreStub,
+) -> None:
+    ndb_stub.bulk_load([SimpleModel(int_prop=i) for i in range(3)])
+
+    resp = SimpleModel.query().order(SimpleModel.int_prop).fetch()
+    assert [m.int_prop for m in resp] == [0, 1, 2]
+    assert len({m.key.id() for m in resp}) == 3
+
+
+def test_bulk_load_numeric_ids(ndb_stub: datastore_stub.LocalDatastoreStub) -> None:
+    ndb_stub.bulk_load([SimpleModel(id=i, int_prop=i) for i in range(1, 4)])
+
+    # Allocated IDs don't collide with the loaded ones
+    key = SimpleModel(int_prop=10).put()
+    assert key.id() > 3
+    assert SimpleModel.query().count() == 4
+
+
+def test_bulk_load_truncated_stream(
+    ndb_stub: datastore_stub.LocalDatastoreStub,
+) -> None:
+    stream = _delimited(
+        ndb.model._entity_to_protobuf(SimpleModel(id=f"test{i}", int_prop=i))
+        for i in range(2)
+    )
+
+    with pytest.raises(ValueError):
+        ndb_stub.bulk_load(io.BytesIO(stream[:-1]))
+    # Nothing from a failed load is written
+    assert SimpleModel.get_by_id("test0") is None
+    assert SimpleModel.query().fetch() == []
+
+
+def test_bulk_load_jsonl(
+    ndb_stub: datastore_stub.LocalDatastoreStub, tmp_path: Any
+) -> None:
+    path = tmp_path / "entities.jsonl"
+    path.write_text(
+        "\n".join(
+            json_format.MessageToJson(
+                ndb.model._entity_to_protobuf(SimpleModel(id=f"test{i}", int_prop=i)),
+                indent=None,
+            )
+            for i in range(5)
+        )
+    )
+
+    assert ndb_stub.bulk_load(str(path)) == 5
+    resp = SimpleModel.query(SimpleModel.int_prop < 2).fetch()
+    assert [m.int_prop for m in resp] == [0, 1]
+
+
+def test_bulk_load_delimited_stream(
+    ndb_stub: datastore_stub.LocalDatastoreStub,
+) -> None:
+    stream = io.BytesIO(
+        _delimited(
+            ndb.model._entity_to_protobuf(SimpleModel(id=f"test{i}", int_prop=i))
+            for i in range(5)
+        )
+    )
+
+    assert ndb_stub.bulk_load(stream) == 5
+    resp = SimpleModel.query().order(-SimpleModel.int_prop).fetch(2)
+    assert [m.int_prop for m in resp] == [4, 3]
+
+
+def test_bulk_load_can_be_restored(
+    ndb_stub: datastore_stub.LocalDatastoreStub,
+) -> None:
+    SimpleModel(id="test0", int_prop=100).put()
+    checkpoint = ndb_stub.store.checkpoint()
+    ndb_stub.bulk_load([SimpleModel(id=f"test{i}", int_prop=i) for i in range(5)])
+
+    ndb_stub.store.restore(checkpoint)
+    ndb.get_context().clear_cache()
+    assert [m.int_prop for m in SimpleModel.query().fetch()] == [100]
+    assert SimpleModel.query(SimpleModel.int_prop == 0).fetch() == []
@@ -0,0 +1,49 @@
+import pytest
+from typing import Any
+from google.cloud import ndb
+from InMemoryCloudDatastoreStub import datastore_stub
+from tests.models import SimpleModel
+
+
+def test_restore_checkpoint(ndb_stub: datastore_stub.LocalDatastoreStub) -> None:
+    ndb.put_multi([SimpleModel(id=f"test{i}", int_prop=i) for i in range(5)])
+    checkpoint = ndb_stub.store.checkpoint()
+
+    SimpleModel(id="test0", int_prop=10).put()
+    SimpleModel(id="test0", int_prop=20).put()
+    ndb.Key(SimpleModel, "test1").delete()
+    SimpleModel(id="test5", int_prop=5).put()
+    nested = ndb_stub.store.checkpoint()
+    SimpleModel(id="test6", int_prop=6).put()
+
+    ndb_stub.store.restore(nested)
+    ndb.get_context().clear_cache()
+    assert SimpleModel.get_by_id("test6") is None
+    assert SimpleModel.get_by_id("test5").int_prop == 5
+
+    ndb_stub.store.restore(checkpoint)
+    ndb.get_context().clear_cache()
+    resp = SimpleModel.query(SimpleModel.int_prop >= 0).order(SimpleModel.int_prop)
+    assert [m.int_prop for m in resp.fetch()] == [0, 1, 2, 3, 4]
+    assert [m.key.id() for m in SimpleModel.query().fetch()] == [
+        f"test{i}" for i in range(5)
+    ]
+
+    # Checkpoints taken after the restored one are gone, it can be reused
+    with pytest.raises(ValueError):
+        ndb_stub.store.restore(nested)
+    SimpleModel(id="test7", int_prop=7).put()
+    ndb_stub.store.restore(checkpoint)
+    assert SimpleModel.query().count() == 5
+
+
+def test_restore_after_snapshot_load_fails(
+    ndb_stub: datastore_stub.LocalDatastoreStub, tmp_path: Any
+) -> None:
+    checkpoint = ndb_stub.store.checkpoint()
+    snapshot = str(tmp_path / "snapshot")
+    ndb_stub.store.save_snapshot(snapshot)
+    ndb_stub.store.load_snapshot(snapshot)
+
+    with pytest.raises(ValueError):
+        ndb_stub.store.restore(checkpoint)
@@ -0,0 +1,112 @@
+import threading
+import pytest
+from concurrent import futures
+from google.cloud import ndb
+from google.cloud.datastore_v1 import types
+from typing import List
+from InMemoryCloudDatastoreStub import datastore_stub
+from InMemoryCloudDatastoreStub._rwlock import _ReadWriteLock
+from tests.models import SimpleModel
+
+
+def _insert_request(int_prop: int) -> types.CommitRequest:
+    entity = ndb.model._entity_to_protobuf(SimpleModel(int_prop=int_prop))
+    return types.CommitRequest(
+        mode=types.CommitRequest.Mode.NON_TRANSACTIONAL,
+        mutations=[types.Mutation(insert=entity)],
+    )
+
+
+def _count_request() -> types.RunQueryRequest:
+    return types.RunQueryRequest(
+        project_id="datastore-stub-test",
+        query=types.Query(kind=[types.KindExpression(name="SimpleModel")]),
+    )
+
+
+def test_concurrent_inserts_get_unique_ids(
+    ndb_stub: datastore_stub.LocalDatastoreStub,
+) -> None:
+    # Worker threads have no ndb context, so requests are built up front
+    requests = [_insert_request(i) for i in range(200)]
+
+    def insert(request: types.CommitRequest) -> List[int]:
+        resp = ndb_stub.Commit(request)
+        return [r.key.path[-1].id for r in resp.mutation_results]
+
+    with futures.ThreadPoolExecutor(max_workers=8) as executor:
+        ids = [i for result in executor.map(insert, requests) for i in result]
+
+    assert len(set(ids)) == 200
+    assert SimpleModel.query().count() == 200
+    resp = SimpleModel.query(SimpleModel.int_prop >= 0).order(SimpleModel.int_prop)
+    assert [m.int_prop for m in resp.fetch()] == list(range(200))
+
+
+def test_queries_see_whole_commits(
+    ndb_stub: datastore_stub.LocalDatastoreStub,
+) -> None:
+    batch_size = 5
+    batches = [
+        types.CommitRequest(
+            mode=types.CommitRequest.Mode.NON_TRANSACTIONAL,
+            mutations=[
+                m
+                for i in range(batch_size)
+                for m in _insert_request(batch * batch_size + i).mutations
+            ],
+        )
+        for batch in range(20)
+    ]
+    done = threading.Event()
+
+    def write() -> None:
+        try:
+            for request in batches:
+                ndb_stub.Commit(request)
+        finally:
+            done.set()
+
+    def read() -> List[int]:
+        # Bounded, so a failing writer can't keep the readers spinning
+        counts = []
+        while not done.is_set() and len(counts) < 10000:
+            resp = ndb_stub.RunQuery(_count_request())
+            counts.append(len(resp.batch.entity_results))
+        return counts
+
+    with futures.ThreadPoolExecutor(max_workers=4) as executor:
+        readers = [executor.submit(read) for _ in range(3)]
+        executor.submit(write).result(timeout=60)
+        counts = [c for reader in readers for c in reader.result(timeout=60)]
+
+    assert all(c % batch_size == 0 for c in counts)
+
+
+def test_read_write_lock() -> None:
+    lock = _ReadWriteLock()
+    readers_in = threading.Barrier(3)
+    writer_done = threading.Event()
+
+    def read() -> bool:
+        with lock.read():
+            # Every reader holds the lock at once, or this times out
+            readers_in.wait(timeout=5)
+            with lock.read():
+                return not writer_done.is_set()
+
+    def write() -> None:
+        with lock.write():
+            with lock.read():
+                writer_done.set()
+
+    with futures.ThreadPoolExecutor(max_workers=4) as executor:
+        readers = [executor.submit(read) for _ in range(3)]
+        assert all(r.result() for r in readers)
+        executor.submit(write).result()
+    assert writer_done.is_set()
+
+    with lock.read():
+        with pytest.raises(RuntimeError):
+            with lock.write():
+                pass
@@ -0,0 +1,101 @@
+import pytest
+from google.cloud import ndb
+from google.cloud.ndb import _datastore_api
+from _pytest.monkeypatch import MonkeyPatch
+from typing import Any
+from InMemoryCloudDatastoreStub import datastore_stub
+from tests.models import ChildModel, RepeatedPropertyModel, SimpleModel
+
+_PARTITION = ("datastore-stub-test", "")
+
+
+@pytest.fixture(params=["serialized", "compressed"])
+def compact_stub(
+    request: Any, monkeypatch: MonkeyPatch
+) -> datastore_stub.LocalDatastoreStub:
+    stub = datastore_stub.LocalDatastoreStub(entity_storage=request.param)
+    monkeypatch.setattr(_datastore_api, "stub", lambda: stub)
+    return stub
+
+
+def test_compact_storage(compact_stub: datastore_stub.LocalDatastoreStub) -> None:
+    parent = SimpleModel(id="parent", str_prop="parent").put()
+    ndb.put_multi(
+        [SimpleModel(id=f"test{i}", str_prop="a", int_prop=i) for i in range(5)]
+    )
+    ChildModel(id="child", parent=parent, str_prop="child").put()
+    RepeatedPropertyModel(id="repeated", int_props=[1, 5]).put()
+    ndb.get_context().clear_cache()
+
+    assert SimpleModel.get_by_id("test3").int_prop == 3
+    resp = SimpleModel.query(SimpleModel.int_prop >= 3).fetch()
+    assert [m.int_prop for m in resp] == [3, 4]
+    resp = SimpleModel.query(SimpleModel.str_prop == "a").order(-SimpleModel.int_prop)
+    assert [m.int_prop for m in resp.fetch(2)] == [4, 3]
+    query = SimpleModel.query(
+        SimpleModel.str_prop == "a", projection=[SimpleModel.int_prop]
+    )
+    resp = query.fetch()
+    assert sorted(m.int_prop for m in resp) == [0, 1, 2, 3, 4]
+    assert ChildModel.query(ancestor=parent).fetch(keys_only=True) == [
+        ndb.Key(SimpleModel, "parent", ChildModel, "child")
+    ]
+    query = RepeatedPropertyModel.query(RepeatedPropertyModel.int_props == 5)
+    assert query.count() == 1
+
+    @ndb.transactional()
+    def increment() -> None:
+        entity = SimpleModel.get_by_id("test0")
+        entity.int_prop += 10
+        entity.put()
+
+    increment()
+    ndb.get_context().clear_cache()
+    assert SimpleModel.get_by_id("test0").int_prop == 10
+    resp = SimpleModel.query(SimpleModel.int_prop >= 4).fetch()
+    assert sorted(m.int_prop for m in resp) == [4, 10]
+
+    # Nothing parsed is kept around
+    for _, stored in compact_stub.store.items(_PARTITION, b""):
+        assert stored._entity is None
+        assert not hasattr(stored, "__dict__")
+
+
+def test_compressed_storage(monkeypatch: MonkeyPatch) -> None:
+    stub = datastore_stub.LocalDatastoreStub(entity_storage="compressed")
+    monkeypatch.setattr(_datastore_api, "stub", lambda: stub)
+    SimpleModel(id="large", str_prop="a" * 1000).put()
+    SimpleModel(id="small", str_prop="a").put()
+
+    large, small = [stored for _, stored in stub.store.items(_PARTITION, b"")]
+    assert len(large._serialized) < 100 < len(large.serialized())
+    # Compressing small entities would make them larger
+    assert small._serialized == small.serialized()
+    ndb.get_context().clear_cache()
+    assert SimpleModel.get_by_id("large").str_prop == "a" * 1000
+
+
+def test_compact_storage_snapshot(
+    compact_stub: datastore_stub.LocalDatastoreStub, tmp_path: Any
+) -> None:
+    ndb.put_multi(
+        [SimpleModel(id=f"test{i}", str_prop="a" * 200, int_prop=i) for i in range(5)]
+    )
+    snapshot = str(tmp_path / "snapshot")
+    compact_stub.store.save_snapshot(snapshot)
+    saved = [s.entity for _, s in compact_stub.store.items(_PARTITION, b"")]
+
+    # Snapshots are the same whichever way the entities were stored
+    stub = datastore_stub.LocalDatastoreStub()
+    stub.store.load_snapshot(snapshot)
+    compact_stub.store.load_snapshot(snapshot)
+    for loaded in (stub, compact_stub):
+        assert [s.entity for _, s in loaded.store.items(_PARTITION, b"")] == saved
+    ndb.get_context().clear_cache()
+    resp = SimpleModel.query(SimpleModel.int_prop < 2).fetch()
+    assert [m.int_prop for m in resp] == [0, 1]
+
+
+def test_unknown_entity_storage() -> None:
+    with pytest.raises(ValueError):
+        datastore_stub.LocalDatastoreStub(entity_storage="pickled")
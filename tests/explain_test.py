@@ -0,0 +1,132 @@
+from google.cloud import ndb
+from google.cloud.datastore_v1 import types
+from InMemoryCloudDatastoreStub import datastore_stub
+from tests.models import SimpleModel
+
+
+def _put_models() -> None:
+    ndb.put_multi(
+        [
+            SimpleModel(
+                id=f"test{i}", str_prop="even" if i % 2 == 0 else "odd", int_prop=i
+            )
+            for i in range(10)
+        ]
+    )
+
+
+def test_explain_property_index(ndb_stub: datastore_stub.LocalDatastoreStub) -> None:
+    _put_models()
+    ndb_stub.explain = True
+
+    resp = SimpleModel.query(
+        SimpleModel.int_prop >= 3, SimpleModel.str_prop == "even"
+    ).fetch()
+    assert sorted(m.int_prop for m in resp) == [4, 6, 8]
+
+    [explanation] = ndb_stub.explanations
+    assert explanation.kind == "SimpleModel"
+    assert explanation.shape == "SimpleModel WHERE int_prop >= ? AND str_prop = ?"
+    assert explanation.strategy == "property_index"
+    assert explanation.index == "str_prop"
+    assert explanation.indexed_filters == ["str_prop = ?"]
+    assert explanation.scanned_filters == ["int_prop >= ?"]
+    assert explanation.entities_scanned == 5
+    assert explanation.entities_matched == 3
+    assert explanation.results == 3
+    assert explanation.sort == "sort"
+    assert explanation.recommended_index == (
+        "- kind: SimpleModel\n"
+        "  properties:\n"
+        "  - name: str_prop\n"
+        "  - name: int_prop"
+    )
+
+
+def test_explain_ordered_index(ndb_stub: datastore_stub.LocalDatastoreStub) -> None:
+    _put_models()
+    ndb_stub.explain = True
+
+    resp = SimpleModel.query().order(-SimpleModel.int_prop).fetch(2)
+    assert [m.int_prop for m in resp] == [9, 8]
+
+    [explanation] = ndb_stub.explanations
+    assert explanation.shape == "SimpleModel ORDER BY -int_prop"
+    assert explanation.strategy == "ordered_index"
+    assert explanation.index == "int_prop"
+    assert explanation.sort == "index_order"
+    # The scan stops once it knows there are more results
+    assert explanation.entities_scanned == 3
+    assert explanation.recommended_index is None
+
+
+def test_explain_composite_index() -> None:
+    stub = datastore_stub.LocalDatastoreStub(
+        indexes=[
+            {
+                "kind": "SimpleModel",
+                "properties": [{"name": "str_prop"}, {"name": "int_prop"}],
+            }
+        ]
+    )
+    stub.store.put_multi(
+        ndb.model._entity_to_protobuf(SimpleModel(id=f"test{i}", str_prop="a"))
+        for i in range(3)
+    )
+    query = types.Query(
+        kind=[types.KindExpression(name="SimpleModel")],
+        filter=types.Filter(
+            property_filter=types.PropertyFilter(
+                property=types.PropertyReference(name="str_prop"),
+                op=types.PropertyFilter.Operator.EQUAL,
+                value=types.Value(string_value="a"),
+            )
+        ),
+        order=[types.PropertyOrder(property=types.PropertyReference(name="int_prop"))],
+    )
+
+    resp, explanation = stub.explain_query(
+        types.RunQueryRequest(project_id="datastore-stub-test", query=query)
+    )
+    assert len(resp.batch.entity_results) == 3
+    assert explanation.strategy == "composite_index"
+    assert explanation.index == "str_prop, int_prop"
+    assert explanation.indexed_filters == ["str_prop = ?"]
+    assert explanation.scanned_filters == []
+    assert explanation.sort == "index_order"
+    # Queries are only recorded with explain on, or through explain_query
+    assert stub.explanations == [explanation]
+
+
+def test_explain_key_range_and_cache() -> None:
+    stub = datastore_stub.LocalDatastoreStub(explain=True, query_cache_size=10)
+    request = types.RunQueryRequest(
+        query=types.Query(kind=[types.KindExpression(name="SimpleModel")])
+    )
+    stub.RunQuery(request)
+    stub.RunQuery(request)
+    assert [e.strategy for e in stub.explanations] == ["key_range", "result_cache"]
+    assert stub.explanations[1].entities_scanned == 0
+
+    stub.clear_explanations()
+    assert stub.explanations == []
+
+
+def test_expensive_queries(ndb_stub: datastore_stub.LocalDatastoreStub) -> None:
+    _put_models()
+    ndb_stub.explain = True
+
+    for _ in range(2):
+        SimpleModel.query().fetch()
+    SimpleModel.query(SimpleModel.str_prop == "odd").fetch()
+
+    [first, second] = ndb_stub.expensive_queries()
+    assert first.shape == "SimpleModel"
+    assert first.calls == 2
+    assert first.entities_scanned == 20
+    assert first.results == 20
+    assert second.shape == "SimpleModel WHERE str_prop = ?"
+    assert second.entities_scanned == 5
+
+    [most_calls] = ndb_stub.expensive_queries(1, by="calls")
+    assert most_calls.shape == "SimpleModel"
@@ -0,0 +1,164 @@
+import pytest
+from google.api_core import exceptions as core_exceptions
+from google.cloud import ndb
+from google.cloud.datastore_v1.proto import datastore_pb2_grpc
+from google.cloud.ndb import _datastore_api
+from _pytest.monkeypatch import MonkeyPatch
+from typing import Any, Callable, Dict, List
+
+from InMemoryCloudDatastoreStub import datastore_stub
+from tests.models import ChildModel, SimpleModel
+
+SIMPLE_MODEL_INDEX: Dict[str, Any] = {
+    "kind": "SimpleModel",
+    "properties": [
+        {"name": "str_prop"},
+        {"name": "int_prop", "direction": "desc"},
+    ],
+}
+
+_StubFactory = Callable[..., datastore_stub.LocalDatastoreStub]
+
+
+@pytest.fixture()
+def make_stub(monkeypatch: MonkeyPatch) -> _StubFactory:
+    def make(**kwargs: Any) -> datastore_stub.LocalDatastoreStub:
+        stub = datastore_stub.LocalDatastoreStub(**kwargs)
+
+        def mock_stub() -> datastore_pb2_grpc.DatastoreStub:
+            return stub
+
+        monkeypatch.setattr(_datastore_api, "stub", mock_stub)
+        return stub
+
+    return make
+
+
+def _put_models() -> List[SimpleModel]:
+    models = [
+        SimpleModel(id=f"test{i}", str_prop="even" if i % 2 == 0 else "odd", int_prop=i)
+        for i in range(10)
+    ]
+    ndb.put_multi(models)
+    return models
+
+
+def test_composite_index_equality_and_order(make_stub: _StubFactory) -> None:
+    make_stub(indexes=[SIMPLE_MODEL_INDEX])
+    _put_models()
+
+    resp = (
+        SimpleModel.query(SimpleModel.str_prop == "even")
+        .order(-SimpleModel.int_prop)
+        .fetch()
+    )
+    assert [m.int_prop for m in resp] == [8, 6, 4, 2, 0]
+
+
+def test_composite_index_range(make_stub: _StubFactory) -> None:
+    make_stub(indexes=[SIMPLE_MODEL_INDEX])
+    _put_models()
+
+    resp = (
+        SimpleModel.query(
+            SimpleModel.str_prop == "odd",
+            SimpleModel.int_prop > 2,
+            SimpleModel.int_prop <= 7,
+        )
+        .order(-SimpleModel.int_prop)
+        .fetch()
+    )
+    assert [m.int_prop for m in resp] == [7, 5, 3]
+
+
+def test_composite_index_from_yaml(make_stub: _StubFactory, tmp_path: Any) -> None:
+    index_yaml = tmp_path / "index.yaml"
+    index_yaml.write_text("""
+indexes:
+- kind: ChildModel
+  ancestor: yes
+  properties:
+  - name: str_prop
+""")
+    make_stub(index_yaml=str(index_yaml), require_indexes=True)
+
+    parent = SimpleModel(id="parent")
+    parent.put()
+    ndb.put_multi(
+        [
+            ChildModel(id=f"child{i}", parent=parent.key, str_prop=s)
+            for i, s in enumerate("cab")
+        ]
+        + [ChildModel(id="orphan", str_prop="d")]
+    )
+
+    resp = ChildModel.query(ancestor=parent.key).order(ChildModel.str_prop).fetch()
+    assert [m.str_prop for m in resp] == ["a", "b", "c"]
+
+    # Ancestors with the same path in another namespace are different entities
+    other = SimpleModel(id="parent", namespace="other")
+    other.put()
+    ChildModel(parent=other.key, str_prop="e", namespace="other").put()
+    resp = ChildModel.query(ancestor=parent.key).order(ChildModel.str_prop).fetch()
+    assert [m.str_prop for m in resp] == ["a", "b", "c"]
+    resp = (
+        ChildModel.query(ancestor=other.key, namespace="other")
+        .order(ChildModel.str_prop)
+        .fetch()
+    )
+    assert [m.str_prop for m in resp] == ["e"]
+
+
+def test_composite_index_fetch_page(make_stub: _StubFactory) -> None:
+    stub = make_stub(indexes=[SIMPLE_MODEL_INDEX], max_batch_size=2)
+    _put_models()
+    query = SimpleModel.query(SimpleModel.str_prop == "even").order(
+        -SimpleModel.int_prop
+    )
+
+    page, cursor, more = query.fetch_page(3)
+    assert [m.int_prop for m in page] == [8, 6, 4]
+    # Pages resume from the cursor's position in the index
+    stub.store.delete(ndb.Key(SimpleModel, "test6")._key.to_protobuf(), None)
+    page, cursor, more = query.fetch_page(3, start_cursor=cursor)
+    assert [m.int_prop for m in page] == [2, 0]
+    assert not more
+
+
+def test_composite_index_updated_on_write(make_stub: _StubFactory) -> None:
+    make_stub(indexes=[SIMPLE_MODEL_INDEX])
+    models = _put_models()
+    models[0].str_prop = "odd"
+    models[0].put()
+    models[9].key.delete()
+
+    resp = (
+        SimpleModel.query(SimpleModel.str_prop == "odd")
+        .order(-SimpleModel.int_prop)
+        .fetch()
+    )
+    assert [m.int_prop for m in resp] == [7, 5, 3, 1, 0]
+
+
+def test_require_indexes_missing_index(make_stub: _StubFactory) -> None:
+    make_stub(require_indexes=True)
+    _put_models()
+
+    with pytest.raises(core_exceptions.FailedPrecondition) as e:
+        SimpleModel.query(SimpleModel.str_prop == "even").order(
+            -SimpleModel.int_prop
+        ).fetch()
+    assert "- name: int_prop\n    direction: desc" in str(e.value)
+
+
+def test_require_indexes_builtin_index(make_stub: _StubFactory) -> None:
+    make_stub(require_indexes=True)
+    _put_models()
+
+    resp = SimpleModel.query(SimpleModel.int_prop >= 5).order(SimpleModel.int_prop)
+    assert [m.int_prop for m in resp.fetch()] == [5, 6, 7, 8, 9]
+
+    resp = SimpleModel.query(
+        SimpleModel.str_prop == "even", SimpleModel.int_prop == 4
+    ).fetch()
+    assert len(resp) == 1
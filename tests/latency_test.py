@@ -0,0 +1,76 @@
+import pytest
+from concurrent import futures
+from google.cloud import ndb
+from google.cloud.datastore_v1 import types
+from typing import List
+from InMemoryCloudDatastoreStub import datastore_stub
+from InMemoryCloudDatastoreStub.latency import LatencyModel
+from tests.models import ChildModel, SimpleModel
+
+
+class _FakeTime(object):
+    def __init__(self) -> None:
+        self.now = 0.0
+        self.sleeps: List[float] = []
+
+    def clock(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float) -> None:
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+def _upsert(model: ndb.Model) -> types.CommitRequest:
+    return types.CommitRequest(
+        mode=types.CommitRequest.Mode.NON_TRANSACTIONAL,
+        mutations=[types.Mutation(upsert=ndb.model._entity_to_protobuf(model))],
+    )
+
+
+def test_method_and_per_entity_latency(
+    ndb_stub: datastore_stub.LocalDatastoreStub,
+) -> None:
+    fake_time = _FakeTime()
+    ndb_stub.latency_model = LatencyModel(
+        latency={"Lookup": 0.01, "RunQuery": lambda: 0.02},
+        per_entity={"Lookup": 0.001, "RunQuery": 0.002},
+        clock=fake_time.clock,
+        sleep=fake_time.sleep,
+    )
+    ndb_stub.bulk_load([SimpleModel(id=f"test{i}", int_prop=i) for i in range(5)])
+
+    ndb.get_multi([ndb.Key(SimpleModel, f"test{i}") for i in range(3)])
+    assert fake_time.sleeps == [pytest.approx(0.013)]
+    SimpleModel.query(SimpleModel.int_prop >= 1).fetch()
+    assert fake_time.sleeps[1] == pytest.approx(0.028)
+
+
+def test_entity_group_write_throttling(
+    ndb_stub: datastore_stub.LocalDatastoreStub,
+) -> None:
+    fake_time = _FakeTime()
+    ndb_stub.latency_model = LatencyModel(
+        entity_group_writes_per_second=1,
+        clock=fake_time.clock,
+        sleep=fake_time.sleep,
+    )
+    parent = ndb.Key(SimpleModel, "parent")
+
+    for i in range(3):
+        ndb_stub.Commit(_upsert(ChildModel(id=f"child{i}", parent=parent)))
+    ndb_stub.Commit(_upsert(SimpleModel(id="other")))
+    # Writes to the same group are spaced a second apart, others aren't held up
+    assert fake_time.sleeps == [1.0, 1.0]
+    assert fake_time.now == 2.0
+
+
+def test_latency_with_executor(ndb_stub: datastore_stub.LocalDatastoreStub) -> None:
+    ndb_stub.latency_model = LatencyModel(latency={"Lookup": 0.05})
+    key = ndb.Key(SimpleModel, "test")._key.to_protobuf()
+
+    with futures.ThreadPoolExecutor(max_workers=2) as executor:
+        ndb_stub.executor = executor
+        future = ndb_stub.Lookup.future(types.LookupRequest(keys=[key]))
+        assert not future.done()
+        assert len(future.result(timeout=5).missing) == 1
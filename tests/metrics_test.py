@@ -0,0 +1,70 @@
+import grpc
+import pytest
+from google.cloud import ndb
+from google.cloud.datastore_v1 import types
+from typing import List
+from InMemoryCloudDatastoreStub import datastore_stub
+from InMemoryCloudDatastoreStub._metrics import RpcEvent
+from InMemoryCloudDatastoreStub._transactions import _TransactionType
+from tests.models import SimpleModel
+
+
+def test_stats(ndb_stub: datastore_stub.LocalDatastoreStub) -> None:
+    ndb.put_multi([SimpleModel(id=f"test{i}", int_prop=i) for i in range(10)])
+    ndb.get_context().clear_cache()
+    ndb.get_multi([ndb.Key(SimpleModel, f"test{i}") for i in range(3)])
+    resp = SimpleModel.query(SimpleModel.str_prop == None).fetch()  # noqa: E711
+    assert len(resp) == 10
+
+    stats = ndb_stub.stats()
+    assert stats["methods"]["Commit"]["calls"] == 1
+    assert stats["methods"]["Lookup"]["calls"] == 1
+    assert stats["methods"]["RunQuery"]["calls"] == 1
+    latency = stats["methods"]["RunQuery"]["latency"]
+    assert latency["count"] == 1 and latency["buckets"][-1] == (float("inf"), 1)
+    sizes = stats["sizes"]
+    assert sizes["commit_mutations"]["sum"] == 10
+    assert sizes["lookup_keys"]["sum"] == 3
+    assert sizes["query_entities_returned"]["sum"] == 10
+    assert sizes["query_entities_scanned"]["sum"] == 10
+
+    ndb_stub.reset_stats()
+    assert ndb_stub.stats()["methods"] == {}
+
+
+def test_stats_errors_and_aborts(ndb_stub: datastore_stub.LocalDatastoreStub) -> None:
+    SimpleModel(id="test", int_prop=1).put()
+    key = ndb.Key(SimpleModel, "test")._key.to_protobuf()
+    transaction = ndb_stub.store.beginTransaction(_TransactionType.READ_WRITE)
+    ndb_stub.Lookup(
+        types.LookupRequest(
+            keys=[key], read_options=types.ReadOptions(transaction=transaction)
+        )
+    )
+    SimpleModel(id="test", int_prop=2).put()
+
+    with pytest.raises(grpc.RpcError):
+        ndb_stub.Commit(
+            types.CommitRequest(
+                transaction=transaction,
+                mutations=[types.Mutation(delete=key)],
+            )
+        )
+    stats = ndb_stub.stats()
+    assert stats["methods"]["Commit"]["errors"] == {"ABORTED": 1}
+    assert stats["transaction_aborts"] == 1
+
+
+def test_metrics_hook(ndb_stub: datastore_stub.LocalDatastoreStub) -> None:
+    events: List[RpcEvent] = []
+    ndb_stub.metrics_hook = events.append
+
+    SimpleModel(id="test", int_prop=1).put()
+    SimpleModel.query().fetch()
+
+    assert [e.method for e in events] == ["Commit", "RunQuery"]
+    assert all(e.code == grpc.StatusCode.OK and e.seconds >= 0 for e in events)
+    assert events[1].sizes == {
+        "query_entities_scanned": 1,
+        "query_entities_returned": 1,
+    }
@@ -16,3 +16,7 @@ class RepeatedPropertyModel(ndb.Model):
 
 class KeyPropertyModel(ndb.Model):
     model_ref = ndb.KeyProperty(kind=SimpleModel)
+
+
+class GenericPropertyModel(ndb.Model):
+    generic_prop = ndb.GenericProperty()
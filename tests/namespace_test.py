@@ -0,0 +1,99 @@
+import pytest
+from google.cloud import ndb
+from google.cloud.ndb import _datastore_api
+from _pytest.monkeypatch import MonkeyPatch
+from typing import Any
+from InMemoryCloudDatastoreStub import datastore_stub
+from InMemoryCloudDatastoreStub._transactions import _TransactionType
+from tests.models import ChildModel, SimpleModel
+
+
+def _put_models(namespace: str, count: int) -> None:
+    ndb.put_multi(
+        [
+            SimpleModel(id=f"test{i}", namespace=namespace, str_prop="a", int_prop=i)
+            for i in range(count)
+        ]
+    )
+
+
+def _make_stub(
+    monkeypatch: MonkeyPatch, **kwargs: Any
+) -> datastore_stub.LocalDatastoreStub:
+    stub = datastore_stub.LocalDatastoreStub(**kwargs)
+    monkeypatch.setattr(_datastore_api, "stub", lambda: stub)
+    return stub
+
+
+def test_queries_stay_in_their_namespace(
+    ndb_stub: datastore_stub.LocalDatastoreStub,
+) -> None:
+    _put_models("a", 3)
+    _put_models("b", 5)
+    ChildModel(id="child", namespace="b", str_prop="a").put()
+
+    assert SimpleModel.query(namespace="a").count() == 3
+    assert SimpleModel.query(namespace="b").count() == 5
+    assert SimpleModel.query().count() == 0
+    resp = SimpleModel.query(SimpleModel.str_prop == "a", namespace="a").fetch()
+    assert {m.key.namespace() for m in resp} == {"a"}
+    resp = SimpleModel.query(namespace="a").order(-SimpleModel.int_prop).fetch()
+    assert [m.int_prop for m in resp] == [2, 1, 0]
+    assert len(ndb.Query(namespace="b").fetch()) == 6
+
+
+def test_composite_index_per_namespace(monkeypatch: MonkeyPatch) -> None:
+    _make_stub(
+        monkeypatch,
+        indexes=[
+            {
+                "kind": "SimpleModel",
+                "properties": [{"name": "str_prop"}, {"name": "int_prop"}],
+            }
+        ],
+        require_indexes=True,
+    )
+    _put_models("a", 3)
+    _put_models("b", 5)
+
+    query = SimpleModel.query(SimpleModel.str_prop == "a", namespace="b").order(
+        SimpleModel.int_prop
+    )
+    assert [m.int_prop for m in query.fetch()] == [0, 1, 2, 3, 4]
+
+
+def test_query_cache_per_namespace(monkeypatch: MonkeyPatch) -> None:
+    stub = _make_stub(monkeypatch, query_cache_size=10)
+    _put_models("a", 3)
+    assert SimpleModel.query(namespace="a").count() == 3
+    _put_models("b", 1)
+    assert SimpleModel.query(namespace="a").count() == 3
+    assert stub.query_cache.hits == 1
+
+
+def test_ids_per_namespace(ndb_stub: datastore_stub.LocalDatastoreStub) -> None:
+    assert SimpleModel(namespace="a").put().id() == 1
+    assert SimpleModel(namespace="b").put().id() == 1
+    assert SimpleModel(namespace="a").put().id() == 2
+
+
+def test_drop_namespace(ndb_stub: datastore_stub.LocalDatastoreStub) -> None:
+    _put_models("a", 3)
+    _put_models("b", 2)
+    SimpleModel(namespace="a").put()
+    checkpoint = ndb_stub.store.checkpoint()
+
+    ndb_stub.store.drop_namespace("datastore-stub-test", "a")
+    ndb.get_context().clear_cache()
+    assert SimpleModel.query(namespace="a").count() == 0
+    assert SimpleModel.query(namespace="b").count() == 2
+    assert ndb.Key(SimpleModel, "test0", namespace="a").get() is None
+    # The namespace starts over
+    assert SimpleModel(namespace="a").put().id() == 1
+    with pytest.raises(ValueError):
+        ndb_stub.store.restore(checkpoint)
+
+    transaction_id = ndb_stub.store.beginTransaction(_TransactionType.READ_ONLY)
+    with pytest.raises(ValueError):
+        ndb_stub.store.drop_namespace("datastore-stub-test", "b")
+    ndb_stub.store.rollbackTransaction(transaction_id)
@@ -1,7 +1,9 @@
+import datetime
 import pytest
 from InMemoryCloudDatastoreStub import datastore_stub
 from google.cloud import ndb
 from tests.models import (
+    GenericPropertyModel,
     ChildModel,
     RepeatedPropertyModel,
     SimpleModel,
@@ -428,3 +430,391 @@ def test_query_count_async_not_found(
 
     count = SimpleModel.query().filter(SimpleModel.str_prop == "foo").count_async()
     assert count.get_result() == 0
+
+
+def test_query_only_returns_requested_kind() -> None:
+    ndb.put_multi(
+        [SimpleModel(id=f"simple{i}", str_prop="asdf") for i in range(3)]
+        + [ChildModel(id=f"child{i}", str_prop="asdf") for i in range(2)]
+    )
+
+    simple_resp = SimpleModel.query(SimpleModel.str_prop == "asdf").fetch()
+    assert len(simple_resp) == 3
+    assert all(isinstance(m, SimpleModel) for m in simple_resp)
+
+    child_resp = ChildModel.query().fetch()
+    assert len(child_resp) == 2
+    assert all(isinstance(m, ChildModel) for m in child_resp)
+
+
+def test_query_kind_after_delete() -> None:
+    keys = ndb.put_multi([SimpleModel(id=f"test{i}", int_prop=i) for i in range(3)])
+    keys[1].delete()
+
+    resp = SimpleModel.query().order(SimpleModel.int_prop).fetch()
+    assert [m.int_prop for m in resp] == [0, 2]
+
+
+def test_query_after_update_uses_new_value() -> None:
+    model = SimpleModel(id="test", int_prop=10)
+    model.put()
+    model.int_prop = 20
+    model.put()
+
+    assert SimpleModel.query(SimpleModel.int_prop == 10).fetch() == []
+    assert SimpleModel.query(SimpleModel.int_prop == 20).fetch() == [model]
+
+
+def test_query_range_on_repeated_property() -> None:
+    model1 = RepeatedPropertyModel(id="test1", int_props=[1, 5, 9])
+    model2 = RepeatedPropertyModel(id="test2", int_props=[2, 3])
+    ndb.put_multi([model1, model2])
+
+    resp = RepeatedPropertyModel.query(RepeatedPropertyModel.int_props > 4).fetch()
+    assert resp == [model1]
+
+    resp = RepeatedPropertyModel.query(RepeatedPropertyModel.int_props <= 2).fetch()
+    assert len(resp) == 2
+
+
+def test_query_range_and_equality() -> None:
+    ndb.put_multi(
+        [
+            SimpleModel(id=f"test{i}", int_prop=i, str_prop="odd" if i % 2 else "even")
+            for i in range(10)
+        ]
+    )
+
+    resp = (
+        SimpleModel.query(SimpleModel.str_prop == "even", SimpleModel.int_prop > 3)
+        .order(SimpleModel.int_prop)
+        .fetch()
+    )
+    assert [m.int_prop for m in resp] == [4, 6, 8]
+
+
+def test_query_string_range() -> None:
+    ndb.put_multi(
+        [SimpleModel(id=f"test{i}", str_prop=s) for i, s in enumerate("abcde")]
+    )
+
+    resp = SimpleModel.query(SimpleModel.str_prop >= "c").fetch()
+    assert sorted(m.str_prop for m in resp) == ["c", "d", "e"]
+
+
+def test_query_fetch_page() -> None:
+    ndb.put_multi([SimpleModel(id=f"test{i}", int_prop=i) for i in range(10)])
+    query = SimpleModel.query().order(SimpleModel.int_prop)
+
+    page, cursor, more = query.fetch_page(4)
+    assert [m.int_prop for m in page] == [0, 1, 2, 3]
+    assert more
+
+    page, cursor, more = query.fetch_page(4, start_cursor=cursor)
+    assert [m.int_prop for m in page] == [4, 5, 6, 7]
+    assert more
+
+    page, cursor, more = query.fetch_page(4, start_cursor=cursor)
+    assert [m.int_prop for m in page] == [8, 9]
+    assert not more
+
+
+def test_query_fetch_page_descending_with_filter() -> None:
+    ndb.put_multi([SimpleModel(id=f"test{i}", int_prop=i) for i in range(10)])
+    query = SimpleModel.query(SimpleModel.int_prop >= 3).order(-SimpleModel.int_prop)
+
+    page, cursor, more = query.fetch_page(5)
+    assert [m.int_prop for m in page] == [9, 8, 7, 6, 5]
+    assert more
+
+    page, cursor, more = query.fetch_page(5, start_cursor=cursor)
+    assert [m.int_prop for m in page] == [4, 3]
+    assert not more
+
+
+def test_query_end_cursor() -> None:
+    ndb.put_multi([SimpleModel(id=f"test{i}", int_prop=i) for i in range(10)])
+    query = SimpleModel.query().order(SimpleModel.int_prop)
+    _, cursor, _ = query.fetch_page(3)
+
+    resp = query.fetch(end_cursor=cursor)
+    assert [m.int_prop for m in resp] == [0, 1, 2]
+
+
+def test_query_in_batches(ndb_stub: datastore_stub.LocalDatastoreStub) -> None:
+    ndb_stub.max_batch_size = 3
+    ndb.put_multi([SimpleModel(id=f"test{i}", int_prop=i) for i in range(10)])
+
+    resp = SimpleModel.query().order(SimpleModel.int_prop).fetch()
+    assert [m.int_prop for m in resp] == list(range(10))
+
+    resp = SimpleModel.query().order(SimpleModel.int_prop).fetch(offset=2, limit=5)
+    assert [m.int_prop for m in resp] == [2, 3, 4, 5, 6]
+
+    assert SimpleModel.query().count() == 10
+
+
+def test_query_multiple_orders() -> None:
+    ndb.put_multi(
+        [SimpleModel(id=f"test{i}", str_prop=f"{i % 3}", int_prop=i) for i in range(9)]
+    )
+
+    resp = SimpleModel.query().order(SimpleModel.str_prop, -SimpleModel.int_prop)
+    assert [(m.str_prop, m.int_prop) for m in resp.fetch()] == [
+        ("0", 6),
+        ("0", 3),
+        ("0", 0),
+        ("1", 7),
+        ("1", 4),
+        ("1", 1),
+        ("2", 8),
+        ("2", 5),
+        ("2", 2),
+    ]
+
+
+def test_query_order_with_limit() -> None:
+    ndb.put_multi(
+        [SimpleModel(id=f"test{i}", int_prop=(i * 7) % 100) for i in range(100)]
+    )
+
+    resp = SimpleModel.query().order(-SimpleModel.int_prop).fetch(5)
+    assert [m.int_prop for m in resp] == [99, 98, 97, 96, 95]
+
+    resp = SimpleModel.query().order(SimpleModel.int_prop).fetch(3, offset=10)
+    assert [m.int_prop for m in resp] == [10, 11, 12]
+
+
+def test_query_order_mixed_types() -> None:
+    ndb.put_multi(
+        [
+            GenericPropertyModel(id="string", generic_prop="a"),
+            GenericPropertyModel(id="float", generic_prop=1.5),
+            GenericPropertyModel(id="int", generic_prop=2),
+            GenericPropertyModel(id="none", generic_prop=None),
+            GenericPropertyModel(id="bool", generic_prop=True),
+            GenericPropertyModel(
+                id="timestamp", generic_prop=datetime.datetime(1970, 1, 1, 0, 0, 0, 3)
+            ),
+            GenericPropertyModel(id="big_int", generic_prop=5),
+        ]
+    )
+
+    # Timestamps sort among integers, as microseconds since the epoch
+    resp = GenericPropertyModel.query().order(GenericPropertyModel.generic_prop)
+    assert [m.key.id() for m in resp.fetch()] == [
+        "none",
+        "int",
+        "timestamp",
+        "big_int",
+        "bool",
+        "string",
+        "float",
+    ]
+
+
+def test_query_order_by_repeated_property() -> None:
+    ndb.put_multi(
+        [
+            RepeatedPropertyModel(id="a", int_props=[5, 1]),
+            RepeatedPropertyModel(id="b", int_props=[3]),
+            RepeatedPropertyModel(id="c", int_props=[2, 9]),
+        ]
+    )
+
+    # Ascending uses each entity's smallest value, descending its largest
+    resp = RepeatedPropertyModel.query().order(RepeatedPropertyModel.int_props)
+    assert [m.key.id() for m in resp.fetch()] == ["a", "c", "b"]
+    resp = RepeatedPropertyModel.query().order(-RepeatedPropertyModel.int_props)
+    assert [m.key.id() for m in resp.fetch()] == ["c", "a", "b"]
+
+
+def test_query_fetch_page_resumes_ordered_scan(
+    ndb_stub: datastore_stub.LocalDatastoreStub,
+) -> None:
+    ndb.put_multi(
+        [
+            RepeatedPropertyModel(id=f"test{i}", int_props=[i // 2, 100 - i])
+            for i in range(100)
+        ]
+    )
+    scanned = []
+    ordered_items = ndb_stub.store.ordered_items
+
+    def counting_ordered_items(*args, **kwargs):
+        for item in ordered_items(*args, **kwargs):
+            scanned.append(item)
+            yield item
+
+    ndb_stub.store.ordered_items = counting_ordered_items
+    query = RepeatedPropertyModel.query(RepeatedPropertyModel.int_props < 50).order(
+        -RepeatedPropertyModel.int_props
+    )
+
+    # Descending queries use each entity's largest value, ties in key order
+    expected = sorted(range(100), key=lambda i: (-max(i // 2, 100 - i), f"test{i}"))
+    expected = [i for i in expected if i // 2 < 50 or 100 - i < 50]
+    ids, cursor, more = [], None, True
+    while more:
+        del scanned[:]
+        page, cursor, more = query.fetch_page(10, start_cursor=cursor)
+        ids.extend(int(m.key.id()[4:]) for m in page)
+        # Each page starts at its cursor and stops after the next result
+        assert 0 < len(scanned) <= 11
+    assert ids == expected
+
+
+def test_query_plans_are_reused(ndb_stub: datastore_stub.LocalDatastoreStub) -> None:
+    ndb.put_multi([SimpleModel(id=f"test{i}", int_prop=i) for i in range(10)])
+    query = SimpleModel.query(SimpleModel.int_prop >= 3).order(SimpleModel.int_prop)
+
+    page, cursor, _ = query.fetch_page(2)
+    assert [m.int_prop for m in page] == [3, 4]
+    page, _, _ = query.fetch_page(2, start_cursor=cursor)
+    assert [m.int_prop for m in page] == [5, 6]
+    assert [m.int_prop for m in query.fetch(3, offset=4)] == [7, 8, 9]
+    assert len(ndb_stub._query_planner) == 1
+
+    # Plans stay valid as the data changes
+    SimpleModel(id="test10", int_prop=10).put()
+    assert [m.int_prop for m in query.fetch(offset=6)] == [9, 10]
+    assert len(ndb_stub._query_planner) == 1
+
+
+def test_query_plan_cache_evicts_least_recently_used(
+    ndb_stub: datastore_stub.LocalDatastoreStub,
+) -> None:
+    ndb_stub._query_planner.cache_size = 2
+    ndb.put_multi([SimpleModel(id=f"test{i}", int_prop=i) for i in range(5)])
+
+    for i in range(4):
+        resp = SimpleModel.query(SimpleModel.int_prop == i).fetch()
+        assert [m.int_prop for m in resp] == [i]
+    assert len(ndb_stub._query_planner) == 2
+
+
+def test_query_filter_mixed_types() -> None:
+    ndb.put_multi(
+        [
+            GenericPropertyModel(id="int", generic_prop=2),
+            GenericPropertyModel(id="float", generic_prop=1.5),
+            GenericPropertyModel(id="bool", generic_prop=True),
+            GenericPropertyModel(id="none", generic_prop=None),
+        ]
+    )
+
+    # Inequalities only match values of the filter's type
+    resp = GenericPropertyModel.query(GenericPropertyModel.generic_prop < 5).fetch()
+    assert [m.key.id() for m in resp] == ["int"]
+    resp = GenericPropertyModel.query(GenericPropertyModel.generic_prop > None).fetch()
+    assert sorted(m.key.id() for m in resp) == ["bool", "float", "int"]
+    resp = GenericPropertyModel.query(GenericPropertyModel.generic_prop == 1).fetch()
+    assert resp == []
+
+
+def test_query_result_cache(ndb_stub: datastore_stub.LocalDatastoreStub) -> None:
+    ndb_stub.query_cache.max_size = 10
+    ndb.put_multi([SimpleModel(id=f"test{i}", int_prop=i) for i in range(5)])
+    query = SimpleModel.query(SimpleModel.int_prop >= 2)
+
+    assert len(query.fetch()) == 3
+    assert len(query.fetch()) == 3
+    assert (ndb_stub.query_cache.hits, ndb_stub.query_cache.misses) == (1, 1)
+
+    # Writes to other kinds keep cached results valid
+    ChildModel(id="child", str_prop="asdf").put()
+    assert len(query.fetch()) == 3
+    assert ndb_stub.query_cache.hits == 2
+
+    SimpleModel(id="test5", int_prop=5).put()
+    assert len(query.fetch()) == 4
+    assert (ndb_stub.query_cache.hits, ndb_stub.query_cache.misses) == (2, 2)
+
+    SimpleModel.get_by_id("test5").key.delete()
+    assert len(query.fetch()) == 3
+    assert ndb_stub.query_cache.misses == 3
+
+
+def test_query_result_cache_disabled(
+    ndb_stub: datastore_stub.LocalDatastoreStub,
+) -> None:
+    ndb.put_multi([SimpleModel(id=f"test{i}", int_prop=i) for i in range(5)])
+    assert len(SimpleModel.query().fetch()) == 5
+    assert len(SimpleModel.query().fetch()) == 5
+    assert len(ndb_stub.query_cache) == 0
+    assert (ndb_stub.query_cache.hits, ndb_stub.query_cache.misses) == (0, 0)
+
+
+def test_query_key_filter() -> None:
+    ndb.put_multi([SimpleModel(id=f"test{i}", int_prop=i) for i in range(10)])
+
+    resp = SimpleModel.query(SimpleModel.key > ndb.Key(SimpleModel, "test6")).fetch()
+    assert [m.int_prop for m in resp] == [7, 8, 9]
+
+    resp = SimpleModel.query(
+        SimpleModel.key >= ndb.Key(SimpleModel, "test2"),
+        SimpleModel.key < ndb.Key(SimpleModel, "test5"),
+        SimpleModel.int_prop != 3,
+    ).fetch()
+    assert [m.int_prop for m in resp] == [2, 4]
+
+    resp = SimpleModel.query(SimpleModel.key == ndb.Key(SimpleModel, "test4")).fetch()
+    assert [m.int_prop for m in resp] == [4]
+
+
+def test_query_key_order() -> None:
+    ndb.put_multi([SimpleModel(id=i, int_prop=i) for i in range(1, 11)])
+    ndb.put_multi([SimpleModel(id=f"test{i}", int_prop=i) for i in range(3)])
+
+    # Numeric IDs sort before names
+    resp = SimpleModel.query().order(SimpleModel.key).fetch(offset=8, limit=4)
+    assert [m.key.id() for m in resp] == [9, 10, "test0", "test1"]
+
+    resp = SimpleModel.query().order(-SimpleModel.key).fetch(3)
+    assert [m.key.id() for m in resp] == ["test2", "test1", "test0"]
+
+    query = SimpleModel.query(SimpleModel.int_prop >= 2).order(SimpleModel.key)
+    page, cursor, more = query.fetch_page(5)
+    assert [m.key.id() for m in page] == [2, 3, 4, 5, 6]
+    assert more
+    page, cursor, more = query.fetch_page(5, start_cursor=cursor)
+    assert [m.key.id() for m in page] == [7, 8, 9, 10, "test2"]
+    assert not more
+
+
+def test_multi_level_ancestor_query() -> None:
+    root = SimpleModel(id="root")
+    parent = SimpleModel(id="parent", parent=root.key)
+    other_parent = SimpleModel(id="other", parent=root.key)
+    ndb.put_multi([root, parent, other_parent])
+    ndb.put_multi(
+        [
+            ChildModel(id=f"child{i}", parent=parent.key, str_prop=f"{i % 2}")
+            for i in range(4)
+        ]
+        + [ChildModel(id="other_child", parent=other_parent.key, str_prop="0")]
+        + [
+            ChildModel(
+                id="grandchild", parent=ndb.Key(ChildModel, "x", parent=parent.key)
+            )
+        ]
+    )
+
+    resp = ChildModel.query(ancestor=parent.key).fetch()
+    assert [m.key.id() for m in resp] == [
+        "child0",
+        "child1",
+        "child2",
+        "child3",
+        "grandchild",
+    ]
+
+    resp = ChildModel.query(ChildModel.str_prop == "0", ancestor=root.key).fetch()
+    assert sorted(m.key.id() for m in resp) == ["child0", "child2", "other_child"]
+
+    # An entity is part of its own ancestor queries
+    resp = SimpleModel.query(ancestor=root.key).fetch()
+    assert [m.key.id() for m in resp] == ["root", "other", "parent"]
+
+    resp = ndb.Query(ancestor=other_parent.key).fetch()
+    assert [m.key.id() for m in resp] == ["other", "other_child"]
@@ -0,0 +1,73 @@
+import grpc
+import pytest
+import subprocess
+import sys
+from google.cloud import ndb
+from google.cloud.datastore_v1 import types
+from google.cloud.datastore_v1.proto import datastore_pb2_grpc
+from typing import Iterator
+from InMemoryCloudDatastoreStub import datastore_stub, server
+from tests.models import SimpleModel
+
+
+@pytest.fixture()
+def client(
+    ndb_stub: datastore_stub.LocalDatastoreStub,
+) -> Iterator[datastore_pb2_grpc.DatastoreStub]:
+    grpc_server, port = server.serve(ndb_stub, port=0, max_workers=4)
+    with grpc.insecure_channel(f"localhost:{port}") as channel:
+        yield datastore_pb2_grpc.DatastoreStub(channel)
+    grpc_server.stop(grace=None)
+
+
+def test_server_shares_store(
+    ndb_stub: datastore_stub.LocalDatastoreStub,
+    client: datastore_pb2_grpc.DatastoreStub,
+) -> None:
+    SimpleModel(id="test1", int_prop=1).put()
+    entity = ndb.model._entity_to_protobuf(SimpleModel(id="test2", int_prop=2))
+    client.Commit(
+        types.CommitRequest(
+            mode=types.CommitRequest.Mode.NON_TRANSACTIONAL,
+            mutations=[types.Mutation(insert=entity)],
+        )
+    )
+
+    resp = client.Lookup(types.LookupRequest(keys=[entity.key]))
+    assert resp.found[0].entity.properties["int_prop"].integer_value == 2
+    resp = client.RunQuery(
+        types.RunQueryRequest(
+            project_id="datastore-stub-test",
+            query=types.Query(kind=[types.KindExpression(name="SimpleModel")]),
+        )
+    )
+    assert len(resp.batch.entity_results) == 2
+    assert SimpleModel.get_by_id("test2").int_prop == 2
+
+    incomplete = ndb.Key(SimpleModel, None)._key.to_protobuf()
+    resp = client.AllocateIds(types.AllocateIdsRequest(keys=[incomplete] * 2))
+    assert [k.path[-1].id for k in resp.keys] == [1, 2]
+
+
+def test_server_returns_errors(client: datastore_pb2_grpc.DatastoreStub) -> None:
+    with pytest.raises(grpc.RpcError) as e:
+        client.Commit(types.CommitRequest(transaction=b"expired"))
+    assert e.value.code() == grpc.StatusCode.INVALID_ARGUMENT
+
+
+def test_server_entry_point() -> None:
+    process = subprocess.Popen(
+        [sys.executable, "-m", "InMemoryCloudDatastoreStub.server", "--port", "0"],
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+    try:
+        assert process.stdout is not None
+        host = process.stdout.readline().strip().split("=")[1]
+        with grpc.insecure_channel(host) as channel:
+            client = datastore_pb2_grpc.DatastoreStub(channel)
+            resp = client.BeginTransaction(types.BeginTransactionRequest())
+            assert resp.transaction
+    finally:
+        process.kill()
+        process.wait()
@@ -0,0 +1,71 @@
+import pytest
+from typing import Any
+from google.cloud import ndb
+from InMemoryCloudDatastoreStub import datastore_stub
+from tests.models import ChildModel, SimpleModel
+
+
+def test_snapshot_round_trip(
+    ndb_stub: datastore_stub.LocalDatastoreStub, tmp_path: Any
+) -> None:
+    parent = SimpleModel(id="parent", str_prop="parent")
+    parent.put()
+    ndb.put_multi([SimpleModel(id=f"test{i}", int_prop=i) for i in range(5)])
+    ChildModel(id="child", parent=parent.key, str_prop="child").put()
+    snapshot = str(tmp_path / "snapshot")
+    ndb_stub.store.save_snapshot(snapshot)
+
+    # Loading replaces whatever was written since
+    ndb.delete_multi([ndb.Key(SimpleModel, f"test{i}") for i in range(3)])
+    SimpleModel(id="test9", int_prop=9).put()
+    ndb_stub.store.load_snapshot(snapshot)
+    ndb.get_context().clear_cache()
+
+    assert SimpleModel.get_by_id("test9") is None
+    assert SimpleModel.get_by_id("test1").int_prop == 1
+    resp = SimpleModel.query(SimpleModel.int_prop >= 3).fetch()
+    assert [m.int_prop for m in resp] == [3, 4]
+    resp = ChildModel.query(ancestor=parent.key).fetch()
+    assert [m.str_prop for m in resp] == ["child"]
+
+    # Loaded data can be modified like any other
+    SimpleModel(id="test3", int_prop=30).put()
+    SimpleModel(id=None, int_prop=5).put()
+    resp = SimpleModel.query(SimpleModel.int_prop >= 3).fetch()
+    assert sorted(m.int_prop for m in resp) == [4, 5, 30]
+
+
+def test_snapshot_rebuilds_composite_indexes(tmp_path: Any) -> None:
+    snapshot = str(tmp_path / "snapshot")
+    source = datastore_stub.LocalDatastoreStub()
+    for i in range(5):
+        source.store.put(
+            ndb.model._entity_to_protobuf(
+                SimpleModel(id=f"test{i}", str_prop=f"{i % 2}", int_prop=i)
+            ),
+            0,
+            None,
+        )
+    source.store.save_snapshot(snapshot)
+
+    stub = datastore_stub.LocalDatastoreStub(
+        indexes=[
+            {
+                "kind": "SimpleModel",
+                "properties": [{"name": "str_prop"}, {"name": "int_prop"}],
+            }
+        ]
+    )
+    stub.store.load_snapshot(snapshot)
+    partition = stub.store._partitions[("datastore-stub-test", "")]
+    index = partition.composite_indexes["SimpleModel"][0]
+    assert len(index) == 5
+
+
+def test_load_invalid_snapshot(
+    ndb_stub: datastore_stub.LocalDatastoreStub, tmp_path: Any
+) -> None:
+    path = tmp_path / "snapshot"
+    path.write_bytes(b"not a snapshot")
+    with pytest.raises(ValueError):
+        ndb_stub.store.load_snapshot(str(path))
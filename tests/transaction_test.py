@@ -1,6 +1,13 @@
+import grpc
+import pytest
+from google.cloud import ndb
+from google.cloud.datastore_v1 import types
 from InMemoryCloudDatastoreStub import datastore_stub
+from InMemoryCloudDatastoreStub._transactions import _TransactionType
 from tests.models import SimpleModel
 
+_PARTITION = ("datastore-stub-test", "")
+
 
 def test_get_or_insert_existing_by_id(
     ndb_stub: datastore_stub.LocalDatastoreStub,
@@ -29,3 +36,180 @@ def test_get_or_insert_then_update() -> None:
 
     sanity_check = SimpleModel.get_by_id("test")
     assert sanity_check == model
+
+
+def test_transaction_reads_snapshot(
+    ndb_stub: datastore_stub.LocalDatastoreStub,
+) -> None:
+    model = SimpleModel(id="test", int_prop=1)
+    ndb_stub._insert_model(model)
+    ds_key = model.key._key.to_protobuf()
+
+    transaction_id = ndb_stub.store.beginTransaction(_TransactionType.READ_WRITE)
+    model.int_prop = 2
+    ndb_stub.store.put(ndb.model._entity_to_protobuf(model), 1, None)
+    ndb_stub._insert_model(SimpleModel(id="test2", int_prop=3))
+
+    snapshot = ndb_stub.store.get(ds_key, transaction_id)
+    assert snapshot is not None
+    assert snapshot.entity.properties["int_prop"].integer_value == 1
+    latest = ndb_stub.store.get(ds_key, None)
+    assert latest is not None
+    assert latest.entity.properties["int_prop"].integer_value == 2
+
+    snapshot_items = list(
+        ndb_stub.store.items(_PARTITION, transaction_id, "SimpleModel")
+    )
+    assert len(snapshot_items) == 1
+
+    ndb_stub.store.rollbackTransaction(transaction_id)
+    assert ndb_stub.store._versions == {}
+
+
+def test_transaction_snapshot_sees_deleted_entities(
+    ndb_stub: datastore_stub.LocalDatastoreStub,
+) -> None:
+    model = SimpleModel(id="test", int_prop=1)
+    ndb_stub._insert_model(model)
+    ds_key = model.key._key.to_protobuf()
+
+    transaction_id = ndb_stub.store.beginTransaction(_TransactionType.READ_ONLY)
+    ndb_stub.store.delete(ds_key, None)
+
+    assert ndb_stub.store.get(ds_key, None) is None
+    assert ndb_stub.store.get(ds_key, transaction_id) is not None
+    assert (
+        len(list(ndb_stub.store.items(_PARTITION, transaction_id, "SimpleModel"))) == 1
+    )
+    assert list(ndb_stub.store.items(_PARTITION, b"", "SimpleModel")) == []
+
+    ndb_stub.store.rollbackTransaction(transaction_id)
+    assert ndb_stub.store._versions == {}
+
+
+def test_query_in_transaction() -> None:
+    parent = SimpleModel(id="parent")
+    parent.put()
+    SimpleModel(id="child", parent=parent.key, int_prop=10).put()
+
+    @ndb.transactional()
+    def query_and_update() -> int:
+        child = SimpleModel.query(SimpleModel.int_prop == 10, ancestor=parent.key).get()
+        child.int_prop = 20
+        child.put()
+        return child.int_prop
+
+    assert query_and_update() == 20
+    assert SimpleModel.get_by_id("child", parent=parent.key).int_prop == 20
+
+
+def test_non_overlapping_transactions_commit(
+    ndb_stub: datastore_stub.LocalDatastoreStub,
+) -> None:
+    model1 = SimpleModel(id="test1", int_prop=1)
+    model2 = SimpleModel(id="test2", int_prop=2)
+    ndb_stub._insert_model(model1)
+    ndb_stub._insert_model(model2)
+    key1 = model1.key._key.to_protobuf()
+    key2 = model2.key._key.to_protobuf()
+
+    transaction1 = ndb_stub.store.beginTransaction(_TransactionType.READ_WRITE)
+    transaction2 = ndb_stub.store.beginTransaction(_TransactionType.READ_WRITE)
+    assert ndb_stub.store.get(key1, transaction1) is not None
+    assert ndb_stub.store.get(key2, transaction2) is not None
+
+    model1.int_prop = 10
+    ndb_stub.store.commitTransaction(
+        transaction1, [types.Mutation(upsert=ndb.model._entity_to_protobuf(model1))]
+    )
+    model2.int_prop = 20
+    ndb_stub.store.commitTransaction(
+        transaction2, [types.Mutation(upsert=ndb.model._entity_to_protobuf(model2))]
+    )
+
+    assert SimpleModel.get_by_id("test1").int_prop == 10
+    assert SimpleModel.get_by_id("test2").int_prop == 20
+
+
+def test_conflicting_transaction_aborts(
+    ndb_stub: datastore_stub.LocalDatastoreStub,
+) -> None:
+    model = SimpleModel(id="test", int_prop=1)
+    ndb_stub._insert_model(model)
+    ds_key = model.key._key.to_protobuf()
+
+    transaction_id = ndb_stub.store.beginTransaction(_TransactionType.READ_WRITE)
+    assert ndb_stub.store.get(ds_key, transaction_id) is not None
+    model.int_prop = 2
+    ndb_stub.store.put(ndb.model._entity_to_protobuf(model), 1, None)
+
+    model.int_prop = 3
+    with pytest.raises(grpc.RpcError) as e:
+        ndb_stub.store.commitTransaction(
+            transaction_id,
+            [types.Mutation(upsert=ndb.model._entity_to_protobuf(model))],
+        )
+    assert e.value.code() == grpc.StatusCode.ABORTED
+    assert SimpleModel.get_by_id("test").int_prop == 2
+    assert ndb_stub.store._versions == {}
+
+
+def test_transaction_retried_after_conflict(
+    ndb_stub: datastore_stub.LocalDatastoreStub,
+) -> None:
+    model = SimpleModel(id="test", int_prop=1)
+    ndb_stub._insert_model(model)
+    attempts = []
+
+    @ndb.transactional()
+    def increment() -> None:
+        stored = SimpleModel.get_by_id("test")
+        if not attempts:
+            # Simulate a concurrent write from outside the transaction
+            concurrent = SimpleModel(id="test", int_prop=100)
+            ndb_stub.store.put(ndb.model._entity_to_protobuf(concurrent), 1, None)
+        attempts.append(stored.int_prop)
+        stored.int_prop += 1
+        stored.put()
+
+    increment()
+    assert attempts == [1, 100]
+    assert SimpleModel.get_by_id("test").int_prop == 101
+
+
+def test_ancestor_query_in_transaction_reads_snapshot(
+    ndb_stub: datastore_stub.LocalDatastoreStub,
+) -> None:
+    parent = SimpleModel(id="parent")
+    ndb_stub._insert_model(parent)
+    for i in range(3):
+        ndb_stub._insert_model(SimpleModel(id=f"child{i}", parent=parent.key))
+
+    transaction_id = ndb_stub.store.beginTransaction(_TransactionType.READ_ONLY)
+    ndb_stub.store.delete(
+        ndb.Key(SimpleModel, "child0", parent=parent.key)._key.to_protobuf(), None
+    )
+    ndb_stub._insert_model(SimpleModel(id="child3", parent=parent.key))
+
+    ancestor_filter = types.Filter(
+        property_filter=types.PropertyFilter(
+            property=types.PropertyReference(name="__key__"),
+            op=types.PropertyFilter.Operator.HAS_ANCESTOR,
+            value=types.Value(key_value=parent.key._key.to_protobuf()),
+        )
+    )
+    request = types.RunQueryRequest(
+        project_id="datastore-stub-test",
+        query=types.Query(
+            kind=[types.KindExpression(name="SimpleModel")], filter=ancestor_filter
+        ),
+        read_options=types.ReadOptions(transaction=transaction_id),
+    )
+    resp = ndb_stub.RunQuery(request)
+    assert [r.entity.key.path[-1].name for r in resp.batch.entity_results] == [
+        "parent",
+        "child0",
+        "child1",
+        "child2",
+    ]
+    ndb_stub.store.rollbackTransaction(transaction_id)